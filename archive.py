@@ -0,0 +1,338 @@
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from database import Database, DATABASE_PATH
+
+# Messages and posts older than this many days move out of the main database
+# into one archive file per month, next to it in ARCHIVE_DIR. Search does not
+# look in the archives, so it is off (0) unless asked for.
+ARCHIVE_AFTER_DAYS = int(os.environ.get('CHAT_ARCHIVE_AFTER_DAYS', 0))
+ARCHIVE_DIR = 'archive'
+# Seconds between archive runs in the GUI and the server.
+ARCHIVE_INTERVAL = 60 * 60
+# Rows moved per transaction, so the database thread is never held for long.
+ARCHIVE_BATCH = 1000
+# Archive files attached to one connection at once; the least recently read
+# one is detached to make room.
+MAX_ATTACHED = 4
+# Where the media store keeps files, relative to the database's directory;
+# the sweep never deletes anything outside them.
+MEDIA_DIRS = ('media', 'posts')
+# Unreferenced files younger than this are left alone; they may belong to an
+# upload whose row has not been written yet.
+MEDIA_GRACE = 24 * 60 * 60
+# Pages of work per compaction step, both for merging the search indexes
+# and for handing free pages back to the file system.
+VACUUM_PAGES = 2000
+SEARCH_INDEXES = ('messages_fts', 'posts_fts')
+
+ARCHIVED_COLUMNS = {
+    'messages': "id, sender_id, receiver_id, group_id, content, media_path, media_type, timestamp",
+    'status_posts': "id, user_id, content, media_path, media_type, timestamp",
+}
+
+ARCHIVE_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS {schema}.messages (
+        id INTEGER PRIMARY KEY,
+        sender_id INTEGER,
+        receiver_id INTEGER,
+        group_id INTEGER,
+        content TEXT,
+        media_path TEXT,
+        media_type TEXT,
+        timestamp DATETIME
+    );
+
+    CREATE TABLE IF NOT EXISTS {schema}.status_posts (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        content TEXT,
+        media_path TEXT,
+        media_type TEXT,
+        timestamp DATETIME
+    );
+
+    CREATE INDEX IF NOT EXISTS {schema}.idx_messages_direct ON messages (sender_id, receiver_id, id);
+    CREATE INDEX IF NOT EXISTS {schema}.idx_messages_group ON messages (group_id, id);
+'''
+
+# The archived_conversations key for a message row; conversation_key() below
+# is the same thing for a chat the GUI has open.
+CONVERSATION_KEY_SQL = """
+    CASE WHEN group_id IS NOT NULL THEN 'g' || group_id
+         ELSE 'u' || MIN(sender_id, receiver_id) || '-' || MAX(sender_id, receiver_id) END
+"""
+
+
+def conversation_key(user_id, chat_id, is_group):
+    if is_group:
+        return f"g{chat_id}"
+    return f"u{min(user_id, chat_id)}-{max(user_id, chat_id)}"
+
+
+def archive_cutoff(days=ARCHIVE_AFTER_DAYS):
+    # Timestamps are stored as "YYYY-MM-DD HH:MM:SS.ffffff" text, which sorts
+    # the same way as the times themselves.
+    return str(datetime.now() - timedelta(days=days))
+
+
+def database_dir(conn):
+    # The directory of the file conn has open as main; archives and media
+    # live next to it.
+    main_file = next(row[2] for row in conn.execute("PRAGMA database_list") if row[1] == 'main')
+    return os.path.dirname(main_file)
+
+
+def next_month(month):
+    year, number = map(int, month.split('-'))
+    return f"{year + number // 12}-{number % 12 + 1:02d}"
+
+
+class Archives:
+    # The month archives of the database conn is open on. They are attached
+    # to conn when a query needs them and detached least recently used first,
+    # so a connection never has more than MAX_ATTACHED extra files open.
+    def __init__(self, conn):
+        self.conn = conn
+        self.root = os.path.join(database_dir(conn), ARCHIVE_DIR)
+        self.attached = OrderedDict()
+
+    def path(self, month):
+        return os.path.join(self.root, f"chat-{month}.db")
+
+    def attach(self, month):
+        # Returns the schema name to qualify the month's tables with.
+        schema = self.attached.get(month)
+        if schema:
+            self.attached.move_to_end(month)
+            return schema
+        if len(self.attached) >= MAX_ATTACHED:
+            _, oldest = self.attached.popitem(last=False)
+            self.conn.execute(f"DETACH DATABASE {oldest}")
+        schema = f"archive_{month.replace('-', '_')}"
+        os.makedirs(self.root, exist_ok=True)
+        self.conn.execute(f"ATTACH DATABASE ? AS {schema}", (self.path(month),))
+        self.conn.executescript(ARCHIVE_SCHEMA.format(schema=schema))
+        self.attached[month] = schema
+        return schema
+
+    def open(self, month):
+        # A read-only connection of its own, for a long read such as an export
+        # that must not be detached from under it.
+        return sqlite3.connect(f"file:{self.path(month)}?mode=ro", uri=True)
+
+    def conversation_months(self, key, before_id=None, after_id=None, newest_first=True):
+        # The months holding messages of one conversation, limited to the ones
+        # with ids on the requested side of before_id/after_id.
+        return [month for (month,) in self.conn.execute(f"""
+            SELECT month FROM archived_conversations
+            WHERE conversation = ? AND first_id < COALESCE(?, 1 << 62) AND last_id > COALESCE(?, -1)
+            ORDER BY month {'DESC' if newest_first else 'ASC'}
+        """, (key, before_id, after_id))]
+
+    def post_months(self, before_id=None):
+        return [month for (month,) in self.conn.execute("""
+            SELECT month FROM archives
+            WHERE first_post_id < COALESCE(?, 1 << 62)
+            ORDER BY month DESC
+        """, (before_id,))]
+
+    def archive_step(self, cutoff, batch=ARCHIVE_BATCH):
+        # Moves up to batch of the oldest rows from before cutoff into their
+        # month's archive, messages first. Returns the number of rows moved,
+        # so 0 means there is nothing left to do.
+        for table in ('messages', 'status_posts'):
+            moved = self.archive_rows(table, cutoff, batch)
+            if moved:
+                return moved
+        return 0
+
+    def archive_rows(self, table, cutoff, batch):
+        first = self.conn.execute(f"SELECT id, timestamp FROM main.{table} ORDER BY id LIMIT 1").fetchone()
+        if first is None or first[1] is None or first[1] >= cutoff:
+            return 0
+        first_id, month = first[0], first[1][:7]
+        # The newest row always stays. The ids are a plain INTEGER PRIMARY
+        # KEY, so the next one is MAX(id) + 1, and an emptied table would hand
+        # out ids that archived rows, read receipts and the conversations
+        # summary already use.
+        newest_id = self.conn.execute(f"SELECT MAX(id) FROM main.{table}").fetchone()[0]
+        if first_id == newest_id:
+            return 0
+
+        # A batch never spans two months, so it goes into a single file.
+        last = self.conn.execute(f"SELECT id FROM main.{table} WHERE id >= ? ORDER BY id LIMIT 1 OFFSET ?",
+                                 (first_id, batch - 1)).fetchone()
+        high = min(last[0], newest_id - 1) if last else newest_id - 1
+        last_id = self.last_id_before(table, first_id, high, min(cutoff, f"{next_month(month)}-01"))
+
+        # Two transactions: with WAL, one spanning the archive file and the
+        # main database is only atomic per file, and a crash during its
+        # commit could keep the delete and lose the copy. The copy is
+        # committed first. If the delete never follows, the next step copies
+        # the same rows again, and until then readers take them from main
+        # (first_unarchived_id).
+        schema = self.attach(month)
+        columns = ARCHIVED_COLUMNS[table]
+        try:
+            self.conn.execute(f"""
+                INSERT OR REPLACE INTO {schema}.{table} ({columns})
+                SELECT {columns} FROM main.{table} WHERE id BETWEEN ? AND ?
+            """, (first_id, last_id))
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+
+        try:
+            # The delete trigger drops one media reference per row, but the
+            # archived copies still use the files, so they are added back.
+            self.conn.execute(f"""
+                INSERT INTO media_blobs (path, refcount)
+                SELECT media_path, COUNT(*) FROM main.{table}
+                WHERE id BETWEEN ? AND ? AND media_path IS NOT NULL
+                GROUP BY media_path
+                ON CONFLICT (path) DO UPDATE SET refcount = refcount + excluded.refcount
+            """, (first_id, last_id))
+            if table == 'messages':
+                self.conn.execute(f"""
+                    INSERT INTO archived_conversations (conversation, month, first_id, last_id)
+                    SELECT {CONVERSATION_KEY_SQL}, ?, MIN(id), MAX(id) FROM main.messages
+                    WHERE id BETWEEN ? AND ?
+                    GROUP BY 1
+                    ON CONFLICT (conversation, month) DO UPDATE SET
+                        first_id = MIN(first_id, excluded.first_id), last_id = MAX(last_id, excluded.last_id)
+                """, (month, first_id, last_id))
+                self.conn.execute("INSERT OR IGNORE INTO archives (month) VALUES (?)", (month,))
+            else:
+                self.conn.execute("""
+                    INSERT INTO archives (month, first_post_id, last_post_id) VALUES (?, ?, ?)
+                    ON CONFLICT (month) DO UPDATE SET
+                        first_post_id = MIN(COALESCE(first_post_id, excluded.first_post_id), excluded.first_post_id),
+                        last_post_id = MAX(COALESCE(last_post_id, excluded.last_post_id), excluded.last_post_id)
+                """, (month, first_id, last_id))
+            moved = self.conn.execute(f"DELETE FROM main.{table} WHERE id BETWEEN ? AND ?",
+                                      (first_id, last_id)).rowcount
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        return moved
+
+    def first_unarchived_id(self, table):
+        # Rows are archived oldest first, so the lowest id left in main bounds
+        # the ids that are archived; an archive row at or above it was copied
+        # by a step that did not get to its delete, and is still in main.
+        first_id = self.conn.execute(f"SELECT MIN(id) FROM main.{table}").fetchone()[0]
+        return 1 << 62 if first_id is None else first_id
+
+    def last_id_before(self, table, low, high, bound):
+        # Ids and timestamps rise together, so the rows before bound are a
+        # prefix of [low, high]; a binary search on id finds where it ends.
+        # low itself is known to be before bound.
+        probe = f"SELECT id, timestamp FROM main.{table} WHERE id >= ? ORDER BY id LIMIT 1"
+        last_id = low
+        low += 1
+        while low <= high:
+            middle = (low + high) // 2
+            row_id, timestamp = self.conn.execute(probe, (middle,)).fetchone()
+            if row_id > high:
+                high = middle - 1
+            elif timestamp is None or timestamp < bound:
+                last_id = row_id
+                low = row_id + 1
+            else:
+                high = middle - 1
+        return last_id
+
+
+def collect_media(conn, roots=MEDIA_DIRS, grace=MEDIA_GRACE):
+    # Deletes the files of media_blobs rows nothing counts any more, then
+    # forgets those rows. Only files the database recorded are candidates,
+    # and only inside roots; both the stored paths and roots are taken from
+    # the database's directory, wherever this runs from. A blob elsewhere,
+    # such as a profile picture picked before the media store existed, is
+    # forgotten but its file is left alone. Returns the number of files
+    # removed.
+    base = database_dir(conn)
+    roots = tuple(os.path.join(os.path.realpath(os.path.join(base, root)), '') for root in roots)
+    now = time.time()
+    removed = 0
+    for (path,) in conn.execute("SELECT path FROM media_blobs WHERE refcount <= 0").fetchall():
+        full_path = os.path.realpath(os.path.join(base, path))
+        if full_path.startswith(roots):
+            try:
+                if now - os.path.getmtime(full_path) < grace:
+                    continue
+                os.remove(full_path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        # A reference added since the SELECT keeps its row.
+        conn.execute("DELETE FROM media_blobs WHERE path = ? AND refcount <= 0", (path,))
+    conn.commit()
+    return removed
+
+
+def compact(conn, pages=VACUUM_PAGES, full=False):
+    # One step of shrinking the database file; returns how much work it did,
+    # so 0 means it is done. The search indexes keep a delete marker for
+    # every archived row until their segments are merged, so that comes
+    # first. Then free pages go back to the file system, which needs
+    # auto_vacuum=INCREMENTAL. A database created before that was set only
+    # gets it from one full VACUUM, which rewrites the whole file under the
+    # write lock; only full=True (archive.py run by hand) does that, and
+    # the app and the server leave such a file at its size.
+    conn.commit()
+    for index in SEARCH_INDEXES:
+        changes = conn.total_changes
+        conn.execute(f"INSERT INTO {index} ({index}, rank) VALUES ('merge', ?)", (-pages,))
+        conn.commit()
+        # A merge that found nothing to do still counts as one change.
+        if conn.total_changes - changes > 1:
+            return conn.total_changes - changes
+
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        if full:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        return 0
+    free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    # Each step of the statement frees one page; executescript() runs it to
+    # the end where execute() would stop after the first.
+    conn.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+    # In WAL mode the file only shrinks once the change is checkpointed.
+    conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    return free_pages - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move old messages and posts into monthly archives, "
+                                                 "delete unused media files and compact the database.")
+    parser.add_argument("--db", default=DATABASE_PATH)
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS,
+                        help="archive rows older than this; 0 only collects media and compacts")
+    parser.add_argument("--batch", type=int, default=ARCHIVE_BATCH)
+    args = parser.parse_args()
+
+    db = Database(args.db)
+    archives = Archives(db.conn)
+    moved = 0
+    if args.days > 0:
+        cutoff = archive_cutoff(args.days)
+        while step := archives.archive_step(cutoff, args.batch):
+            moved += step
+    removed = collect_media(db.conn)
+    while compact(db.conn, full=True):
+        pass
+    db.close()
+    print(f"archived {moved} rows, removed {removed} media files", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
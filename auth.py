@@ -0,0 +1,31 @@
+import os
+
+# bcrypt work factor for new and upgraded hashes; each step doubles the cost
+# of a login. Hashes made with another factor are redone at the next login.
+BCRYPT_ROUNDS = int(os.environ.get('CHAT_BCRYPT_ROUNDS', 12))
+
+
+def hash_rounds(hashed):
+    # "$2b$12$..." -> 12
+    try:
+        return int(hashed.split(b'$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+# bcrypt is imported where it is used, on the thread checking the password,
+# so loading it is not part of starting the app.
+def hash_password(password, rounds=BCRYPT_ROUNDS):
+    import bcrypt
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds))
+
+
+def check_password(password, hashed, rounds=BCRYPT_ROUNDS):
+    # Returns (matches, new_hash); new_hash is only set when the password
+    # matched a hash made with a different work factor and should replace it.
+    import bcrypt
+    if not bcrypt.checkpw(password.encode('utf-8'), hashed):
+        return False, None
+    if hash_rounds(hashed) != rounds:
+        return True, hash_password(password, rounds)
+    return True, None
@@ -0,0 +1,83 @@
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from seed import seed_database
+
+from repository import ChatService
+
+
+def timed(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def database_size(service):
+    # Pages in use by the main database, whatever the WAL holds at the time.
+    conn = service.db.conn
+    return conn.execute("PRAGMA page_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+
+
+def measure(label, service, args):
+    # What opening the app costs: a chat's newest page, the sidebar counters
+    # and the posts feed, then a page from far back in the same chat.
+    oldest = service.db.conn.execute("SELECT MIN(id) FROM messages WHERE group_id = 1").fetchone()[0]
+    results = {
+        'latest page': timed(lambda: service.get_messages_page(1, 1, True), args.repeat),
+        'unread counts': timed(lambda: service.get_unread_counts(1), args.repeat),
+        'posts page': timed(lambda: service.get_posts_page(), args.repeat),
+        'page before main': timed(lambda: service.get_messages_page(1, 1, True, before_id=oldest), args.repeat),
+    }
+    print(f"{label:8} {database_size(service) / 2 ** 20:8.1f} MiB  " +
+          "  ".join(f"{name} {ms:7.3f} ms" for name, ms in results.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hot-path reads before and after old rows are archived.")
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--posts", type=int, default=20000)
+    parser.add_argument("--months", type=int, default=24, help="how far back the seeded history goes")
+    parser.add_argument("--keep-days", type=int, default=90, help="rows newer than this stay in the main table")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--path", help="database file to seed (default: a temporary directory)")
+    args = parser.parse_args()
+
+    path = args.path or os.path.join(tempfile.mkdtemp(), "archive.db")
+    spacing = args.months * 30 * 24 * 3600 / args.messages
+    seed_database(path, messages=args.messages, posts=args.posts, message_spacing=spacing).close()
+
+    service = ChatService(path)
+    # The app keeps the change feed trimmed; the seed leaves a row per message.
+    service.prune_changes()
+    while service.compact():
+        pass
+    measure("before", service, args)
+
+    newest = service.db.conn.execute("SELECT MAX(timestamp) FROM messages").fetchone()[0]
+    cutoff = str(datetime.fromisoformat(newest) - timedelta(days=args.keep_days))
+    started = time.perf_counter()
+    moved = 0
+    while step := service.repository.archive_step(cutoff):
+        moved += step
+    archived = time.perf_counter() - started
+    started = time.perf_counter()
+    while service.compact():
+        pass
+    compacted = time.perf_counter() - started
+    print(f"archived {moved} rows in {archived:.1f} s ({moved / archived:.0f} rows/s), "
+          f"compacted in {compacted:.1f} s", file=sys.stderr)
+
+    measure("after", service, args)
+    service.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+from seed import seed_database
+
+from auth import hash_password
+from chat_server import ChatClient, serve
+from database import Database
+from repository import ChatService
+
+# Every seeded user gets this password for server runs, where clients log in.
+PASSWORD = "bench"
+
+# What one simulated client does, as (operation, weight). Polling the change
+# feed and refreshing unread counts dominate, as they do for an idle client.
+QUERY_MIX = [
+    ('poll_changes', 40),
+    ('unread_counts', 20),
+    ('load_messages', 15),
+    ('load_groups', 5),
+    ('load_posts', 5),
+    ('save_message', 15),
+]
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summarize(latencies, elapsed):
+    ordered = sorted(latencies)
+    if not ordered:
+        return {'count': 0}
+    return {
+        'count': len(ordered),
+        'throughput_ops_s': round(len(ordered) / elapsed, 1),
+        'p50_ms': round(percentile(ordered, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(ordered, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(ordered, 0.99) * 1000, 3),
+        'max_ms': round(ordered[-1] * 1000, 3),
+    }
+
+
+class ClientState:
+    def __init__(self, client_id, args):
+        self.rng = random.Random(client_id)
+        self.user_id = self.rng.randint(1, args.users)
+        self.peer_id = self.rng.randint(1, args.users)
+        self.last_change_id = 0
+        self.operations = [name for name, _ in QUERY_MIX]
+        self.weights = [weight for _, weight in QUERY_MIX]
+
+    def next_call(self):
+        # Returns (operation, ChatService method, args) for the next request.
+        operation = self.rng.choices(self.operations, self.weights)[0]
+        if operation == 'poll_changes':
+            return operation, 'get_changes', (self.last_change_id,)
+        if operation == 'unread_counts':
+            return operation, 'get_unread_counts', (self.user_id,)
+        if operation == 'load_messages':
+            return operation, 'get_messages_page', (self.user_id, self.peer_id, False)
+        if operation == 'load_groups':
+            return operation, 'get_user_groups', (self.user_id,)
+        if operation == 'load_posts':
+            return operation, 'get_posts_page', ()
+        return operation, 'save_message', (self.user_id, self.peer_id, False, "load test", None, None)
+
+    def record(self, method, result):
+        if method == 'get_changes' and result:
+            self.last_change_id = result[-1][0]
+
+
+def direct_client(path, client_id, args, start_event, results):
+    service = ChatService(path)
+    state = ClientState(client_id, args)
+    state.last_change_id = service.latest_change_id()
+    latencies = {name: [] for name, _ in QUERY_MIX}
+    errors = 0
+    start_event.wait()
+    deadline = time.perf_counter() + args.duration
+    while time.perf_counter() < deadline:
+        operation, method, call_args = state.next_call()
+        started = time.perf_counter()
+        try:
+            state.record(method, getattr(service, method)(*call_args))
+        except Exception:
+            service.db.conn.rollback()
+            errors += 1
+        latencies[operation].append(time.perf_counter() - started)
+        if args.think:
+            time.sleep(state.rng.expovariate(1 / args.think))
+    results.put((latencies, errors))
+
+
+def run_direct(path, args):
+    # One process per client, each with its own connection to the file.
+    start_event = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    clients = [multiprocessing.Process(target=direct_client, args=(path, i, args, start_event, results))
+               for i in range(args.clients)]
+    for process in clients:
+        process.start()
+    time.sleep(0.5)
+    started = time.perf_counter()
+    start_event.set()
+    collected = [results.get() for _ in clients]
+    elapsed = time.perf_counter() - started
+    for process in clients:
+        process.join()
+    return collected, elapsed
+
+
+def run_server_process(path, address):
+    asyncio.run(serve(path, address))
+
+
+async def server_client(address, client_id, args, ready, start_event):
+    client = await ChatClient().connect(address)
+    state = ClientState(client_id, args)
+    try:
+        await client.call('login', f"user{state.user_id}", PASSWORD)
+    finally:
+        # A failed login is raised by gather() rather than left waiting.
+        ready.put_nowait(client_id)
+    latencies = {name: [] for name, _ in QUERY_MIX}
+    errors = 0
+    await start_event.wait()
+    deadline = time.perf_counter() + args.duration
+    while time.perf_counter() < deadline:
+        operation, method, call_args = state.next_call()
+        started = time.perf_counter()
+        try:
+            if method == 'get_changes':
+                # The server pushes the client its changes instead.
+                while not client.pushes.empty():
+                    state.record(method, client.pushes.get_nowait())
+            else:
+                state.record(method, await client.call(method, *call_args))
+        except Exception:
+            errors += 1
+        latencies[operation].append(time.perf_counter() - started)
+        if args.think:
+            await asyncio.sleep(state.rng.expovariate(1 / args.think))
+    await client.close()
+    return latencies, errors
+
+
+async def run_clients(address, args):
+    # The clock starts once every client has logged in, which is a bcrypt
+    # check each on the server.
+    ready = asyncio.Queue()
+    start_event = asyncio.Event()
+    tasks = [asyncio.create_task(server_client(address, i, args, ready, start_event))
+             for i in range(args.clients)]
+    for _ in tasks:
+        await ready.get()
+    started = time.perf_counter()
+    start_event.set()
+    collected = await asyncio.gather(*tasks)
+    return collected, time.perf_counter() - started
+
+
+def run_server(path, args):
+    # The server gets its own process; the clients share this one as asyncio tasks.
+    db = Database(path)
+    db.conn.execute("UPDATE users SET password = ?", (hash_password(PASSWORD),))
+    db.conn.commit()
+    db.close()
+
+    address = f"unix:{os.path.join(tempfile.mkdtemp(), 'bench.sock')}"
+    server = multiprocessing.Process(target=run_server_process, args=(path, address), daemon=True)
+    server.start()
+    deadline = time.time() + 30
+    while not os.path.exists(address[len('unix:'):]):
+        if time.time() > deadline:
+            raise RuntimeError("chat server did not start")
+        time.sleep(0.05)
+    try:
+        return asyncio.run(run_clients(address, args))
+    finally:
+        server.terminate()
+        server.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated chat clients against the backend; prints JSON.")
+    parser.add_argument("--transport", choices=["direct", "server"], default="direct",
+                        help="direct: each client opens chat_app.db; server: clients talk to chat_server.py")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load")
+    parser.add_argument("--think", type=float, default=0.0,
+                        help="mean pause between a client's requests in seconds (0 = closed loop)")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--groups", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--posts", type=int, default=1000)
+    parser.add_argument("--path", help="reuse (or create) the seeded database at this path")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    path = args.path or os.path.join(tempfile.mkdtemp(), "backend.db")
+    if not os.path.exists(path):
+        seed_database(path, users=args.users, groups=args.groups, messages=args.messages,
+                      posts=args.posts).conn.close()
+
+    print(f"{args.clients} {args.transport} clients for {args.duration:.0f} s", file=sys.stderr)
+    collected, elapsed = run_direct(path, args) if args.transport == "direct" else run_server(path, args)
+
+    by_operation = {name: [] for name, _ in QUERY_MIX}
+    errors = 0
+    for latencies, failed in collected:
+        errors += failed
+        for name, samples in latencies.items():
+            by_operation[name].extend(samples)
+
+    report = {
+        'config': {key: getattr(args, key) for key in ('transport', 'clients', 'duration', 'think', 'users',
+                                                       'groups', 'messages', 'posts')},
+        'elapsed_s': round(elapsed, 3),
+        'errors': errors,
+        'total': summarize([sample for samples in by_operation.values() for sample in samples], elapsed),
+        'operations': {name: summarize(samples, elapsed) for name, samples in by_operation.items()},
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
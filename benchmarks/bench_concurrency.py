@@ -0,0 +1,127 @@
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from seed import seed_database
+
+from database import Database
+from repository import ChatService
+
+# The pre-WAL defaults, for comparison.
+LEGACY_PRAGMAS = {'journal_mode': 'DELETE', 'synchronous': 'FULL', 'busy_timeout': 5000,
+                  'cache_size': -2000, 'mmap_size': 0}
+
+
+def sender(path, pragmas, sender_id, messages, start_event, results):
+    # Always puts a result, even if the connection cannot be opened, so the
+    # parent never waits for a child that has died.
+    latencies = []
+    errors = 0
+    try:
+        service = ChatService(path, pragmas=pragmas)
+        service.db  # connect before the clock starts
+        start_event.wait()
+        for i in range(messages):
+            started = time.perf_counter()
+            try:
+                service.save_message(sender_id, sender_id % 50 + 1, False, f"stress {sender_id}:{i}")
+            except sqlite3.OperationalError:
+                service.db.conn.rollback()
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+    finally:
+        results.put((latencies, errors + messages - len(latencies)))
+
+
+def reader(path, pragmas, user_id, stop_event, start_event, results):
+    latencies = []
+    try:
+        service = ChatService(path, pragmas=pragmas)
+        service.db
+        start_event.wait()
+        while not stop_event.is_set():
+            started = time.perf_counter()
+            try:
+                service.get_changes(0, 100)
+                service.get_unread_counts(user_id)
+            except sqlite3.OperationalError:
+                pass
+            latencies.append(time.perf_counter() - started)
+            time.sleep(0.01)
+    finally:
+        results.put(latencies)
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run(label, pragmas, args):
+    path = os.path.join(tempfile.mkdtemp(), "stress.db")
+    seed_database(path, users=100, groups=10, messages=args.seed_messages, posts=0).conn.close()
+    # Switches the journal mode before the children open the file; a child
+    # that had to do it would find the database locked by the others.
+    Database(path, pragmas=pragmas).close()
+
+    start_event = multiprocessing.Event()
+    stop_event = multiprocessing.Event()
+    sender_results = multiprocessing.Queue()
+    reader_results = multiprocessing.Queue()
+    senders = [multiprocessing.Process(target=sender, args=(path, pragmas, i + 1, args.messages,
+                                                             start_event, sender_results))
+               for i in range(args.senders)]
+    readers = [multiprocessing.Process(target=reader, args=(path, pragmas, i + 1, stop_event,
+                                                             start_event, reader_results))
+               for i in range(args.readers)]
+    for process in senders + readers:
+        process.start()
+
+    time.sleep(0.5)
+    started = time.perf_counter()
+    start_event.set()
+    write_latencies, errors = [], 0
+    for _ in senders:
+        latencies, failed = sender_results.get()
+        write_latencies.extend(latencies)
+        errors += failed
+    elapsed = time.perf_counter() - started
+    stop_event.set()
+    read_latencies = []
+    for _ in readers:
+        read_latencies.extend(reader_results.get())
+    for process in senders + readers:
+        process.join()
+
+    total = args.senders * args.messages
+    if not write_latencies:
+        print(f"{label:8} no message was sent, locked errors {errors}")
+        return
+    print(f"{label:8} {total / elapsed:10.0f} msg/s  "
+          f"write p50 {statistics.median(write_latencies) * 1000:7.2f} ms  "
+          f"p99 {percentile(write_latencies, 0.99) * 1000:8.2f} ms  "
+          f"max {max(write_latencies) * 1000:8.2f} ms  "
+          f"read p99 {percentile(read_latencies, 0.99) * 1000 if read_latencies else 0:8.2f} ms  "
+          f"locked errors {errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent sender processes against one chat_app.db file.")
+    parser.add_argument("--senders", type=int, default=8)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=500, help="messages per sender")
+    parser.add_argument("--seed-messages", type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f"{args.senders} senders x {args.messages} messages, {args.readers} polling readers", file=sys.stderr)
+    run("legacy", LEGACY_PRAGMAS, args)
+    run("wal", None, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from seed import seed_database
+
+from records import Message
+from repository import ChatService, conversation_filter, export_line
+
+QUERY = """
+    SELECT m.id, m.content, m.media_path, m.media_type, m.timestamp, u.username
+    FROM messages m
+    JOIN users u ON m.sender_id = u.id
+    WHERE {where}
+    ORDER BY m.id
+"""
+
+
+def seed_conversation(path, messages):
+    # Two users and one long conversation between them.
+    db = seed_database(path, users=2, groups=0, messages=0, posts=0)
+    start = datetime(2020, 1, 1)
+    db.conn.executemany("INSERT INTO messages (sender_id, receiver_id, content, timestamp) VALUES (?, ?, ?, ?)",
+                        ((i % 2 + 1, 2 - i % 2, f"message number {i} in a long conversation",
+                          start + timedelta(seconds=i)) for i in range(messages)))
+    db.conn.commit()
+    db.close()
+
+
+def export_fetchall(service, path, record):
+    # The whole result is fetched into a list before any of it is written.
+    where, params = conversation_filter(1, 2, False)
+    rows = service.db.conn.execute(QUERY.format(where=where), params).fetchall()
+    if record:
+        rows = [Message(*row) for row in rows]
+    with open(path, 'w', encoding='utf-8') as f:
+        for row in rows:
+            f.write(export_line(row if record else Message(*row)))
+    return len(rows)
+
+
+def export_streamed(service, path, record):
+    return service.export_conversation(1, 2, False, path)
+
+
+def measure(label, export, service, record):
+    output = os.path.join(tempfile.mkdtemp(), "export.txt")
+    tracemalloc.start()
+    started = time.perf_counter()
+    count = export(service, output, record)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:20} {count} messages  peak {peak / 2 ** 20:8.1f} MiB  {elapsed:6.2f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak Python memory while exporting one long conversation.")
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--path", help="reuse (or create) the seeded database at this path")
+    args = parser.parse_args()
+
+    path = args.path or os.path.join(tempfile.mkdtemp(), "export.db")
+    if not os.path.exists(path):
+        seed_conversation(path, args.messages)
+
+    service = ChatService(path)
+    row = service.db.conn.execute(QUERY.format(where="m.id = 1")).fetchone()
+    print(f"one row: tuple {sys.getsizeof(row)} bytes, Message {sys.getsizeof(Message(*row))} bytes",
+          file=sys.stderr)
+    measure("tuples, fetchall", export_fetchall, service, False)
+    measure("records, fetchall", export_fetchall, service, True)
+    measure("records, streamed", export_streamed, service, True)
+    service.close()
+
+
+if __name__ == '__main__':
+    main()
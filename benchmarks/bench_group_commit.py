@@ -0,0 +1,94 @@
+import argparse
+import os
+import queue
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from seed import seed_database
+
+from database import CONNECTION_PRAGMAS
+from group_commit import CommitStats, collect_batch
+from repository import ChatService
+
+STOP = object()
+
+
+def producer(jobs, sender_id, messages, start_event):
+    start_event.wait()
+    for i in range(messages):
+        jobs.put((time.perf_counter(), (sender_id, sender_id % 50 + 1, False, f"burst {sender_id}:{i}", None, None)))
+
+
+def writer(path, pragmas, jobs, group_commit, latencies, stats):
+    # Mirrors DatabaseWorker.run: one connection, jobs taken in queue order.
+    service = ChatService(path, pragmas=pragmas)
+    while True:
+        job = jobs.get()
+        if job is STOP:
+            break
+        started = time.perf_counter()
+        if group_commit:
+            batch, leftover = collect_batch(jobs, job, lambda queued: queued is not STOP)
+            service.save_messages([args for _, args in batch])
+        else:
+            batch, leftover = [job], None
+            service.save_message(*job[1])
+        committed = time.perf_counter()
+        stats.record(len(batch), committed - started)
+        latencies.extend(committed - queued_at for queued_at, _ in batch)
+        if leftover is STOP:
+            break
+    service.close()
+
+
+def run(label, group_commit, pragmas, args):
+    path = os.path.join(tempfile.mkdtemp(), "group_commit.db")
+    seed_database(path, users=100, groups=10, messages=args.seed_messages, posts=0).conn.close()
+
+    jobs = queue.Queue()
+    start_event = threading.Event()
+    latencies = []
+    stats = CommitStats()
+    writer_thread = threading.Thread(target=writer, args=(path, pragmas, jobs, group_commit, latencies, stats))
+    producers = [threading.Thread(target=producer, args=(jobs, i + 1, args.messages, start_event))
+                 for i in range(args.senders)]
+    writer_thread.start()
+    for thread in producers:
+        thread.start()
+
+    started = time.perf_counter()
+    start_event.set()
+    for thread in producers:
+        thread.join()
+    jobs.put(STOP)
+    writer_thread.join()
+    elapsed = time.perf_counter() - started
+
+    snapshot = stats.snapshot()
+    ordered = sorted(latencies)
+    print(f"{label:14} {snapshot['messages'] / elapsed:10.0f} msg/s  "
+          f"{snapshot['batches']:6} commits  mean batch {snapshot['mean_batch']:6.1f}  "
+          f"ack p50 {statistics.median(ordered) * 1000:8.2f} ms  "
+          f"p99 {ordered[int(len(ordered) * 0.99)] * 1000:8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Message write throughput with and without group commit.")
+    parser.add_argument("--senders", type=int, default=4, help="threads queueing messages at once")
+    parser.add_argument("--messages", type=int, default=2000, help="messages per sender")
+    parser.add_argument("--seed-messages", type=int, default=100000)
+    parser.add_argument("--synchronous", default=CONNECTION_PRAGMAS['synchronous'],
+                        help="PRAGMA synchronous for the writer; FULL fsyncs every commit")
+    args = parser.parse_args()
+
+    pragmas = dict(CONNECTION_PRAGMAS, synchronous=args.synchronous)
+    print(f"{args.senders} senders x {args.messages} messages, synchronous={args.synchronous}", file=sys.stderr)
+    run("per-message", False, pragmas, args)
+    run("group commit", True, pragmas, args)
+
+
+if __name__ == '__main__':
+    main()
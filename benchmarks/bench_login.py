@@ -0,0 +1,72 @@
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from seed import seed_database
+
+from auth import BCRYPT_ROUNDS, check_password, hash_password
+from repository import ChatService
+
+
+def login(services, path, username, password, rounds, burst_started):
+    # What LoginWindow does for one user: fetch the hash, check it off the
+    # GUI thread and store the upgraded hash if the work factor changed.
+    if not hasattr(services, 'service'):
+        services.service = ChatService(path)
+    user_id, stored = services.service.get_user_credentials(username)
+    matches, new_hash = check_password(password, stored, rounds)
+    if not matches:
+        raise RuntimeError(f"{username} was rejected")
+    if new_hash:
+        services.service.set_password(user_id, new_hash)
+    return time.perf_counter() - burst_started, new_hash is not None
+
+
+def run(workers, args):
+    # Every user logs in at the same moment, as after a server restart.
+    path = os.path.join(tempfile.mkdtemp(), "login.db")
+    db = seed_database(path, users=args.logins, groups=0, messages=0, posts=0)
+    db.conn.execute("UPDATE users SET password = ?", (hash_password(args.password, args.stored_rounds),))
+    db.conn.commit()
+    db.close()
+
+    services = threading.local()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        started = time.perf_counter()
+        futures = [executor.submit(login, services, path, f"user{i}", args.password, args.rounds, started)
+                   for i in range(1, args.logins + 1)]
+        results = [future.result() for future in futures]
+        elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for latency, _ in results)
+    rehashed = sum(1 for _, upgraded in results if upgraded)
+    print(f"{workers:3} workers  {args.logins / elapsed:8.1f} logins/s  "
+          f"p50 {statistics.median(latencies) * 1000:8.1f} ms  "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:8.1f} ms  {rehashed} rehashed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Login throughput when many users authenticate at once.")
+    parser.add_argument("--logins", type=int, default=64, help="users logging in at the same moment")
+    parser.add_argument("--workers", default="1,2,4,8", help="comma-separated thread pool sizes to try")
+    parser.add_argument("--rounds", type=int, default=BCRYPT_ROUNDS, help="work factor logins are checked against")
+    parser.add_argument("--stored-rounds", type=int, help="work factor of the stored hashes (default --rounds); "
+                                                          "a different value makes every login rehash")
+    parser.add_argument("--password", default="correct horse battery staple")
+    args = parser.parse_args()
+    if args.stored_rounds is None:
+        args.stored_rounds = args.rounds
+
+    print(f"{args.logins} logins, stored rounds {args.stored_rounds}, target rounds {args.rounds}, "
+          f"{os.cpu_count()} CPUs", file=sys.stderr)
+    for workers in [int(count) for count in args.workers.split(",")]:
+        run(workers, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from seed import seed_database
+
+# The per-tick queries issued by MainWindow and ChatWidget timers.
+POLL_QUERIES = {
+    "check_new_messages (direct)": ("""
+        SELECT MAX(id) FROM messages
+        WHERE (sender_id = ? AND receiver_id = ?)
+        OR (sender_id = ? AND receiver_id = ?)
+    """, lambda u, p, g: (u, p, p, u)),
+    "check_new_messages (group)": ("""
+        SELECT MAX(id) FROM messages WHERE group_id = ?
+    """, lambda u, p, g: (g,)),
+    "check_unread_messages (direct)": ("""
+        SELECT COUNT(*) FROM messages
+        WHERE sender_id = ? AND receiver_id = ?
+        AND id > COALESCE((
+            SELECT MAX(id) FROM messages
+            WHERE (sender_id = ? AND receiver_id = ?)
+            OR (sender_id = ? AND receiver_id = ?)
+        ), 0)
+    """, lambda u, p, g: (p, u, u, p, p, u)),
+    "check_unread_messages (group)": ("""
+        SELECT COUNT(*) FROM messages
+        WHERE group_id = ? AND sender_id != ?
+        AND id > COALESCE((
+            SELECT MAX(id) FROM messages
+            WHERE group_id = ? AND sender_id = ?
+        ), 0)
+    """, lambda u, p, g: (g, u, g, u)),
+    "load_groups": ("""
+        SELECT g.id, g.name FROM groups g
+        JOIN group_members gm ON g.id = gm.group_id
+        WHERE gm.user_id = ?
+    """, lambda u, p, g: (u,)),
+    "load_posts": ("""
+        SELECT sp.content, sp.media_path, sp.media_type, sp.timestamp
+        FROM status_posts sp
+        ORDER BY sp.timestamp DESC
+        LIMIT 50
+    """, lambda u, p, g: ()),
+}
+
+
+def time_queries(db, args):
+    rng = random.Random(1)
+    results = {}
+    for name, (sql, make_params) in POLL_QUERIES.items():
+        samples = []
+        for _ in range(args.repeat):
+            params = make_params(rng.randint(1, args.users), rng.randint(1, args.users),
+                                 rng.randint(1, args.groups))
+            started = time.perf_counter()
+            db.conn.execute(sql, params).fetchall()
+            samples.append((time.perf_counter() - started) * 1000)
+        results[name] = statistics.median(samples)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Poll query latency before and after the index migration.")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--groups", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--posts", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    print(f"Seeding {args.messages} messages into {path} ...", file=sys.stderr)
+    db = seed_database(path, users=args.users, groups=args.groups, messages=args.messages,
+                       posts=args.posts, schema_version=1)
+
+    before = time_queries(db, args)
+    started = time.perf_counter()
+    db.migrate()
+    migration_seconds = time.perf_counter() - started
+    after = time_queries(db, args)
+
+    print(f"Migrated to schema version {db.schema_version} in {migration_seconds:.2f}s")
+    print(f"{'query':34} {'before (ms)':>12} {'after (ms)':>12} {'speedup':>9}")
+    for name in POLL_QUERIES:
+        print(f"{name:34} {before[name]:12.3f} {after[name]:12.3f} {before[name] / max(after[name], 1e-6):8.0f}x")
+
+    db.conn.close()
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from seed import seed_database
+
+from repository import ChatService
+
+# Terms of decreasing frequency in the seeded vocabulary, from a word in
+# roughly a third of all messages down to one in a few hundred.
+QUERIES = ["word1", "word2 word3", "word50", "word500", "word4999", "word7 word900"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time ChatService.search_messages on a large chat_app.db.")
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--vocabulary", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--path", help="reuse (or create) the seeded database at this path")
+    args = parser.parse_args()
+
+    path = args.path or os.path.join(tempfile.mkdtemp(), "search.db")
+    if not os.path.exists(path):
+        started = time.perf_counter()
+        seed_database(path, users=args.users, messages=args.messages, vocabulary=args.vocabulary).conn.close()
+        print(f"seeded {args.messages} messages in {time.perf_counter() - started:.0f} s", file=sys.stderr)
+
+    service = ChatService(path)
+    rng = random.Random(0)
+    for query in QUERIES:
+        timings = []
+        hits = 0
+        for _ in range(args.repeat):
+            user_id = rng.randint(1, args.users)
+            started = time.perf_counter()
+            hits = len(service.search_messages(user_id, query))
+            timings.append(time.perf_counter() - started)
+        print(f"{query:16} median {statistics.median(timings) * 1000:7.2f} ms  "
+              f"max {max(timings) * 1000:7.2f} ms  ({hits} hits on the first page)")
+
+
+if __name__ == '__main__':
+    main()
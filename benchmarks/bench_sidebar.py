@@ -0,0 +1,101 @@
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from seed import seed_database
+
+from repository import ChatService
+
+SUMMARY_VERSION = 9
+
+# What the sidebar ran on every refresh before the conversations summary:
+# unread counts recomputed from messages and read receipts.
+UNREAD_FROM_MESSAGES = """
+    SELECT 'user', m.sender_id, COUNT(*)
+    FROM messages m
+    LEFT JOIN read_receipts r
+        ON r.user_id = m.receiver_id AND r.peer_id = m.sender_id AND r.group_id = 0
+    WHERE m.receiver_id = ? AND m.id > COALESCE(r.last_read_id, 0)
+    GROUP BY m.sender_id
+
+    UNION ALL
+
+    SELECT 'group', m.group_id, COUNT(*)
+    FROM group_members gm
+    JOIN messages m ON m.group_id = gm.group_id
+    LEFT JOIN read_receipts r
+        ON r.user_id = gm.user_id AND r.peer_id = 0 AND r.group_id = gm.group_id
+    WHERE gm.user_id = ? AND m.sender_id != ? AND m.id > COALESCE(r.last_read_id, 0)
+    GROUP BY m.group_id
+"""
+
+
+def timed(function, args):
+    rng = random.Random(1)
+    samples = []
+    for _ in range(args.repeat):
+        user_id = rng.randint(1, args.users)
+        started = time.perf_counter()
+        function(user_id, rng)
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def send_direct(service, args):
+    return lambda user_id, rng: service.save_message(user_id, rng.randint(1, args.users), False, "bench")
+
+
+def send_group(service, args):
+    return lambda user_id, rng: service.save_message(user_id, rng.randint(1, args.groups), True, "bench")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sidebar refresh and send cost before and after the "
+                                                 "conversations summary table.")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--groups", type=int, default=100)
+    parser.add_argument("--members-per-group", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--path", help="database file to seed (default: a temporary directory)")
+    args = parser.parse_args()
+
+    path = args.path or os.path.join(tempfile.mkdtemp(), "sidebar.db")
+    print(f"Seeding {args.messages} messages into {path} ...", file=sys.stderr)
+    seed_database(path, users=args.users, groups=args.groups, messages=args.messages, posts=0,
+                  members_per_group=args.members_per_group, schema_version=SUMMARY_VERSION - 1).close()
+
+    service = ChatService(path, schema_version=SUMMARY_VERSION - 1)
+    conn = service.db.conn
+    before = {
+        'sidebar refresh': timed(lambda user_id, rng: conn.execute(
+            UNREAD_FROM_MESSAGES, (user_id, user_id, user_id)).fetchall(), args),
+        'send direct': timed(send_direct(service, args), args),
+        'send to group': timed(send_group(service, args), args),
+    }
+    service.close()
+
+    service = ChatService(path)
+    started = time.perf_counter()
+    conn = service.db.conn  # the first connection runs the migration
+    migrated = time.perf_counter() - started
+    rows = conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+    print(f"built {rows} conversation rows in {migrated:.1f} s", file=sys.stderr)
+    after = {
+        'sidebar refresh': timed(lambda user_id, rng: service.get_conversations(user_id), args),
+        'send direct': timed(send_direct(service, args), args),
+        'send to group': timed(send_group(service, args), args),
+    }
+    service.close()
+
+    print(f"{'':16} {'before':>10} {'after':>10}")
+    for name in before:
+        print(f"{name:16} {before[name]:7.3f} ms {after[name]:7.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
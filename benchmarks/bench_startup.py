@@ -0,0 +1,104 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from seed import seed_database
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# One app launch, run with -c in a fresh interpreter so that nothing is
+# imported ahead of main: build the window, wait for the login screen's
+# first paint, then sit at the login screen for the idle time.
+CHILD = """
+import json, os, sys, time
+started = float(os.environ['STARTUP_BENCH_STARTED'])
+import main as chat_app
+imported = time.time()
+
+import instrumentation
+from PyQt5.QtCore import QEvent, QObject, QTimer
+from PyQt5.QtWidgets import QApplication
+
+class PaintWatcher(QObject):
+    painted = None
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Paint and self.painted is None:
+            self.painted = time.time()
+            QTimer.singleShot(int(float(sys.argv[1]) * 1000), app.quit)
+        return False
+
+app = QApplication(sys.argv[:1])
+window = chat_app.MainWindow()
+watcher = PaintWatcher()
+window.login_screen.installEventFilter(watcher)
+window.show()
+app.exec()
+queries = sum(histogram.count for kind, _, histogram in instrumentation.snapshot() if kind == 'db')
+window.close()
+print(json.dumps({'import_ms': (imported - started) * 1000, 'paint_ms': (watcher.painted - started) * 1000,
+                  'queries': queries}))
+"""
+
+
+def launch(workdir, idle, importtime=False):
+    env = dict(os.environ, STARTUP_BENCH_STARTED=repr(time.time()), CHAT_PROFILE='1', PYTHONPATH=REPO_DIR)
+    env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', CHILD, str(idle)]
+    result = subprocess.run(command, cwd=workdir, env=env, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.splitlines()[-1]), result.stderr
+
+
+def slowest_imports(stderr, count):
+    # -X importtime lines read "import time: self | cumulative | name", with
+    # the name indented two more spaces per level; these are the modules
+    # main imports itself.
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            if name.strip() == 'main':
+                break
+            imports = []
+        elif depth == 1:
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time from launch to the login screen's first paint.")
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--idle', type=float, default=3.0,
+                        help="seconds to stay at the login screen, counting database calls")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--top', type=int, default=10, help="slowest top-level imports to list")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    seed_database(os.path.join(workdir, 'chat_app.db'), users=args.users, messages=args.messages).close()
+
+    runs = [launch(workdir, args.idle)[0] for _ in range(args.runs)]
+    for key, label in (('import_ms', 'main imported'), ('paint_ms', 'first paint')):
+        values = sorted(run[key] for run in runs)
+        print(f"{label:13} median {statistics.median(values):7.1f} ms  min {values[0]:7.1f} ms  "
+              f"max {values[-1]:7.1f} ms")
+    print(f"database calls in {args.idle:.0f} s at the login screen: {max(run['queries'] for run in runs)}")
+
+    _, stderr = launch(workdir, 0, importtime=True)
+    print("slowest imports (cumulative):")
+    for microseconds, name in slowest_imports(stderr, args.top):
+        print(f"  {microseconds / 1000:7.1f} ms  {name}")
+
+
+if __name__ == '__main__':
+    main()
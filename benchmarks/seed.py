@@ -0,0 +1,57 @@
+import itertools
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database
+
+
+def seed_database(path, users=1000, groups=100, messages=100000, posts=1000,
+                  members_per_group=20, group_share=0.3, schema_version=None, seed=0, vocabulary=0,
+                  message_spacing=1):
+    if os.path.exists(path):
+        os.remove(path)
+
+    rng = random.Random(seed)
+    db = Database(path, schema_version=schema_version)
+    start = datetime(2020, 1, 1)
+
+    db.conn.executemany("INSERT INTO users (id, username, password, telephone) VALUES (?, ?, ?, ?)",
+                        ((i, f"user{i}", b"x", f"555-{i:06d}") for i in range(1, users + 1)))
+    db.conn.executemany("INSERT INTO groups (id, name, created_by) VALUES (?, ?, ?)",
+                        ((i, f"group{i}", rng.randint(1, users)) for i in range(1, groups + 1)))
+    db.conn.executemany("INSERT INTO group_members (group_id, user_id) VALUES (?, ?)",
+                        ((g, u) for g in range(1, groups + 1)
+                         for u in rng.sample(range(1, users + 1), min(members_per_group, users))))
+
+    # With a vocabulary, message text is 4-12 words drawn with Zipf-like
+    # frequencies (word1 is the most common), which is what search needs.
+    words = [f"word{rank}" for rank in range(1, vocabulary + 1)]
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, vocabulary + 1)))
+
+    def content(i):
+        if not vocabulary:
+            return f"message {i}"
+        return " ".join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(4, 12)))
+
+    def message_rows():
+        for i in range(1, messages + 1):
+            sender = rng.randint(1, users)
+            timestamp = start + timedelta(seconds=i * message_spacing)
+            if groups and rng.random() < group_share:
+                yield (i, sender, None, rng.randint(1, groups), content(i), timestamp)
+            else:
+                yield (i, sender, rng.randint(1, users), None, content(i), timestamp)
+
+    db.conn.executemany("""
+        INSERT INTO messages (id, sender_id, receiver_id, group_id, content, timestamp)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, message_rows())
+    db.conn.executemany("INSERT INTO status_posts (user_id, content, timestamp) VALUES (?, ?, ?)",
+                        ((rng.randint(1, users), f"post {i}", start + timedelta(minutes=i))
+                         for i in range(posts)))
+    db.conn.commit()
+    return db
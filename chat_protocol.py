@@ -0,0 +1,122 @@
+import base64
+import json
+import struct
+
+from records import RECORD_TYPES, fields
+
+# Every frame is a 4-byte big-endian length followed by that many bytes of
+# compact JSON. Requests are {"id", "method", "args"}, replies carry the same
+# id and either "result" or "error", and server pushes carry "push" instead.
+HEADER = struct.Struct('>I')
+MAX_FRAME = 16 * 1024 * 1024
+DEFAULT_PORT = 8765
+# Where each ChatService method takes the caller's own user id. Clients do not
+# send it; the server puts in the id the connection logged in as, so nobody
+# can read or write as someone else.
+SESSION_ARGUMENTS = {
+    'get_messages_page': 0, 'mark_read': 0, 'get_unread_counts': 0, 'get_conversations': 0, 'get_users': 0,
+    'get_user_groups': 0, 'create_group': 1, 'save_message': 0, 'create_post': 0, 'set_profile_pic': 0,
+    'search_messages': 0,
+}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class RemoteError(Exception):
+    pass
+
+
+def encode_value(value):
+    # JSON has no bytes (password hashes), tuple-keyed dicts (unread counts) or
+    # records, so those are wrapped in small tagged objects.
+    if isinstance(value, bytes):
+        return {'$b': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, dict):
+        return {'$d': [[encode_value(k), encode_value(v)] for k, v in value.items()]}
+    if isinstance(value, (list, tuple)):
+        return [encode_value(item) for item in value]
+    if type(value).__name__ in RECORD_TYPES:
+        return {'$r': type(value).__name__, 'v': encode_value(fields(value))}
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, dict):
+        if '$b' in value:
+            return base64.b64decode(value['$b'])
+        if '$d' in value:
+            return {decode_key(k): decode_value(v) for k, v in value['$d']}
+        if '$r' in value:
+            return RECORD_TYPES[value['$r']](*decode_value(value['v']))
+        return {k: decode_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [decode_value(item) for item in value]
+    return value
+
+
+def decode_key(key):
+    key = decode_value(key)
+    return tuple(key) if isinstance(key, list) else key
+
+
+def encode_frame(message):
+    payload = json.dumps(encode_value(message), separators=(',', ':'), default=str).encode('utf-8')
+    if len(payload) > MAX_FRAME:
+        raise ProtocolError(f"frame of {len(payload)} bytes is too large")
+    return HEADER.pack(len(payload)) + payload
+
+
+def split_frames(buffer):
+    # Splits complete frame payloads off the front of a bytearray, leaving any
+    # partial frame in place for the next read.
+    payloads = []
+    while len(buffer) >= HEADER.size:
+        (length,) = HEADER.unpack_from(buffer)
+        if length > MAX_FRAME:
+            raise ProtocolError(f"frame of {length} bytes is too large")
+        if len(buffer) < HEADER.size + length:
+            break
+        payloads.append(bytes(buffer[HEADER.size:HEADER.size + length]))
+        del buffer[:HEADER.size + length]
+    return payloads
+
+
+def decode_payload(payload):
+    # Bad JSON or an unknown tag only spoils its own frame; the length prefix
+    # still says where the next one starts.
+    try:
+        return decode_value(json.loads(payload))
+    except (ValueError, KeyError, TypeError, RecursionError) as e:
+        raise ProtocolError(f"bad frame: {e!r}") from e
+
+
+def decode_frames(buffer):
+    return [decode_payload(payload) for payload in split_frames(buffer)]
+
+
+def client_arguments(method, args):
+    # The arguments of a ChatService call as a client sends them.
+    position = SESSION_ARGUMENTS.get(method)
+    if position is None:
+        return list(args)
+    return [*args[:position], *args[position + 1:]]
+
+
+def session_arguments(method, args, user_id):
+    # The reverse, on the server: the logged-in user id put back in place.
+    position = SESSION_ARGUMENTS.get(method)
+    if position is None:
+        return args
+    return [*args[:position], user_id, *args[position:]]
+
+
+def parse_address(address):
+    # "unix:/path/to/socket", "host:port" or just "host".
+    if address.startswith('unix:'):
+        return 'unix', address[len('unix:'):], None
+    host, _, port = address.rpartition(':')
+    if not host:
+        return 'tcp', port or '127.0.0.1', DEFAULT_PORT
+    return 'tcp', host, int(port)
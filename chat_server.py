@@ -0,0 +1,403 @@
+import argparse
+import asyncio
+import itertools
+import os
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from archive import ARCHIVE_INTERVAL
+from auth import check_password, hash_password
+from chat_protocol import (DEFAULT_PORT, MAX_FRAME, ProtocolError, RemoteError, client_arguments, decode_frames,
+                           decode_payload, encode_frame, parse_address, session_arguments, split_frames)
+from database import DATABASE_PATH
+import instrumentation
+from group_commit import GROUP_COMMIT_MAX
+from repository import ChatService, check_message
+
+# The ChatService methods a logged-in client may call; anything else is
+# refused, so clients cannot reach password hashes or set_password(), the
+# whole change feed (they are pushed the part they may see), the archiving
+# steps or the connection itself. Before login only login and register are
+# answered.
+CLIENT_METHODS = frozenset([
+    'get_messages_page', 'mark_read', 'get_unread_counts', 'get_conversations', 'get_users', 'get_user_profile',
+    'set_profile_pic', 'get_group_name', 'get_user_groups', 'create_group', 'save_message', 'get_posts_page',
+    'create_post', 'search_messages', 'search_posts',
+])
+# Calls that take (user_id, chat_id, is_group, ...); a group chat is only
+# open to its members.
+CONVERSATION_METHODS = frozenset(['get_messages_page', 'mark_read', 'save_message'])
+# Calls that only read; they run on a pool of reader threads, each with its
+# own connection, while everything else stays on the single writer thread.
+READ_METHODS = frozenset([
+    'get_messages_page', 'get_unread_counts', 'get_conversations', 'get_user_credentials', 'get_users',
+    'get_user_profile', 'get_group_name', 'get_user_groups', 'get_posts_page', 'search_messages',
+    'search_posts', 'latest_change_id', 'get_changes', 'is_member', 'member_groups',
+])
+# More reader threads than cores only adds switching: SQLite releases the GIL
+# while it works, so each reader wants a core of its own.
+READ_WORKERS = min(4, os.cpu_count() or 1)
+# bcrypt releases the GIL too; password checks get threads of their own so a
+# burst of logins never queues behind, or in front of, database calls.
+PASSWORD_WORKERS = os.cpu_count() or 1
+# How often the change feed is read when no client write has woken the pusher;
+# this picks up rows written by other processes.
+CHANGE_PUSH_INTERVAL = 0.2
+CHANGE_PRUNE_EVERY = 3000
+ARCHIVE_START_DELAY = 60
+
+
+def check_request(request):
+    # Returns (method, args) for a well-formed request.
+    if not isinstance(request, dict):
+        raise ProtocolError("request is not an object")
+    method, args = request.get('method'), request.get('args', [])
+    if not isinstance(method, str):
+        raise ProtocolError("request has no method")
+    if not isinstance(args, list):
+        raise ProtocolError("request args is not a list")
+    return method, args
+
+
+def message_row(sender_id, chat_id, is_group, content, media_path=None, media_type=None):
+    # A save_message request as the row save_messages takes.
+    check_message(content, media_path)
+    return sender_id, chat_id, is_group, content, media_path, media_type
+
+
+def visible_changes(changes, user_id, group_ids):
+    # The change feed rows one user may see: messages they sent or received
+    # or that went to their groups, memberships and renames of their groups,
+    # and the public rows (new users, profiles and posts).
+    visible = []
+    for change in changes:
+        _, kind, _, change_user_id, peer_id, group_id = change
+        if kind == 'message':
+            allowed = group_id in group_ids if group_id else user_id in (change_user_id, peer_id)
+        elif kind in ('group_member', 'group'):
+            allowed = group_id in group_ids
+        else:
+            allowed = True
+        if allowed:
+            visible.append(change)
+    return visible
+
+
+def settle(future, result=None, error=None):
+    # The client may have gone while its message was being written.
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class ChatServer:
+    def __init__(self, path=DATABASE_PATH):
+        self.path = path
+        self.db = instrumentation.instrument(ChatService(path), 'db')
+        # Writes go through one thread in arrival order, as they do in the
+        # GUI's DatabaseWorker; with WAL, reads run beside them. A client's
+        # next request is only read once its last one has been answered, so
+        # each client still sees its own writes.
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.readers = ThreadPoolExecutor(max_workers=READ_WORKERS)
+        self.passwords = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS)
+        # Each connection and the user it logged in as, None until it has.
+        self.clients = {}
+        self.server = None
+        self.tasks = []
+        self.last_change_id = None
+
+    def call(self, method, args):
+        return getattr(self.db, method)(*args)
+
+    async def run_db(self, method, *args):
+        executor = self.readers if method in READ_METHODS else self.executor
+        return await asyncio.get_running_loop().run_in_executor(executor, self.call, method, args)
+
+    async def start(self, address=f"127.0.0.1:{DEFAULT_PORT}"):
+        self.last_change_id = await self.run_db('latest_change_id')
+        self.changes_waiting = asyncio.Event()
+        self.outgoing = asyncio.Queue()
+
+        kind, host, port = parse_address(address)
+        if kind == 'unix':
+            self.server = await asyncio.start_unix_server(self.handle_client, host)
+        else:
+            self.server = await asyncio.start_server(self.handle_client, host, port)
+        self.tasks = [asyncio.create_task(self.push_changes()), asyncio.create_task(self.write_messages()),
+                      asyncio.create_task(self.maintain())]
+        return self.server
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+        for writer in list(self.clients):
+            writer.close()
+        self.executor.shutdown()
+        self.readers.shutdown()
+        self.passwords.shutdown()
+        self.db.close_all()
+
+    async def run_password(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.passwords, function, *args)
+
+    async def handle_client(self, reader, writer):
+        self.clients[writer] = None
+        buffer = bytearray()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                buffer.extend(data)
+                # A frame over MAX_FRAME leaves no way to find the next one and
+                # ends the connection; anything else wrong with a frame is
+                # answered with an error.
+                for payload in split_frames(buffer):
+                    try:
+                        request = decode_payload(payload)
+                    except ProtocolError as e:
+                        self.send(writer, {'id': None, 'error': str(e)})
+                        continue
+                    await self.handle_request(writer, request)
+        except (ConnectionError, ProtocolError):
+            pass
+        finally:
+            self.clients.pop(writer, None)
+            writer.close()
+
+    async def handle_request(self, writer, request):
+        try:
+            method, args = check_request(request)
+        except ProtocolError as e:
+            request_id = request.get('id') if isinstance(request, dict) else None
+            self.send(writer, {'id': request_id, 'error': str(e)})
+            return
+
+        reply = {'id': request.get('id')}
+        try:
+            reply['result'] = await self.dispatch(writer, method, args)
+        except Exception as e:
+            reply['error'] = str(e)
+        self.send(writer, reply)
+
+    async def dispatch(self, writer, method, args):
+        if method in ('login', 'register'):
+            return await getattr(self, method)(writer, *args)
+        if method not in CLIENT_METHODS:
+            raise ValueError(f"unknown method: {method}")
+        user_id = self.clients.get(writer)
+        if user_id is None:
+            raise PermissionError("not logged in")
+
+        args = session_arguments(method, args, user_id)
+        if method in CONVERSATION_METHODS and len(args) > 2 and args[2]:
+            if not await self.run_db('is_member', user_id, args[1]):
+                raise PermissionError("not a member of this group")
+        if method == 'save_message':
+            return await self.queue_message(args)
+        result = await self.run_db(method, *args)
+        if method in ('create_group', 'create_post', 'set_profile_pic'):
+            self.changes_waiting.set()
+        return result
+
+    async def login(self, writer, username, password):
+        # Binds the connection to the user and returns their id; None means
+        # there is no such user, and the client may offer to register.
+        user = await self.run_db('get_user_credentials', username)
+        if not user:
+            return None
+        user_id, stored_hash = user
+        matches, new_hash = await self.run_password(check_password, password, stored_hash)
+        if not matches:
+            raise PermissionError("Incorrect password")
+        if new_hash:
+            # The stored hash used another work factor; keep the upgraded one.
+            await self.run_db('set_password', user_id, new_hash)
+        self.clients[writer] = user_id
+        return user_id
+
+    async def register(self, writer, username, password, telephone):
+        if not password:
+            raise ValueError("password is empty")
+        password_hash = await self.run_password(hash_password, password)
+        user_id = await self.run_db('create_user', username, password_hash, telephone)
+        self.changes_waiting.set()
+        self.clients[writer] = user_id
+        return user_id
+
+    def send(self, writer, message):
+        if writer.is_closing():
+            return
+        # A client that stops reading is dropped rather than buffered without bound.
+        if writer.transport.get_write_buffer_size() > MAX_FRAME:
+            writer.close()
+            return
+        writer.write(encode_frame(message))
+
+    async def queue_message(self, args):
+        # Checked and given its defaults here, so that a bad request fails on
+        # its own instead of taking the rest of its batch with it.
+        row = message_row(*args)
+        future = asyncio.get_running_loop().create_future()
+        await self.outgoing.put((row, future))
+        return await future
+
+    async def write_messages(self):
+        # Messages from different clients that arrive while a commit is running
+        # go into the next transaction together.
+        while True:
+            batch = [await self.outgoing.get()]
+            while not self.outgoing.empty() and len(batch) < GROUP_COMMIT_MAX:
+                batch.append(self.outgoing.get_nowait())
+            try:
+                message_ids = await self.run_db('save_messages', [row for row, _ in batch])
+            except Exception as e:
+                if len(batch) == 1:
+                    settle(batch[0][1], error=e)
+                else:
+                    # The batch was rolled back; one at a time, only the
+                    # message that caused it fails again.
+                    for row, future in batch:
+                        try:
+                            settle(future, await self.run_db('save_message', *row))
+                        except Exception as error:
+                            settle(future, error=error)
+            else:
+                for (_, future), message_id in zip(batch, message_ids):
+                    settle(future, message_id)
+            self.changes_waiting.set()
+
+    async def push_changes(self):
+        for tick in itertools.count(1):
+            try:
+                await asyncio.wait_for(self.changes_waiting.wait(), CHANGE_PUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.changes_waiting.clear()
+
+            changes = await self.run_db('get_changes', self.last_change_id)
+            if changes:
+                self.last_change_id = changes[-1][0]
+                # Memberships are read after the changes, so someone added
+                # to a group in this batch already sees its messages.
+                clients = [(writer, user_id) for writer, user_id in self.clients.items() if user_id is not None]
+                member_groups = await self.run_db('member_groups', {user_id for _, user_id in clients})
+                for writer, user_id in clients:
+                    visible = visible_changes(changes, user_id, member_groups[user_id])
+                    if visible:
+                        self.send(writer, {'push': 'changes', 'changes': visible})
+                if len(changes) == 1000:
+                    self.changes_waiting.set()
+            if tick % CHANGE_PRUNE_EVERY == 0:
+                await self.run_db('prune_changes')
+
+    async def maintain(self):
+        # Each step is queued on the database thread behind whatever clients
+        # have already asked for, so a long archive run never stalls them.
+        await asyncio.sleep(ARCHIVE_START_DELAY)
+        while True:
+            try:
+                while await self.run_db('archive_step'):
+                    pass
+                await self.run_db('collect_media')
+                while await self.run_db('compact'):
+                    pass
+            except Exception as e:
+                print(f"Error archiving: {e}", file=sys.stderr)
+            await asyncio.sleep(ARCHIVE_INTERVAL)
+
+
+class ChatClient:
+    # asyncio client for scripts and benchmarks; the GUI uses RemoteDatabase.
+    def __init__(self):
+        self.pending = {}
+        self.request_ids = itertools.count(1)
+        self.pushes = asyncio.Queue()
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+
+    async def connect(self, address=f"127.0.0.1:{DEFAULT_PORT}"):
+        kind, host, port = parse_address(address)
+        if kind == 'unix':
+            self.reader, self.writer = await asyncio.open_unix_connection(host)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.read_task = asyncio.create_task(self.read_replies())
+        return self
+
+    async def call(self, method, *args):
+        # Takes the same arguments as the ChatService method; the caller's own
+        # user id is left out on the wire, as the server knows it from login().
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.writer.write(encode_frame({'id': request_id, 'method': method,
+                                        'args': client_arguments(method, args)}))
+        return await future
+
+    async def read_replies(self):
+        buffer = bytearray()
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                buffer.extend(data)
+                for message in decode_frames(buffer):
+                    if 'push' in message:
+                        self.pushes.put_nowait(message['changes'])
+                        continue
+                    # A reply to no request of ours is an error about a frame
+                    # the server could not read.
+                    future = self.pending.pop(message.get('id'), None)
+                    if future is None:
+                        continue
+                    if 'error' in message:
+                        future.set_exception(RemoteError(message['error']))
+                    else:
+                        future.set_result(message.get('result'))
+        except ConnectionError:
+            pass
+        finally:
+            for future in self.pending.values():
+                future.set_exception(ConnectionError("connection to chat server closed"))
+            self.pending.clear()
+
+    async def close(self):
+        self.writer.close()
+        await self.read_task
+
+
+async def serve(path, address):
+    server = ChatServer(path)
+    await server.start(address)
+    print(f"Chat server on {address} using {path}", file=sys.stderr)
+    async with server.server:
+        await server.server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve chat_app.db to chat clients over a socket.")
+    parser.add_argument("--db", default=DATABASE_PATH)
+    parser.add_argument("--listen", default=f"127.0.0.1:{DEFAULT_PORT}",
+                        help="host:port, or unix:/path/to/socket")
+    args = parser.parse_args()
+    instrumentation.dump_at_exit()
+    # SIGTERM shuts down the same way as Ctrl+C, so exit handlers still run.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncio.run(serve(args.db, args.listen))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
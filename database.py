@@ -0,0 +1,486 @@
+import sqlite3
+import threading
+
+DATABASE_PATH = 'chat_app.db'
+BUSY_TIMEOUT = 5.0
+# Prepared statements kept per connection, least recently used dropped
+# first. A pass over every service method runs about 130 distinct
+# statements, half of them against attached archive months, so the sqlite3
+# default of 128 would already be evicting.
+STATEMENT_CACHE_SIZE = 256
+
+# Applied to every connection. WAL lets readers in other app instances keep
+# going while one of them writes; synchronous=NORMAL is durable in WAL mode
+# except for the last transactions before a power loss. auto_vacuum only
+# takes effect on a new file; running archive.py by hand converts older ones.
+CONNECTION_PRAGMAS = {
+    'auto_vacuum': 'INCREMENTAL',
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': int(BUSY_TIMEOUT * 1000),
+    'cache_size': -16000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+# Each entry upgrades the schema by one version; PRAGMA user_version records
+# how many have been applied to a given database file.
+MIGRATIONS = [
+    '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            password BLOB NOT NULL,
+            telephone TEXT,
+            profile_pic TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            sender_id INTEGER,
+            receiver_id INTEGER,
+            group_id INTEGER,
+            content TEXT,
+            media_path TEXT,
+            media_type TEXT,
+            timestamp DATETIME,
+            FOREIGN KEY (sender_id) REFERENCES users (id),
+            FOREIGN KEY (receiver_id) REFERENCES users (id),
+            FOREIGN KEY (group_id) REFERENCES groups (id)
+        );
+
+        CREATE TABLE IF NOT EXISTS groups (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            created_by INTEGER,
+            FOREIGN KEY (created_by) REFERENCES users (id)
+        );
+
+        CREATE TABLE IF NOT EXISTS group_members (
+            group_id INTEGER,
+            user_id INTEGER,
+            FOREIGN KEY (group_id) REFERENCES groups (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        );
+
+        CREATE TABLE IF NOT EXISTS status_posts (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            content TEXT,
+            media_path TEXT,
+            media_type TEXT,
+            timestamp DATETIME,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        );
+    ''',
+
+    '''
+        CREATE INDEX IF NOT EXISTS idx_messages_direct ON messages (sender_id, receiver_id, id);
+        CREATE INDEX IF NOT EXISTS idx_messages_group ON messages (group_id, id);
+        CREATE INDEX IF NOT EXISTS idx_group_members_user ON group_members (user_id, group_id);
+        CREATE INDEX IF NOT EXISTS idx_status_posts_timestamp ON status_posts (timestamp);
+        ANALYZE;
+    ''',
+
+    '''
+        CREATE TABLE IF NOT EXISTS changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            row_id INTEGER,
+            user_id INTEGER,
+            peer_id INTEGER,
+            group_id INTEGER
+        );
+
+        CREATE TRIGGER IF NOT EXISTS trg_messages_change AFTER INSERT ON messages BEGIN
+            INSERT INTO changes (kind, row_id, user_id, peer_id, group_id)
+            VALUES ('message', NEW.id, NEW.sender_id, NEW.receiver_id, NEW.group_id);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_users_change AFTER INSERT ON users BEGIN
+            INSERT INTO changes (kind, row_id, user_id) VALUES ('user', NEW.id, NEW.id);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_group_members_change AFTER INSERT ON group_members BEGIN
+            INSERT INTO changes (kind, row_id, user_id, group_id)
+            VALUES ('group_member', NEW.group_id, NEW.user_id, NEW.group_id);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_status_posts_change AFTER INSERT ON status_posts BEGIN
+            INSERT INTO changes (kind, row_id, user_id) VALUES ('post', NEW.id, NEW.user_id);
+        END;
+    ''',
+
+    '''
+        CREATE TABLE IF NOT EXISTS read_receipts (
+            user_id INTEGER NOT NULL,
+            peer_id INTEGER NOT NULL DEFAULT 0,
+            group_id INTEGER NOT NULL DEFAULT 0,
+            last_read_id INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, peer_id, group_id)
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_messages_inbox ON messages (receiver_id, sender_id, id);
+
+        -- Existing conversations count as read up to the user's last reply,
+        -- which is what the sidebar counters showed before receipts existed.
+        INSERT OR IGNORE INTO read_receipts (user_id, peer_id, group_id, last_read_id)
+        SELECT sender_id, receiver_id, 0, MAX(id) FROM messages
+        WHERE receiver_id IS NOT NULL
+        GROUP BY sender_id, receiver_id;
+
+        INSERT OR IGNORE INTO read_receipts (user_id, peer_id, group_id, last_read_id)
+        SELECT sender_id, 0, group_id, MAX(id) FROM messages
+        WHERE group_id IS NOT NULL
+        GROUP BY sender_id, group_id;
+    ''',
+    '''
+        -- One row per stored media file, counting the messages, posts and
+        -- profiles that point at it.
+        CREATE TABLE IF NOT EXISTS media_blobs (
+            path TEXT PRIMARY KEY,
+            refcount INTEGER NOT NULL DEFAULT 0
+        );
+
+        CREATE TRIGGER IF NOT EXISTS media_ref_message_insert AFTER INSERT ON messages
+        WHEN NEW.media_path IS NOT NULL BEGIN
+            INSERT OR IGNORE INTO media_blobs (path) VALUES (NEW.media_path);
+            UPDATE media_blobs SET refcount = refcount + 1 WHERE path = NEW.media_path;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS media_ref_message_delete AFTER DELETE ON messages
+        WHEN OLD.media_path IS NOT NULL BEGIN
+            UPDATE media_blobs SET refcount = refcount - 1 WHERE path = OLD.media_path;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS media_ref_post_insert AFTER INSERT ON status_posts
+        WHEN NEW.media_path IS NOT NULL BEGIN
+            INSERT OR IGNORE INTO media_blobs (path) VALUES (NEW.media_path);
+            UPDATE media_blobs SET refcount = refcount + 1 WHERE path = NEW.media_path;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS media_ref_post_delete AFTER DELETE ON status_posts
+        WHEN OLD.media_path IS NOT NULL BEGIN
+            UPDATE media_blobs SET refcount = refcount - 1 WHERE path = OLD.media_path;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS media_ref_profile_update AFTER UPDATE OF profile_pic ON users
+        WHEN NEW.profile_pic IS NOT OLD.profile_pic BEGIN
+            UPDATE media_blobs SET refcount = refcount - 1 WHERE path = OLD.profile_pic;
+            INSERT OR IGNORE INTO media_blobs (path) SELECT NEW.profile_pic WHERE NEW.profile_pic IS NOT NULL;
+            UPDATE media_blobs SET refcount = refcount + 1 WHERE path = NEW.profile_pic;
+        END;
+
+        INSERT INTO media_blobs (path, refcount)
+        SELECT media_path, COUNT(*) FROM (
+            SELECT media_path FROM messages WHERE media_path IS NOT NULL
+            UNION ALL
+            SELECT media_path FROM status_posts WHERE media_path IS NOT NULL
+            UNION ALL
+            SELECT profile_pic FROM users WHERE profile_pic IS NOT NULL
+        )
+        GROUP BY media_path;
+    ''',
+    '''
+        -- search_scope names who can see a message ("g<group>" or "u<sender> u<receiver>").
+        -- It is indexed next to the text so a search intersects the user's
+        -- conversations inside FTS5 instead of filtering the matches afterwards.
+        ALTER TABLE messages ADD COLUMN search_scope TEXT GENERATED ALWAYS AS (
+            CASE WHEN group_id IS NOT NULL THEN 'g' || group_id
+                 ELSE 'u' || sender_id || ' u' || receiver_id END
+        ) VIRTUAL;
+
+        -- External-content indexes: the text lives in messages/status_posts
+        -- and the triggers keep the token index in step with it.
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content, search_scope, content='messages', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        );
+
+        CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+            content, content='status_posts', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        );
+
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, content, search_scope) VALUES (NEW.id, NEW.content, NEW.search_scope);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content, search_scope)
+            VALUES ('delete', OLD.id, OLD.content, OLD.search_scope);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content, search_scope)
+            VALUES ('delete', OLD.id, OLD.content, OLD.search_scope);
+            INSERT INTO messages_fts (rowid, content, search_scope) VALUES (NEW.id, NEW.content, NEW.search_scope);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON status_posts BEGIN
+            INSERT INTO posts_fts (rowid, content) VALUES (NEW.id, NEW.content);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON status_posts BEGIN
+            INSERT INTO posts_fts (posts_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE OF content ON status_posts BEGIN
+            INSERT INTO posts_fts (posts_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+            INSERT INTO posts_fts (rowid, content) VALUES (NEW.id, NEW.content);
+        END;
+
+        INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');
+        INSERT INTO posts_fts (posts_fts) VALUES ('rebuild');
+    ''',
+    '''
+        -- Edits to users and groups go into the change feed too, so the
+        -- in-memory directory of names and pictures can follow them.
+        CREATE TRIGGER IF NOT EXISTS trg_users_update_change
+        AFTER UPDATE OF username, telephone, profile_pic ON users BEGIN
+            INSERT INTO changes (kind, row_id, user_id) VALUES ('profile', NEW.id, NEW.id);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_groups_update_change AFTER UPDATE OF name ON groups BEGIN
+            INSERT INTO changes (kind, row_id, group_id) VALUES ('group', NEW.id, NEW.id);
+        END;
+    ''',
+    '''
+        -- Months whose old messages and posts were moved to archive files.
+        CREATE TABLE IF NOT EXISTS archives (
+            month TEXT PRIMARY KEY,
+            first_post_id INTEGER,
+            last_post_id INTEGER
+        );
+
+        -- The id range each conversation has in each archived month, so that
+        -- scrolling back only opens the files that hold some of it.
+        CREATE TABLE IF NOT EXISTS archived_conversations (
+            conversation TEXT NOT NULL,
+            month TEXT NOT NULL,
+            first_id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            PRIMARY KEY (conversation, month)
+        ) WITHOUT ROWID;
+    ''',
+    '''
+        -- The sidebar's view of each conversation, one row per member: the
+        -- latest message, a preview of it and how many messages the member
+        -- has not read. The triggers keep it in step with every insert, in
+        -- the same transaction, so the sidebar never reads messages itself.
+        -- The preview is the first 100 characters, or "[image]" and the like
+        -- for a message that is only media.
+        CREATE TABLE IF NOT EXISTS conversations (
+            user_id INTEGER NOT NULL,
+            peer_id INTEGER NOT NULL DEFAULT 0,
+            group_id INTEGER NOT NULL DEFAULT 0,
+            last_message_id INTEGER NOT NULL,
+            last_sender_id INTEGER,
+            preview TEXT,
+            last_timestamp DATETIME,
+            unread INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, peer_id, group_id)
+        ) WITHOUT ROWID;
+
+        CREATE INDEX IF NOT EXISTS idx_conversations_recent ON conversations (user_id, last_message_id);
+        CREATE INDEX IF NOT EXISTS idx_group_members_group ON group_members (group_id, user_id);
+
+        CREATE TRIGGER IF NOT EXISTS conversations_direct_message AFTER INSERT ON messages
+        WHEN NEW.receiver_id IS NOT NULL BEGIN
+            INSERT INTO conversations (user_id, peer_id, group_id, last_message_id, last_sender_id, preview,
+                                       last_timestamp, unread)
+            VALUES (NEW.sender_id, NEW.receiver_id, 0, NEW.id, NEW.sender_id,
+                    CASE WHEN NEW.content != '' THEN substr(NEW.content, 1, 100)
+                         ELSE '[' || COALESCE(NEW.media_type, 'media') || ']' END, NEW.timestamp, 0),
+                   (NEW.receiver_id, NEW.sender_id, 0, NEW.id, NEW.sender_id,
+                    CASE WHEN NEW.content != '' THEN substr(NEW.content, 1, 100)
+                         ELSE '[' || COALESCE(NEW.media_type, 'media') || ']' END, NEW.timestamp, 1)
+            ON CONFLICT (user_id, peer_id, group_id) DO UPDATE SET
+                last_message_id = excluded.last_message_id,
+                last_sender_id = excluded.last_sender_id,
+                preview = excluded.preview,
+                last_timestamp = excluded.last_timestamp,
+                unread = unread + excluded.unread;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS conversations_group_message AFTER INSERT ON messages
+        WHEN NEW.group_id IS NOT NULL BEGIN
+            INSERT INTO conversations (user_id, peer_id, group_id, last_message_id, last_sender_id, preview,
+                                       last_timestamp, unread)
+            SELECT DISTINCT user_id, 0, NEW.group_id, NEW.id, NEW.sender_id,
+                   CASE WHEN NEW.content != '' THEN substr(NEW.content, 1, 100)
+                        ELSE '[' || COALESCE(NEW.media_type, 'media') || ']' END, NEW.timestamp,
+                   user_id != NEW.sender_id
+            FROM group_members
+            WHERE group_id = NEW.group_id
+            ON CONFLICT (user_id, peer_id, group_id) DO UPDATE SET
+                last_message_id = excluded.last_message_id,
+                last_sender_id = excluded.last_sender_id,
+                preview = excluded.preview,
+                last_timestamp = excluded.last_timestamp,
+                unread = unread + excluded.unread;
+        END;
+
+        -- Someone added to a group sees its history as unread, as they would
+        -- have before the summary existed.
+        CREATE TRIGGER IF NOT EXISTS conversations_group_member AFTER INSERT ON group_members BEGIN
+            INSERT OR IGNORE INTO conversations (user_id, peer_id, group_id, last_message_id, last_sender_id,
+                                                 preview, last_timestamp, unread)
+            SELECT NEW.user_id, 0, NEW.group_id, m.id, m.sender_id,
+                   CASE WHEN m.content != '' THEN substr(m.content, 1, 100)
+                        ELSE '[' || COALESCE(m.media_type, 'media') || ']' END, m.timestamp,
+                   (SELECT COUNT(*) FROM messages
+                    WHERE group_id = NEW.group_id AND sender_id != NEW.user_id)
+            FROM messages m
+            WHERE m.group_id = NEW.group_id
+            ORDER BY m.id DESC
+            LIMIT 1;
+        END;
+
+        -- A read receipt recounts what is left past it, which is usually
+        -- nothing and always a short range of an index.
+        CREATE TRIGGER IF NOT EXISTS conversations_read_direct AFTER INSERT ON read_receipts
+        WHEN NEW.group_id = 0 BEGIN
+            UPDATE conversations SET unread = (
+                SELECT COUNT(*) FROM messages
+                WHERE receiver_id = NEW.user_id AND sender_id = NEW.peer_id AND id > NEW.last_read_id
+            )
+            WHERE user_id = NEW.user_id AND peer_id = NEW.peer_id AND group_id = 0;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS conversations_reread_direct AFTER UPDATE OF last_read_id ON read_receipts
+        WHEN NEW.group_id = 0 BEGIN
+            UPDATE conversations SET unread = (
+                SELECT COUNT(*) FROM messages
+                WHERE receiver_id = NEW.user_id AND sender_id = NEW.peer_id AND id > NEW.last_read_id
+            )
+            WHERE user_id = NEW.user_id AND peer_id = NEW.peer_id AND group_id = 0;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS conversations_read_group AFTER INSERT ON read_receipts
+        WHEN NEW.group_id != 0 BEGIN
+            UPDATE conversations SET unread = (
+                SELECT COUNT(*) FROM messages
+                WHERE group_id = NEW.group_id AND sender_id != NEW.user_id AND id > NEW.last_read_id
+            )
+            WHERE user_id = NEW.user_id AND peer_id = 0 AND group_id = NEW.group_id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS conversations_reread_group AFTER UPDATE OF last_read_id ON read_receipts
+        WHEN NEW.group_id != 0 BEGIN
+            UPDATE conversations SET unread = (
+                SELECT COUNT(*) FROM messages
+                WHERE group_id = NEW.group_id AND sender_id != NEW.user_id AND id > NEW.last_read_id
+            )
+            WHERE user_id = NEW.user_id AND peer_id = 0 AND group_id = NEW.group_id;
+        END;
+
+        -- Existing messages, counted the way get_unread_counts used to.
+        INSERT INTO conversations (user_id, peer_id, group_id, last_message_id, unread)
+        SELECT user_id, peer_id, 0, MAX(id), SUM(unread) FROM (
+            SELECT sender_id AS user_id, receiver_id AS peer_id, id, 0 AS unread
+            FROM messages
+            WHERE receiver_id IS NOT NULL
+            UNION ALL
+            SELECT m.receiver_id, m.sender_id, m.id, m.id > COALESCE(r.last_read_id, 0)
+            FROM messages m
+            LEFT JOIN read_receipts r
+                ON r.user_id = m.receiver_id AND r.peer_id = m.sender_id AND r.group_id = 0
+            WHERE m.receiver_id IS NOT NULL
+        )
+        GROUP BY user_id, peer_id;
+
+        INSERT INTO conversations (user_id, peer_id, group_id, last_message_id, unread)
+        SELECT gm.user_id, 0, gm.group_id, MAX(m.id),
+               SUM(m.sender_id != gm.user_id AND m.id > COALESCE(r.last_read_id, 0))
+        FROM (SELECT DISTINCT group_id, user_id FROM group_members) gm
+        JOIN messages m ON m.group_id = gm.group_id
+        LEFT JOIN read_receipts r ON r.user_id = gm.user_id AND r.peer_id = 0 AND r.group_id = gm.group_id
+        GROUP BY gm.user_id, gm.group_id;
+
+        UPDATE conversations SET (last_sender_id, preview, last_timestamp) = (
+            SELECT sender_id,
+                   CASE WHEN content != '' THEN substr(content, 1, 100)
+                        ELSE '[' || COALESCE(media_type, 'media') || ']' END,
+                   timestamp
+            FROM messages
+            WHERE id = conversations.last_message_id
+        );
+
+        ANALYZE conversations;
+    ''',
+]
+
+
+class Database:
+    # One connection. Every query runs on a cursor of its own (conn.execute),
+    # so two reads that interleave never share a result set.
+    def __init__(self, path=DATABASE_PATH, schema_version=None, pragmas=None, check_same_thread=True):
+        self.conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE_SIZE,
+                                    check_same_thread=check_same_thread)
+        for name, value in {**CONNECTION_PRAGMAS, **(pragmas or {})}.items():
+            self.conn.execute(f"PRAGMA {name} = {value}")
+        self.migrate(schema_version)
+
+    @property
+    def schema_version(self):
+        return self.conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate(self, target_version=None):
+        if target_version is None:
+            target_version = len(MIGRATIONS)
+
+        for version in range(self.schema_version, target_version):
+            self.conn.executescript(f"""
+                BEGIN IMMEDIATE;
+                {MIGRATIONS[version]}
+                PRAGMA user_version = {version + 1};
+                COMMIT;
+            """)
+
+    def close(self):
+        self.conn.close()
+
+
+class ConnectionPool:
+    # A Database per thread for one file, opened the first time the thread
+    # asks for it. sqlite3 connections must not be used by two threads at
+    # once; with one each, and WAL, readers never wait for one another or
+    # for the writer. Nothing is opened until a thread needs it.
+    def __init__(self, path=DATABASE_PATH, schema_version=None, pragmas=None):
+        self.path = path
+        self.schema_version = schema_version
+        self.pragmas = pragmas
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.databases = []
+        self.migrated = False
+
+    def database(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            # The first connection migrates the schema and the rest wait for
+            # it, so two threads never run the same migration; a target of 0
+            # leaves the schema as it is.
+            with self.lock:
+                target_version = 0 if self.migrated else self.schema_version
+                db = Database(self.path, target_version, self.pragmas, check_same_thread=False)
+                self.migrated = True
+                self.databases.append(db)
+            self.local.db = db
+        return db
+
+    def close(self):
+        # Closes the calling thread's connection.
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            self.local.db = None
+            with self.lock:
+                self.databases.remove(db)
+            db.close()
+
+    def close_all(self):
+        # For shutdown, once no thread is using its connection any more.
+        with self.lock:
+            databases, self.databases = self.databases, []
+        for db in databases:
+            db.close()
@@ -0,0 +1,101 @@
+import os
+import threading
+
+from records import User
+
+
+class Directory:
+    # Users, groups and group memberships kept in memory for every connection
+    # in the process to one database file. They are read in full once, then
+    # kept current from the change feed, which also records writes made by
+    # other processes.
+    directories = {}
+    directories_lock = threading.Lock()
+
+    @classmethod
+    def for_path(cls, path):
+        if path == ':memory:':
+            return cls()
+        key = os.path.abspath(path)
+        with cls.directories_lock:
+            if key not in cls.directories:
+                cls.directories[key] = cls()
+            return cls.directories[key]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_change_id = None
+        self.users = {}
+        self.usernames = {}
+        self.groups = {}
+        self.user_groups = {}
+
+    def refresh(self, conn):
+        # One probe of the change feed's bounds; rows are only read when
+        # something other than a message has happened since the last call.
+        with self.lock:
+            first_id, last_id = conn.execute("""
+                SELECT (SELECT MIN(id) FROM changes), (SELECT MAX(id) FROM changes)
+            """).fetchone()
+            last_id = last_id or 0
+            if self.last_change_id is None or (first_id or 0) > self.last_change_id + 1:
+                # First use, or the changes since the last refresh were pruned.
+                self.load(conn, last_id)
+            elif last_id > self.last_change_id:
+                changes = conn.execute("""
+                    SELECT kind, row_id, user_id, group_id FROM changes
+                    WHERE id > ? AND id <= ? AND kind != 'message'
+                    ORDER BY id
+                """, (self.last_change_id, last_id)).fetchall()
+                self.apply(conn, changes)
+                self.last_change_id = last_id
+
+    def load(self, conn, change_id):
+        # change_id is read before the tables, so a write that lands in
+        # between is applied again on the next refresh; applying is idempotent.
+        users = {row[0]: User(*row) for row in conn.execute(
+            "SELECT id, username, telephone, profile_pic FROM users")}
+        groups = dict(conn.execute("SELECT id, name FROM groups"))
+        user_groups = {}
+        for group_id, user_id in conn.execute("SELECT group_id, user_id FROM group_members"):
+            user_groups.setdefault(user_id, set()).add(group_id)
+        self.users, self.groups, self.user_groups = users, groups, user_groups
+        self.usernames = {user_id: user.username for user_id, user in users.items()}
+        self.last_change_id = change_id
+
+    def apply(self, conn, changes):
+        for kind, row_id, user_id, group_id in changes:
+            if kind in ('user', 'profile'):
+                row = conn.execute("SELECT id, username, telephone, profile_pic FROM users WHERE id = ?",
+                                   (row_id,)).fetchone()
+                if row:
+                    self.users[row[0]] = User(*row)
+                    self.usernames[row[0]] = row[1]
+            elif kind == 'group_member':
+                if group_id not in self.groups:
+                    self.load_group(conn, group_id)
+                self.user_groups.setdefault(user_id, set()).add(group_id)
+            elif kind == 'group':
+                self.load_group(conn, row_id)
+
+    def load_group(self, conn, group_id):
+        row = conn.execute("SELECT name FROM groups WHERE id = ?", (group_id,)).fetchone()
+        if row:
+            self.groups[group_id] = row[0]
+
+    def user(self, conn, user_id):
+        # A user created since the last refresh is looked for once more.
+        user = self.users.get(user_id)
+        if user is None:
+            self.refresh(conn)
+            user = self.users.get(user_id)
+        return user
+
+    def username(self, conn, user_id):
+        user = self.user(conn, user_id)
+        return user.username if user else None
+
+    def group_name(self, conn, group_id):
+        if group_id not in self.groups:
+            self.refresh(conn)
+        return self.groups[group_id]
@@ -0,0 +1,48 @@
+import queue
+import time
+
+# How long the writer waits for more messages after the first one arrives
+# before committing, and the most it will put in one transaction.
+GROUP_COMMIT_WINDOW = 0.005
+GROUP_COMMIT_MAX = 256
+
+
+def collect_batch(jobs, first, batchable, window=GROUP_COMMIT_WINDOW, limit=GROUP_COMMIT_MAX):
+    # Gathers the jobs queued behind `first` into one batch. Returns the batch
+    # and the first job that could not join it (None if there was none); the
+    # caller must run that job next so the queue stays in order.
+    batch = [first]
+    deadline = time.perf_counter() + window
+    while len(batch) < limit:
+        remaining = deadline - time.perf_counter()
+        try:
+            job = jobs.get(timeout=remaining) if remaining > 0 else jobs.get_nowait()
+        except queue.Empty:
+            break
+        if not batchable(job):
+            return batch, job
+        batch.append(job)
+    return batch, None
+
+
+class CommitStats:
+    def __init__(self):
+        self.messages = 0
+        self.batches = 0
+        self.largest_batch = 0
+        self.commit_seconds = 0.0
+
+    def record(self, batch_size, seconds):
+        self.messages += batch_size
+        self.batches += 1
+        self.largest_batch = max(self.largest_batch, batch_size)
+        self.commit_seconds += seconds
+
+    def snapshot(self):
+        return {
+            'messages': self.messages,
+            'batches': self.batches,
+            'largest_batch': self.largest_batch,
+            'mean_batch': self.messages / self.batches if self.batches else 0.0,
+            'messages_per_second': self.messages / self.commit_seconds if self.commit_seconds else 0.0,
+        }
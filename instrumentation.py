@@ -0,0 +1,174 @@
+import atexit
+import bisect
+import functools
+import json
+import os
+import threading
+import time
+
+# CHAT_PROFILE=1 turns timing on. When it is off, instrument() and timed()
+# hand back exactly what they were given, so nothing is wrapped and the hot
+# paths cost the same as before. CHAT_PROFILE_DUMP names a file to write the
+# numbers to: Prometheus text format, or JSON if the name ends in .json.
+ENABLED = os.environ.get('CHAT_PROFILE', '') not in ('', '0')
+DUMP_PATH = os.environ.get('CHAT_PROFILE_DUMP') or None
+DUMP_INTERVAL = 10000
+
+# Histogram bucket upper bounds in seconds; the last bucket is everything slower.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds, rows, failed):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.rows += rows
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if failed:
+            self.errors += 1
+
+    def quantile(self, fraction):
+        # The upper bound of the bucket the quantile falls in, so an estimate
+        # that errs on the slow side; the overflow bucket reports the max.
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if count and seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+metrics = {}
+metrics_lock = threading.Lock()
+
+
+def record(kind, name, seconds, rows=0, failed=False):
+    with metrics_lock:
+        histogram = metrics.get((kind, name))
+        if histogram is None:
+            histogram = metrics[(kind, name)] = Histogram()
+        histogram.add(seconds, rows, failed)
+
+
+def row_count(result):
+    if result is None:
+        return 0
+    if isinstance(result, (list, dict)):
+        return len(result)
+    return 1
+
+
+def timed(kind, name, function):
+    if not ENABLED:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            record(kind, name, time.perf_counter() - started, failed=True)
+            raise
+        record(kind, name, time.perf_counter() - started, row_count(result))
+        return result
+    return wrapper
+
+
+def profiled(kind):
+    # Decorator form of timed(), named after the function. Applied to methods
+    # in a class body, the bound methods keep their __self__.
+    def decorate(function):
+        return timed(kind, function.__qualname__, function)
+    return decorate
+
+
+def instrument(obj, kind):
+    # Times every public method of obj from now on, under its own name.
+    if not ENABLED:
+        return obj
+    for name in dir(type(obj)):
+        if not name.startswith('_') and callable(getattr(type(obj), name)):
+            setattr(obj, name, timed(kind, name, getattr(obj, name)))
+    return obj
+
+
+def snapshot():
+    # (kind, name, Histogram) for every metric, slowest total first.
+    with metrics_lock:
+        items = [(kind, name, histogram) for (kind, name), histogram in metrics.items()]
+    return sorted(items, key=lambda item: item[2].total, reverse=True)
+
+
+def to_json():
+    report = []
+    for kind, name, histogram in snapshot():
+        report.append({
+            'kind': kind,
+            'name': name,
+            'count': histogram.count,
+            'errors': histogram.errors,
+            'rows': histogram.rows,
+            'total_s': round(histogram.total, 6),
+            'max_s': round(histogram.max, 6),
+            'p50_s': histogram.quantile(0.50),
+            'p95_s': histogram.quantile(0.95),
+            'p99_s': histogram.quantile(0.99),
+            'buckets': dict(zip([str(bound) for bound in BUCKETS] + ['+Inf'], histogram.counts)),
+        })
+    return json.dumps({'time': time.time(), 'metrics': report}, indent=2)
+
+
+def to_prometheus():
+    # Each metric family's samples have to be contiguous, under its TYPE line.
+    durations = ["# TYPE chat_duration_seconds histogram"]
+    rows = ["# TYPE chat_rows_total counter"]
+    errors = ["# TYPE chat_errors_total counter"]
+    for kind, name, histogram in snapshot():
+        labels = f'kind="{kind}",name="{name}"'
+        cumulative = 0
+        for bound, count in zip([str(bound) for bound in BUCKETS] + ['+Inf'], histogram.counts):
+            cumulative += count
+            durations.append(f'chat_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        durations.append(f"chat_duration_seconds_sum{{{labels}}} {histogram.total:.6f}")
+        durations.append(f"chat_duration_seconds_count{{{labels}}} {histogram.count}")
+        rows.append(f"chat_rows_total{{{labels}}} {histogram.rows}")
+        errors.append(f"chat_errors_total{{{labels}}} {histogram.errors}")
+    return "\n".join(durations + rows + errors) + "\n"
+
+
+def dump(path=DUMP_PATH):
+    if not path:
+        return
+    text = to_json() if path.endswith('.json') else to_prometheus()
+    # Written beside the target and renamed over it, so a scraper never
+    # reads a half-written file.
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+
+def dump_at_exit():
+    if ENABLED and DUMP_PATH:
+        atexit.register(dump)
+
+
+def summary(limit=15):
+    # Fixed-width text for the developer overlay.
+    lines = [f"{'metric':40} {'calls':>7} {'err':>4} {'rows':>8} {'total ms':>9} {'p50':>7} {'p95':>7} {'max':>7}"]
+    for kind, name, histogram in snapshot()[:limit]:
+        lines.append(f"{kind + '.' + name:40.40} {histogram.count:7} {histogram.errors:4} {histogram.rows:8} "
+                     f"{histogram.total * 1000:9.1f} {histogram.quantile(0.5) * 1000:7.2f} "
+                     f"{histogram.quantile(0.95) * 1000:7.2f} {histogram.max * 1000:7.2f}")
+    return "\n".join(lines)
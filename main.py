@@ -1,76 +1,899 @@
 import sys
 import os
-from datetime import datetime
-import sqlite3
-import shutil
+import argparse
+import itertools
+import queue
+import time
+import hashlib
+from functools import partial
 
-from PyQt5.QtMultimedia import QSound
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout,
                              QHBoxLayout, QPushButton, QLabel, QLineEdit,
                              QTextEdit, QFileDialog, QListWidget, QStackedWidget,
-                             QDialog, QInputDialog, QMessageBox, QScrollArea,
-                             QFrame, QListWidgetItem)
-from PyQt5.QtCore import Qt, QSize, QTimer
-from PyQt5.QtGui import QIcon, QPixmap, QImage
-import base64, bcrypt
-
-
-class Database:
-    def __init__(self):
-        self.conn = sqlite3.connect('chat_app.db')
-        self.cur = self.conn.cursor()
-        self.create_tables()
-
-    def create_tables(self):
-        self.cur.executescript('''
-            CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY,
-            username TEXT UNIQUE NOT NULL,
-            password BLOB NOT NULL,
-            telephone TEXT,
-            profile_pic TEXT
-        );
-
-
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY,
-                sender_id INTEGER,
-                receiver_id INTEGER,
-                group_id INTEGER,
-                content TEXT,
-                media_path TEXT,
-                media_type TEXT,
-                timestamp DATETIME,
-                FOREIGN KEY (sender_id) REFERENCES users (id),
-                FOREIGN KEY (receiver_id) REFERENCES users (id),
-                FOREIGN KEY (group_id) REFERENCES groups (id)
-            );
-
-            CREATE TABLE IF NOT EXISTS groups (
-                id INTEGER PRIMARY KEY,
-                name TEXT NOT NULL,
-                created_by INTEGER,
-                FOREIGN KEY (created_by) REFERENCES users (id)
-            );
-
-            CREATE TABLE IF NOT EXISTS group_members (
-                group_id INTEGER,
-                user_id INTEGER,
-                FOREIGN KEY (group_id) REFERENCES groups (id),
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            );
-
-            CREATE TABLE IF NOT EXISTS status_posts (
-                id INTEGER PRIMARY KEY,
-                user_id INTEGER,
-                content TEXT,
-                media_path TEXT,
-                media_type TEXT,
-                timestamp DATETIME,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            );
-        ''')
-        self.conn.commit()
+                             QDialog, QInputDialog, QMessageBox, QListWidgetItem,
+                             QListView, QStyledItemDelegate, QProgressBar, QShortcut)
+from PyQt5.QtCore import (Qt, QSize, QRect, QTimer, QObject, QThread, QThreadPool, QRunnable, QUrl,
+                          QAbstractListModel, QModelIndex, pyqtSignal)
+from PyQt5 import sip
+from PyQt5.QtGui import (QIcon, QPixmap, QImage, QImageReader, QPixmapCache, QColor, QFont,
+                         QDesktopServices, QFontDatabase, QKeySequence)
+import base64
+
+from archive import ARCHIVE_INTERVAL
+from database import DATABASE_PATH
+from records import Message
+from repository import ChatService, MESSAGE_PAGE_SIZE, POST_PAGE_SIZE
+import media_store
+import instrumentation
+from instrumentation import profiled
+from auth import check_password, hash_password
+from group_commit import collect_batch
+from chat_protocol import RemoteError, client_arguments, decode_frames, encode_frame, parse_address
+
+MAX_RENDERED_MESSAGES = 300
+CHANGE_POLL_INTERVAL = 1000
+CHANGE_PRUNE_EVERY = 600
+NAME_ROLE = Qt.ItemDataRole.UserRole + 1
+THUMBNAIL_DIR = ".thumbnails"
+PIXMAP_CACHE_KB = 64 * 1024
+AVATAR_SIZE = 40
+HEADER_PIC_SIZE = 75
+PROFILE_PIC_SIZE = 200
+CHAT_IMAGE_SIZE = 200
+POST_IMAGE_SIZE = 300
+OVERLAY_INTERVAL = 1000
+ARCHIVE_START_DELAY = 60 * 1000
+
+content_digests = {}
+
+
+def content_digest(path):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in content_digests:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        content_digests[key] = digest.hexdigest()
+    return content_digests[key]
+
+
+def thumbnail_path(path, size):
+    # Thumbnails are keyed by the source's content hash, so the same picture
+    # stored under several names is only ever scaled once per size.
+    digest = content_digest(path)
+    thumb = os.path.join(THUMBNAIL_DIR, digest[:2], f"{digest}_{size}.png")
+    if not os.path.exists(thumb):
+        reader = QImageReader(path)
+        reader.setAutoTransform(True)
+        scaled_size = reader.size()
+        if scaled_size.isValid():
+            scaled_size.scale(size, size, Qt.AspectRatioMode.KeepAspectRatio)
+            reader.setScaledSize(scaled_size)
+        image = reader.read()
+        if image.isNull():
+            return None
+
+        os.makedirs(os.path.dirname(thumb), exist_ok=True)
+        image.save(f"{thumb}.tmp", "PNG")
+        os.replace(f"{thumb}.tmp", thumb)
+    return thumb
+
+
+def pixmap_cache_key(path, size):
+    return f"{os.path.abspath(path)}:{os.stat(path).st_mtime_ns}:{size}"
+
+
+def cached_pixmap(path, size):
+    pixmap = QPixmapCache.find(pixmap_cache_key(path, size))
+    return None if pixmap is None or pixmap.isNull() else pixmap
+
+
+def generate_thumbnails(path, *sizes):
+    for size in sizes:
+        try:
+            thumbnail_path(path, size)
+        except OSError as e:
+            print(f"Error generating thumbnail: {str(e)}")
+
+
+def callback_alive(callback):
+    owner = getattr(getattr(callback, 'func', callback), '__self__', None)
+    return not (isinstance(owner, QObject) and sip.isdeleted(owner))
+
+
+class BackgroundTask(QRunnable):
+    def __init__(self, tasks, token, function, args, progress):
+        super().__init__()
+        self.tasks = tasks
+        self.token = token
+        self.function = function
+        self.args = args
+        self.progress = progress
+        self.percent = -1
+
+    def report(self, done, total):
+        percent = done * 100 // total if total else 100
+        if percent != self.percent:
+            self.percent = percent
+            self.tasks.task_progress.emit(self.token, percent)
+
+    def run(self):
+        # Any exception has to come back as a failure: a caller waiting on the
+        # result (a disabled login button, a progress bar) would wait forever.
+        try:
+            if self.progress:
+                result = self.function(*self.args, progress=self.report)
+            else:
+                result = self.function(*self.args)
+        except Exception as e:
+            self.tasks.task_failed.emit(self.token, str(e))
+        else:
+            self.tasks.task_finished.emit(self.token, result)
+
+
+class BackgroundTasks(QObject):
+    # One shared pool per subclass for a kind of slow work. Functions run on
+    # the pool; their results come back on the GUI thread to callbacks whose
+    # owner has not been deleted in the meantime.
+    task_progress = pyqtSignal(int, int)
+    task_finished = pyqtSignal(int, object)
+    task_failed = pyqtSignal(int, str)
+
+    THREADS = 2
+    FAILURE = "Error in background task"
+
+    instances = {}
+
+    @classmethod
+    def instance(cls):
+        if cls not in BackgroundTasks.instances:
+            BackgroundTasks.instances[cls] = cls()
+        return BackgroundTasks.instances[cls]
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(self.THREADS)
+        self.next_token = 0
+        self.pending = {}
+        self.task_progress.connect(self.on_progress)
+        self.task_finished.connect(self.on_finished)
+        self.task_failed.connect(self.on_failed)
+
+    def start(self, function, args, callback, errback=None, progress=None):
+        # With a progress callback, function is also passed progress=report,
+        # to be called as report(done, total).
+        self.next_token += 1
+        self.pending[self.next_token] = (callback, errback, progress)
+        self.pool.start(BackgroundTask(self, self.next_token, function, args, progress is not None))
+
+    def on_progress(self, token, percent):
+        progress = self.pending.get(token, (None, None, None))[2]
+        if progress and callback_alive(progress):
+            progress(percent)
+
+    def on_finished(self, token, result):
+        callback = self.pending.pop(token)[0]
+        if callback_alive(callback):
+            callback(result)
+
+    def on_failed(self, token, error):
+        errback = self.pending.pop(token)[1]
+        if errback and callback_alive(errback):
+            errback(error)
+        else:
+            print(f"{self.FAILURE}: {error}")
+
+
+def decode_image(path, size):
+    # QImage, unlike QPixmap, may be created off the GUI thread.
+    try:
+        thumb = thumbnail_path(path, size)
+        return QImage(thumb) if thumb else QImage()
+    except OSError:
+        return QImage()
+
+
+class ImageLoader(BackgroundTasks):
+    FAILURE = "Error decoding image"
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool.setMaxThreadCount(max(2, QThreadPool.globalInstance().maxThreadCount() - 1))
+        self.decoding = {}
+        self.placeholders = {}
+
+    def placeholder(self, size):
+        if size not in self.placeholders:
+            pixmap = QPixmap(size, size * 3 // 4)
+            pixmap.fill(QColor("#dddddd"))
+            self.placeholders[size] = pixmap
+        return self.placeholders[size]
+
+    def request(self, path, size, callback):
+        # Returns the pixmap straight away when it is cached; otherwise returns a
+        # placeholder and calls back with the real pixmap once it is decoded.
+        if not path or not os.path.exists(path):
+            return QPixmap()
+
+        pixmap = cached_pixmap(path, size)
+        if pixmap is not None:
+            return pixmap
+
+        key = pixmap_cache_key(path, size)
+        if key not in self.decoding:
+            self.decoding[key] = []
+            self.start(decode_image, (path, size), partial(self.on_decoded, key))
+        self.decoding[key].append(callback)
+        return self.placeholder(size)
+
+    def set_pixmap(self, label, path, size):
+        label.setPixmap(self.request(path, size, label.setPixmap))
+
+    def on_decoded(self, key, image):
+        pixmap = QPixmap.fromImage(image)
+        if not pixmap.isNull():
+            QPixmapCache.insert(key, pixmap)
+        for callback in self.decoding.pop(key, []):
+            if callback_alive(callback):
+                callback(pixmap)
+
+
+def ingest_media(path, thumbnail_sizes, progress=None):
+    stored_path, digest = media_store.ingest(path, progress=progress)
+    stat = os.stat(stored_path)
+    content_digests[(os.path.abspath(stored_path), stat.st_size, stat.st_mtime_ns)] = digest
+    generate_thumbnails(stored_path, *thumbnail_sizes)
+    return stored_path
+
+
+class MediaUploader(BackgroundTasks):
+    # Uploads are disk bound; two at a time keeps a large video from
+    # starving the image decoders without serialising every attachment.
+    THREADS = 2
+    FAILURE = "Error storing media"
+
+    def upload(self, path, callback, progress=None, errback=None, thumbnail_sizes=()):
+        self.start(ingest_media, (path, thumbnail_sizes), callback, errback, progress)
+
+
+class Authenticator(BackgroundTasks):
+    # bcrypt is deliberately slow; it runs here so the window keeps painting.
+    THREADS = 2
+    FAILURE = "Error hashing password"
+
+    def check(self, password, hashed, callback, errback=None):
+        # Calls back with (matches, new_hash), as auth.check_password returns.
+        self.start(check_password, (password, hashed), callback, errback)
+
+    def hash(self, password, callback, errback=None):
+        self.start(hash_password, (password,), callback, errback)
+
+
+class DatabaseWorker(QThread):
+    job_finished = pyqtSignal(object, object)
+    job_failed = pyqtSignal(str, object, object)
+
+    STOP = object()
+
+    def __init__(self, service, parent=None):
+        super().__init__(parent)
+        self.service = service
+        self.jobs = queue.Queue()
+        self.job_finished.connect(self.deliver)
+        self.job_failed.connect(self.deliver_error)
+
+    def submit(self, method, *args, callback=None, errback=None):
+        self.jobs.put((method, args, callback, errback))
+
+    def stop(self):
+        self.jobs.put(self.STOP)
+        self.wait()
+
+    def is_message_job(self, job):
+        return job is not self.STOP and job[0] == 'save_message'
+
+    def run(self):
+        # The service hands this thread a connection of its own, the first
+        # time it is used; sqlite3 connections must stay on one thread.
+        service = self.service
+        next_job = None
+        while True:
+            job = next_job or self.jobs.get()
+            next_job = None
+            if job is self.STOP:
+                break
+
+            method, args, callback, errback = job
+            if method == 'save_message':
+                # Messages queued close together share one transaction and one fsync.
+                batch, next_job = collect_batch(self.jobs, job, self.is_message_job)
+                self.save_batch(service, batch)
+                continue
+
+            try:
+                result = getattr(service, method)(*args)
+            except Exception as e:
+                self.job_failed.emit(method, errback, e)
+            else:
+                self.job_finished.emit(callback, result)
+        service.close()
+
+    def save_batch(self, service, batch):
+        # With CHAT_PROFILE the service is instrumented, and db.save_messages
+        # counts the commits, the messages they carried (rows) and their time.
+        try:
+            message_ids = service.save_messages([args for _, args, _, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                method, _, _, errback = batch[0]
+                self.job_failed.emit(method, errback, e)
+                return
+            # The batch was rolled back; one at a time, only the message
+            # that caused it fails again.
+            for method, args, callback, errback in batch:
+                try:
+                    message_id = service.save_message(*args)
+                except Exception as error:
+                    self.job_failed.emit(method, errback, error)
+                else:
+                    self.job_finished.emit(callback, message_id)
+            return
+
+        for (_, _, callback, _), message_id in zip(batch, message_ids):
+            self.job_finished.emit(callback, message_id)
+
+    def deliver(self, callback, result):
+        if callback and callback_alive(callback):
+            callback(result)
+
+    def deliver_error(self, method, errback, error):
+        if errback is None:
+            print(f"Error running {method}: {str(error)}")
+        elif callback_alive(errback):
+            errback(error)
+
+
+class RemoteDatabase(QObject):
+    # Same submit() interface as DatabaseWorker, but the calls go to a
+    # chat_server process, which also pushes change feed rows as they happen.
+    changes_pushed = pyqtSignal(object)
+
+    def __init__(self, address, parent=None):
+        super().__init__(parent)
+        # Only server mode needs QtNetwork, so it is not loaded at startup.
+        from PyQt5.QtNetwork import QLocalSocket, QTcpSocket
+
+        self.kind, self.host, self.port = parse_address(address)
+        self.socket = QLocalSocket(self) if self.kind == 'unix' else QTcpSocket(self)
+        self.socket.connected.connect(self.on_connected)
+        self.socket.readyRead.connect(self.on_ready_read)
+        self.socket.disconnected.connect(self.on_disconnected)
+        self.request_ids = itertools.count(1)
+        self.pending = {}
+        self.outbox = []
+        self.buffer = bytearray()
+        self.is_connected = False
+
+    def start(self):
+        if self.kind == 'unix':
+            self.socket.connectToServer(self.host)
+        else:
+            self.socket.connectToHost(self.host, self.port)
+
+    def stop(self):
+        self.socket.abort()
+
+    def submit(self, method, *args, callback=None, errback=None):
+        request_id = next(self.request_ids)
+        self.pending[request_id] = (method, callback, errback, time.perf_counter())
+        frame = encode_frame({'id': request_id, 'method': method, 'args': client_arguments(method, args)})
+        if self.is_connected:
+            self.socket.write(frame)
+        else:
+            self.outbox.append(frame)
+
+    def on_connected(self):
+        self.is_connected = True
+        for frame in self.outbox:
+            self.socket.write(frame)
+        self.outbox.clear()
+
+    def on_ready_read(self):
+        self.buffer.extend(bytes(self.socket.readAll()))
+        for message in decode_frames(self.buffer):
+            if 'push' in message:
+                self.changes_pushed.emit(message['changes'])
+                continue
+
+            if message.get('id') not in self.pending:
+                print(f"Error from chat server: {message.get('error')}")
+                continue
+            method, callback, errback, started = self.pending.pop(message['id'])
+            if instrumentation.ENABLED:
+                # Round trip as the GUI sees it, server time included.
+                instrumentation.record('remote', method, time.perf_counter() - started,
+                                       instrumentation.row_count(message.get('result')), 'error' in message)
+            if 'error' in message:
+                self.deliver_error(method, errback, RemoteError(message['error']))
+            elif callback and callback_alive(callback):
+                callback(message.get('result'))
+
+    def on_disconnected(self):
+        self.is_connected = False
+        pending, self.pending = self.pending, {}
+        for method, _, errback, _ in pending.values():
+            self.deliver_error(method, errback, ConnectionError("lost connection to chat server"))
+
+    def deliver_error(self, method, errback, error):
+        if errback is None:
+            print(f"Error running {method}: {str(error)}")
+        elif callback_alive(errback):
+            errback(error)
+
+
+class ChangeDispatcher(QObject):
+    message_added = pyqtSignal(int, int, int, int)
+    user_added = pyqtSignal(int)
+    group_member_added = pyqtSignal(int, int)
+    post_added = pyqtSignal(int, int)
+
+    def __init__(self, db, parent=None):
+        super().__init__(parent)
+        self.db = db
+        self.last_change_id = None
+        self.polling = False
+        self.ticks = 0
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.poll)
+
+    def start(self):
+        if isinstance(self.db, RemoteDatabase):
+            # The server pushes changes, so there is nothing to poll.
+            self.db.changes_pushed.connect(self.dispatch)
+            return
+        self.db.submit('latest_change_id', callback=self.on_started)
+
+    def on_started(self, change_id):
+        self.last_change_id = change_id
+        self.timer.start(CHANGE_POLL_INTERVAL)
+
+    def stop(self):
+        self.timer.stop()
+
+    @profiled('timer')
+    def poll(self):
+        if self.polling:
+            return
+        self.polling = True
+        self.db.submit('get_changes', self.last_change_id, callback=self.dispatch, errback=self.on_poll_failed)
+
+        self.ticks += 1
+        if self.ticks % CHANGE_PRUNE_EVERY == 0:
+            self.db.submit('prune_changes')
+
+    def on_poll_failed(self, error):
+        self.polling = False
+        print(f"Error polling changes: {str(error)}")
+
+    @profiled('gui')
+    def dispatch(self, changes):
+        self.polling = False
+        for change_id, kind, row_id, user_id, peer_id, group_id in changes:
+            self.last_change_id = change_id
+            if kind == 'message':
+                self.message_added.emit(row_id, user_id or 0, peer_id or 0, group_id or 0)
+            elif kind == 'user':
+                self.user_added.emit(user_id)
+            elif kind == 'group_member':
+                self.group_member_added.emit(group_id, user_id)
+            elif kind == 'post':
+                self.post_added.emit(row_id, user_id)
+
+
+class Archiver(QObject):
+    # Runs archiving, the media sweep and compaction on the background
+    # database worker a step at a time, so the write lock is only ever held
+    # for one step and the UI's own writes wait for at most that long.
+    def __init__(self, db, parent=None):
+        super().__init__(parent)
+        self.db = db
+        self.running = False
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.run)
+
+    def start(self):
+        QTimer.singleShot(ARCHIVE_START_DELAY, self.run)
+        self.timer.start(ARCHIVE_INTERVAL * 1000)
+
+    def stop(self):
+        self.timer.stop()
+
+    def run(self):
+        if self.running or not self.timer.isActive():
+            return
+        self.running = True
+        self.db.submit('archive_step', callback=self.on_archived, errback=self.on_failed)
+
+    def on_archived(self, moved):
+        if moved:
+            self.db.submit('archive_step', callback=self.on_archived, errback=self.on_failed)
+        else:
+            self.db.submit('collect_media', callback=self.on_collected, errback=self.on_failed)
+
+    def on_collected(self, removed):
+        self.db.submit('compact', callback=self.on_compacted, errback=self.on_failed)
+
+    def on_compacted(self, work):
+        if work:
+            self.db.submit('compact', callback=self.on_compacted, errback=self.on_failed)
+        else:
+            self.running = False
+
+    def on_failed(self, error):
+        self.running = False
+        print(f"Error archiving: {str(error)}")
+
+
+class CachedLayoutDelegate(QStyledItemDelegate):
+    # Row layouts are computed once per item for the current viewport width and
+    # dropped when the width changes or one of the item's images finishes loading.
+    PADDING = 8
+
+    def __init__(self, view):
+        super().__init__(view)
+        self.view = view
+        self.layouts = {}
+        self.layout_width = None
+
+    def cached_layout(self, item_id, width):
+        if width != self.layout_width:
+            self.layouts.clear()
+            self.layout_width = width
+        return self.layouts.get(item_id)
+
+    def on_image_ready(self, item_id, pixmap):
+        self.layouts.pop(item_id, None)
+        row = self.view.model().row_for_id(item_id)
+        if row is not None:
+            self.sizeHintChanged.emit(self.view.model().index(row))
+
+
+class MessageModel(QAbstractListModel):
+    MessageRole = Qt.ItemDataRole.UserRole
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.messages = []
+        # Messages the user has sent that are not back from the database yet.
+        # They sit below the loaded rows under negative ids, and are dropped
+        # once a row with the id they were saved under has been loaded.
+        self.pending = []
+        self.saved_ids = {}
+        self.next_pending_id = 0
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.messages) + len(self.pending)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        row = index.row()
+        message = self.messages[row] if row < len(self.messages) else self.pending[row - len(self.messages)]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return message.content
+        if role == self.MessageRole:
+            return message
+        return None
+
+    @property
+    def first_id(self):
+        return self.messages[0].id if self.messages else 0
+
+    @property
+    def last_id(self):
+        return self.messages[-1].id if self.messages else 0
+
+    def row_for_id(self, message_id):
+        if message_id < 0:
+            for row, message in enumerate(self.pending):
+                if message.id == message_id:
+                    return len(self.messages) + row
+            return None
+
+        # Ids are ascending, so this is a binary search.
+        low, high = 0, len(self.messages)
+        while low < high:
+            middle = (low + high) // 2
+            if self.messages[middle].id < message_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.messages) and self.messages[low].id == message_id:
+            return low
+        return None
+
+    def reset_messages(self, rows):
+        self.beginResetModel()
+        self.messages = list(rows)
+        self.endResetModel()
+        self.drop_delivered()
+
+    def append_messages(self, rows):
+        self.beginInsertRows(QModelIndex(), len(self.messages), len(self.messages) + len(rows) - 1)
+        self.messages.extend(rows)
+        self.endInsertRows()
+        self.drop_delivered()
+
+    def prepend_messages(self, rows):
+        self.beginInsertRows(QModelIndex(), 0, len(rows) - 1)
+        self.messages[:0] = rows
+        self.endInsertRows()
+
+    def trim_front(self, count):
+        self.beginRemoveRows(QModelIndex(), 0, count - 1)
+        del self.messages[:count]
+        self.endRemoveRows()
+
+    def trim_back(self, count):
+        self.beginRemoveRows(QModelIndex(), len(self.messages) - count, len(self.messages) - 1)
+        del self.messages[-count:]
+        self.endRemoveRows()
+
+    def add_pending(self, content, media_path, media_type, username):
+        self.next_pending_id -= 1
+        row = len(self.messages) + len(self.pending)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.pending.append(Message(self.next_pending_id, content, media_path, media_type, "sending...", username))
+        self.endInsertRows()
+        return self.next_pending_id
+
+    def confirm_pending(self, pending_id, message_id):
+        self.saved_ids[pending_id] = message_id
+        self.drop_delivered()
+
+    def remove_pending(self, pending_id):
+        row = self.row_for_id(pending_id)
+        if row is not None:
+            self.beginRemoveRows(QModelIndex(), row, row)
+            del self.pending[row - len(self.messages)]
+            self.endRemoveRows()
+        self.saved_ids.pop(pending_id, None)
+
+    def drop_delivered(self):
+        for pending_id, message_id in list(self.saved_ids.items()):
+            if message_id <= self.last_id:
+                self.remove_pending(pending_id)
+
+
+class MessageDelegate(CachedLayoutDelegate):
+    highlighted_id = None
+
+    def message_layout(self, message, width, font_metrics):
+        layout = self.cached_layout(message.id, width)
+        if layout:
+            return layout
+
+        padding = self.PADDING
+        text_width = max(width - 2 * padding, 1)
+        layout = {'content': None, 'media': None, 'link': None}
+        layout['header'] = QRect(padding, padding, text_width, font_metrics.height())
+        y = padding + font_metrics.height()
+
+        if message.content:
+            height = font_metrics.boundingRect(QRect(0, 0, text_width, 100000),
+                                               Qt.TextFlag.TextWordWrap, message.content).height()
+            layout['content'] = QRect(padding, y, text_width, height)
+            y += height
+
+        if message.media_path:
+            if message.media_type == 'image' and os.path.exists(message.media_path):
+                pixmap = ImageLoader.instance().request(message.media_path, CHAT_IMAGE_SIZE,
+                                                        partial(self.on_image_ready, message.id))
+                layout['media'] = (QRect(padding, y, pixmap.width(), pixmap.height()), pixmap)
+                y += pixmap.height()
+            else:
+                label = "[Click to Play Video]" if message.media_type == 'video' else "[Download File]"
+                layout['link'] = (QRect(padding, y, text_width, font_metrics.height()), label)
+                y += font_metrics.height()
+
+        layout['height'] = y + padding
+        self.layouts[message.id] = layout
+        return layout
+
+    def sizeHint(self, option, index):
+        message = index.data(MessageModel.MessageRole)
+        width = self.view.viewport().width()
+        return QSize(width, self.message_layout(message, width, option.fontMetrics)['height'])
+
+    @profiled('gui')
+    def paint(self, painter, option, index):
+        message = index.data(MessageModel.MessageRole)
+        layout = self.message_layout(message, option.rect.width(), option.fontMetrics)
+
+        painter.save()
+        if message.id == self.highlighted_id:
+            painter.fillRect(option.rect, QColor("#fff3b0"))
+        painter.translate(option.rect.topLeft())
+        painter.setPen(option.palette.text().color())
+
+        header_font = QFont(option.font)
+        header_font.setBold(True)
+        painter.setFont(header_font)
+        painter.drawText(layout['header'], Qt.AlignmentFlag.AlignLeft, f"{message.username} ({message.timestamp}):")
+        painter.setFont(option.font)
+
+        if layout['content']:
+            painter.drawText(layout['content'], Qt.TextFlag.TextWordWrap, message.content)
+        if layout['media']:
+            rect, pixmap = layout['media']
+            painter.drawPixmap(rect.topLeft(), pixmap)
+        if layout['link']:
+            rect, label = layout['link']
+            painter.setPen(option.palette.link().color())
+            painter.drawText(rect, Qt.AlignmentFlag.AlignLeft, label)
+        painter.restore()
+
+
+class PostsModel(QAbstractListModel):
+    PostRole = Qt.ItemDataRole.UserRole
+
+    def __init__(self, db, parent=None):
+        super().__init__(parent)
+        self.db = db
+        self.posts = []
+        self.has_more = True
+        self.fetching = False
+        # Like ChatWidget.loading/append_pending: new posts that arrive while
+        # a page of them is in flight are fetched once it has landed.
+        self.fetching_newer = False
+        self.newer_pending = False
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.posts)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        post = self.posts[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return post.content
+        if role == self.PostRole:
+            return post
+        return None
+
+    def row_for_id(self, post_id):
+        for row, post in enumerate(self.posts):
+            if post.id == post_id:
+                return row
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self.has_more and not self.fetching
+
+    def fetchMore(self, parent=QModelIndex()):
+        if not self.canFetchMore(parent):
+            return
+        self.fetching = True
+        before_id = self.posts[-1].id if self.posts else None
+        self.db.submit('get_posts_page', before_id, callback=self.on_older_page)
+
+    @profiled('gui')
+    def on_older_page(self, rows):
+        self.fetching = False
+        self.has_more = len(rows) == POST_PAGE_SIZE
+        if rows:
+            self.beginInsertRows(QModelIndex(), len(self.posts), len(self.posts) + len(rows) - 1)
+            self.posts.extend(rows)
+            self.endInsertRows()
+        if self.newer_pending:
+            self.newer_pending = False
+            self.fetch_newer()
+
+    def fetch_newer(self):
+        if self.fetching_newer or (self.fetching and not self.posts):
+            # Before the first page has landed there is nothing to page on
+            # from yet.
+            self.newer_pending = True
+            return
+        self.fetching_newer = True
+        # A feed that is still empty once loaded had no posts, so every post
+        # is new.
+        after_id = self.posts[0].id if self.posts else 0
+        self.db.submit('get_posts_page', None, after_id, callback=self.on_newer_page,
+                       errback=self.on_newer_failed)
+
+    @profiled('gui')
+    def on_newer_page(self, rows):
+        # rows are the posts right after the newest one shown, newest first;
+        # a full page means more are waiting.
+        self.fetching_newer = False
+        more = len(rows) == POST_PAGE_SIZE
+        rows = [post for post in rows if not self.posts or post.id > self.posts[0].id]
+        if rows:
+            self.beginInsertRows(QModelIndex(), 0, len(rows) - 1)
+            self.posts[:0] = rows
+            self.endInsertRows()
+        if more or self.newer_pending:
+            self.newer_pending = False
+            self.fetch_newer()
+
+    def on_newer_failed(self, error):
+        self.fetching_newer = False
+        print(f"Error loading new posts: {str(error)}")
+
+
+class PostDelegate(CachedLayoutDelegate):
+    def post_layout(self, post, width, font_metrics):
+        layout = self.cached_layout(post.id, width)
+        if layout:
+            return layout
+
+        loader = ImageLoader.instance()
+        on_ready = partial(self.on_image_ready, post.id)
+        padding = self.PADDING
+        text_width = max(width - 2 * padding, 1)
+        layout = {'avatar': None, 'content': None, 'media': None, 'video': None}
+
+        if post.profile_pic and os.path.exists(post.profile_pic):
+            layout['avatar'] = (QRect(padding, padding, AVATAR_SIZE, AVATAR_SIZE),
+                                loader.request(post.profile_pic, AVATAR_SIZE, on_ready))
+        header_x = padding + AVATAR_SIZE + padding if layout['avatar'] else padding
+        layout['header'] = QRect(header_x, padding, width - header_x - padding, AVATAR_SIZE)
+        y = padding + AVATAR_SIZE + padding
+
+        if post.content:
+            height = font_metrics.boundingRect(QRect(0, 0, text_width, 100000),
+                                               Qt.TextFlag.TextWordWrap, post.content).height()
+            layout['content'] = QRect(padding, y, text_width, height)
+            y += height + padding
+
+        if post.media_path and os.path.exists(post.media_path):
+            if post.media_type == 'image':
+                pixmap = loader.request(post.media_path, POST_IMAGE_SIZE, on_ready)
+                layout['media'] = (QRect(padding, y, pixmap.width(), pixmap.height()), pixmap)
+                y += pixmap.height() + padding
+            elif post.media_type == 'video':
+                layout['video'] = QRect(padding, y, text_width, font_metrics.height())
+                y += font_metrics.height() + padding
+
+        layout['height'] = y
+        self.layouts[post.id] = layout
+        return layout
+
+    def sizeHint(self, option, index):
+        post = index.data(PostsModel.PostRole)
+        width = self.view.viewport().width()
+        return QSize(width, self.post_layout(post, width, option.fontMetrics)['height'])
+
+    @profiled('gui')
+    def paint(self, painter, option, index):
+        post = index.data(PostsModel.PostRole)
+        layout = self.post_layout(post, option.rect.width(), option.fontMetrics)
+
+        painter.save()
+        painter.translate(option.rect.topLeft())
+        painter.setPen(QColor("#bbbbbb"))
+        painter.drawRect(0, 0, option.rect.width() - 1, option.rect.height() - 1)
+        painter.setPen(option.palette.text().color())
+
+        if layout['avatar']:
+            rect, pixmap = layout['avatar']
+            painter.drawPixmap(rect.topLeft(), pixmap)
+        painter.drawText(layout['header'], Qt.AlignmentFlag.AlignVCenter, f"{post.username} - {post.timestamp}")
+        if layout['content']:
+            painter.drawText(layout['content'], Qt.TextFlag.TextWordWrap, post.content)
+        if layout['media']:
+            rect, pixmap = layout['media']
+            painter.drawPixmap(rect.topLeft(), pixmap)
+        if layout['video']:
+            painter.drawText(layout['video'], Qt.AlignmentFlag.AlignLeft,
+                             f"[Video: {os.path.basename(post.media_path)}]")
+        painter.restore()
 
 
 class PostsWidget(QWidget):
@@ -118,88 +941,61 @@ class PostsWidget(QWidget):
         def make_post():
             content = post_input.toPlainText()
             if content or self.media_path:
-                media_type = None
-                new_media_path = None
                 if self.media_path:
                     ext = os.path.splitext(self.media_path)[1].lower()
+                    media_type = None
                     if ext in ['.jpg', '.jpeg', '.png']:
                         media_type = 'image'
                     elif ext in ['.mp4', '.avi']:
                         media_type = 'video'
 
-                    storage_dir = f"posts/{media_type}s"
-                    os.makedirs(storage_dir, exist_ok=True)
-                    new_media_path = os.path.join(storage_dir, f"post_{datetime.now().strftime('%Y%m%d_%H%M%S')}{ext}")
-                    shutil.copy2(self.media_path, new_media_path)
-
-                self.db.cur.execute("""
-                    INSERT INTO status_posts (user_id, content, media_path, media_type, timestamp)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (self.user_id, content, new_media_path, media_type, datetime.now()))
-                self.db.conn.commit()
+                    self.upload_progress.setValue(0)
+                    self.upload_progress.show()
+                    MediaUploader.instance().upload(
+                        self.media_path, partial(self.create_post, content, media_type),
+                        progress=self.upload_progress.setValue, errback=self.on_upload_failed,
+                        thumbnail_sizes=(POST_IMAGE_SIZE,) if media_type == 'image' else ())
+                else:
+                    self.create_post(content, None, None)
 
                 post_input.clear()
                 self.media_path = None
                 attach_btn.setText("Attach Media")
-                self.load_posts()
 
         post_btn.clicked.connect(make_post)
         layout.addWidget(post_btn)
 
-        self.posts_area = QScrollArea()
-        self.posts_widget = QWidget()
-        self.posts_layout = QVBoxLayout()
-        self.posts_widget.setLayout(self.posts_layout)
-        self.posts_area.setWidget(self.posts_widget)
-        self.posts_area.setWidgetResizable(True)
-        layout.addWidget(self.posts_area)
+        self.upload_progress = QProgressBar()
+        self.upload_progress.hide()
+        layout.addWidget(self.upload_progress)
+
+        self.model = PostsModel(self.db)
+        self.posts_view = QListView()
+        self.posts_view.setModel(self.model)
+        self.posts_view.setItemDelegate(PostDelegate(self.posts_view))
+        self.posts_view.setVerticalScrollMode(QListView.ScrollPerPixel)
+        self.posts_view.setResizeMode(QListView.Adjust)
+        self.posts_view.setSelectionMode(QListView.NoSelection)
+        layout.addWidget(self.posts_view)
 
         self.setLayout(layout)
         self.load_posts()
 
-    def load_posts(self):
-
-        for i in reversed(range(self.posts_layout.count())):
-            self.posts_layout.itemAt(i).widget().setParent(None)
-
-
-        self.db.cur.execute("""
-            SELECT sp.content, sp.media_path, sp.media_type, sp.timestamp, u.username, u.profile_pic
-            FROM status_posts sp
-            JOIN users u ON sp.user_id = u.id
-            ORDER BY sp.timestamp DESC
-        """)
-
-        for content, media_path, media_type, timestamp, username, profile_pic in self.db.cur.fetchall():
-            post_frame = QFrame()
-            post_frame.setFrameStyle(QFrame.Shape.Panel | QFrame.Shadow.Raised)
-            post_layout = QVBoxLayout()
+    def on_post_created(self, post_id):
+        self.model.fetch_newer()
 
+    def create_post(self, content, media_type, media_path):
+        self.upload_progress.hide()
+        self.db.submit('create_post', self.user_id, content, media_path, media_type,
+                       callback=self.on_post_created)
 
-            user_info = QHBoxLayout()
-            if profile_pic and os.path.exists(profile_pic):
-                pic_label = QLabel()
-                pixmap = QPixmap(profile_pic)
-                pic_label.setPixmap(pixmap.scaled(40, 40, Qt.AspectRatioMode.KeepAspectRatio))
-                user_info.addWidget(pic_label)
+    def on_upload_failed(self, error):
+        self.upload_progress.hide()
+        QMessageBox.warning(self, "Error", f"Could not attach media: {error}")
 
-            user_info.addWidget(QLabel(f"{username} - {timestamp}"))
-            post_layout.addLayout(user_info)
-
-            if content:
-                post_layout.addWidget(QLabel(content))
-
-            if media_path and os.path.exists(media_path):
-                media_label = QLabel()
-                if media_type == 'image':
-                    pixmap = QPixmap(media_path)
-                    media_label.setPixmap(pixmap.scaled(300, 300, Qt.AspectRatioMode.KeepAspectRatio))
-                    post_layout.addWidget(media_label)
-                elif media_type == 'video':
-                    post_layout.addWidget(QLabel(f"[Video: {os.path.basename(media_path)}]"))
+    def load_posts(self):
+        self.model.fetchMore(QModelIndex())
 
-            post_frame.setLayout(post_layout)
-            self.posts_layout.addWidget(post_frame)
 
 class LoginWindow(QWidget):
     def __init__(self, db, main_window):
@@ -245,14 +1041,14 @@ class LoginWindow(QWidget):
 "font-size: 14px;")
         layout.addWidget(self.password_input)
 
-        loginButton = QPushButton("Login/Register")
-        loginButton.setStyleSheet("padding: 20px;\n"
-                                  "background-color: #0077b9;\n"
-                                  "color: rgba(255,255,255,210);\n"
-                                  "font-size: 18px;\n"
-                                  "border-radius: 5px;\n")
-        loginButton.clicked.connect(self.handle_login)
-        layout.addWidget(loginButton)
+        self.login_button = QPushButton("Login/Register")
+        self.login_button.setStyleSheet("padding: 20px;\n"
+                                        "background-color: #0077b9;\n"
+                                        "color: rgba(255,255,255,210);\n"
+                                        "font-size: 18px;\n"
+                                        "border-radius: 5px;\n")
+        self.login_button.clicked.connect(self.handle_login)
+        layout.addWidget(self.login_button)
 
         self.setLayout(layout)
 
@@ -264,40 +1060,84 @@ class LoginWindow(QWidget):
             QMessageBox.warning(self, "Error", "Please enter both username and password.")
             return
 
-        self.db.cur.execute("SELECT id, password FROM users WHERE username = ?", (username,))
-        user = self.db.cur.fetchone()
-
+        # The button stays disabled until this attempt has finished, so a
+        # second click cannot queue another bcrypt round behind it.
+        self.login_button.setEnabled(False)
+        if isinstance(self.db, RemoteDatabase):
+            # The server checks the password and never hands out hashes.
+            self.db.submit('login', username, password,
+                           callback=partial(self.on_remote_login, username, password),
+                           errback=self.on_login_failed)
+            return
+        self.db.submit('get_user_credentials', username,
+                       callback=partial(self.on_credentials_loaded, username, password),
+                       errback=self.on_login_failed)
+
+    def ask_telephone(self):
+        telephone, ok = QInputDialog.getText(self, "Register", "Enter your telephone number:")
+        if not ok or not telephone.strip():
+            self.login_button.setEnabled(True)
+            QMessageBox.warning(self, "Error", "Registration cancelled. Telephone number is required.")
+            return None
+        return telephone
+
+    def on_credentials_loaded(self, username, password, user):
         if user:
             user_id, stored_hashed_password = user
-
-
-            if bcrypt.checkpw(password.encode('utf-8'), stored_hashed_password):
-                QMessageBox.information(self, "Success", "Login successful!")
-                self.main_window.set_current_user(user_id, username)
-                self.main_window.show_main_screen()
-            else:
-                QMessageBox.critical(self, "Error", "Incorrect password. Please try again.")
+            Authenticator.instance().check(password, stored_hashed_password,
+                                           partial(self.on_password_checked, user_id, username),
+                                           errback=self.on_login_failed)
         else:
-            telephone, ok = QInputDialog.getText(self, "Register", "Enter your telephone number:")
-            if not ok or not telephone.strip():
-                QMessageBox.warning(self, "Error", "Registration cancelled. Telephone number is required.")
-                return
+            telephone = self.ask_telephone()
+            if telephone:
+                Authenticator.instance().hash(password, partial(self.on_password_hashed, username, telephone),
+                                              errback=self.on_register_failed)
+
+    def on_remote_login(self, username, password, user_id):
+        if user_id is not None:
+            self.login_button.setEnabled(True)
+            QMessageBox.information(self, "Success", "Login successful!")
+            self.main_window.set_current_user(user_id, username)
+            self.main_window.show_main_screen()
+            return
+        telephone = self.ask_telephone()
+        if telephone:
+            self.db.submit('register', username, password, telephone,
+                           callback=partial(self.on_registered, username),
+                           errback=self.on_register_failed)
+
+    def on_password_checked(self, user_id, username, result):
+        matches, new_hash = result
+        self.login_button.setEnabled(True)
+        if not matches:
+            QMessageBox.critical(self, "Error", "Incorrect password. Please try again.")
+            return
 
-            hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        if new_hash:
+            # The stored hash used an older work factor; keep the upgraded one.
+            self.db.submit('set_password', user_id, new_hash)
+        QMessageBox.information(self, "Success", "Login successful!")
+        self.main_window.set_current_user(user_id, username)
+        self.main_window.show_main_screen()
 
-            try:
-                self.db.cur.execute("INSERT INTO users (username, password, telephone) VALUES (?, ?, ?)",
-                                    (username, hashed_password, telephone))
-                self.db.conn.commit()
-                user_id = self.db.cur.lastrowid
+    def on_login_failed(self, error):
+        self.login_button.setEnabled(True)
+        QMessageBox.critical(self, "Error", f"Failed to log in: {str(error)}")
 
-                QMessageBox.information(self, "Success", "Registration successful! You can now log in.")
-                self.main_window.set_current_user(user_id, username)
-                self.main_window.show_main_screen()
+    def on_password_hashed(self, username, telephone, hashed_password):
+        self.db.submit('create_user', username, hashed_password, telephone,
+                       callback=partial(self.on_registered, username),
+                       errback=self.on_register_failed)
 
-            except sqlite3.Error as e:
-                QMessageBox.critical(self, "Error", f"Failed to register: {str(e)}")
-                self.db.conn.rollback()
+    def on_registered(self, username, user_id):
+        self.login_button.setEnabled(True)
+        QMessageBox.information(self, "Success", "Registration successful! You can now log in.")
+        self.main_window.set_current_user(user_id, username)
+        self.main_window.show_main_screen()
+
+    def on_register_failed(self, error):
+        self.login_button.setEnabled(True)
+        QMessageBox.critical(self, "Error", f"Failed to register: {str(error)}")
 
 
 class MemberSelectionDialog(QDialog):
@@ -317,11 +1157,7 @@ class MemberSelectionDialog(QDialog):
         self.members_list = QListWidget()
         self.members_list.setSelectionMode(QListWidget.MultiSelection)
 
-        self.db.cur.execute("SELECT id, username FROM users WHERE id != ?", (self.current_user_id,))
-        for user_id, username in self.db.cur.fetchall():
-            item = QListWidgetItem(username)
-            item.setData(Qt.UserRole, user_id)
-            self.members_list.addItem(item)
+        self.db.submit('get_users', self.current_user_id, callback=self.populate_members)
 
         layout.addWidget(QLabel("Select members for the group:"))
         layout.addWidget(self.members_list)
@@ -339,24 +1175,35 @@ class MemberSelectionDialog(QDialog):
 
         self.setLayout(layout)
 
+    def populate_members(self, users):
+        for user in users:
+            item = QListWidgetItem(user.username)
+            item.setData(Qt.UserRole, user.id)
+            self.members_list.addItem(item)
+
     def get_selected_members(self):
         selected_items = self.members_list.selectedItems()
         return [item.data(Qt.UserRole) for item in selected_items]
 
 class ChatWidget(QWidget):
-    def __init__(self, db, user_id, chat_id, is_group=False):
+    messages_read = pyqtSignal()
+
+    def __init__(self, db, user_id, chat_id, is_group=False, username=None, focus_message_id=None):
         super().__init__()
         self.db = db
         self.user_id = user_id
+        self.username = username
         self.chat_id = chat_id
         self.is_group = is_group
-        self.last_message_id = 0
+        self.has_older = False
+        self.has_newer = False
+        self.loading = False
+        self.append_pending = False
         self.init_ui()
-        self.load_messages()
-
-        self.update_timer = QTimer(self)
-        self.update_timer.timeout.connect(self.check_new_messages)
-        self.update_timer.start(1000)
+        if focus_message_id:
+            self.load_around(focus_message_id)
+        else:
+            self.load_messages()
 
     def init_ui(self):
         layout = QVBoxLayout()
@@ -369,14 +1216,32 @@ class ChatWidget(QWidget):
         self.name_label = QLabel()
         header_layout.addWidget(self.name_label)
         header_layout.addStretch()
+
+        # The export file is written by whichever process owns the database,
+        # so there is no export when talking to a chat server.
+        if not isinstance(self.db, RemoteDatabase):
+            export_btn = QPushButton("Export")
+            export_btn.clicked.connect(self.export_conversation)
+            header_layout.addWidget(export_btn)
         layout.addLayout(header_layout)
 
         self.update_header_info()
 
-        self.messages_area = QTextEdit()
-        self.messages_area.setReadOnly(True)
+        self.message_model = MessageModel(self)
+        self.messages_area = QListView()
+        self.messages_area.setModel(self.message_model)
+        self.messages_area.setItemDelegate(MessageDelegate(self.messages_area))
+        self.messages_area.setVerticalScrollMode(QListView.ScrollPerPixel)
+        self.messages_area.setResizeMode(QListView.Adjust)
+        self.messages_area.setSelectionMode(QListView.NoSelection)
+        self.messages_area.doubleClicked.connect(self.open_media)
+        self.messages_area.verticalScrollBar().valueChanged.connect(self.on_scroll)
         layout.addWidget(self.messages_area)
 
+        self.upload_progress = QProgressBar()
+        self.upload_progress.hide()
+        layout.addWidget(self.upload_progress)
+
         input_layout = QHBoxLayout()
 
         self.message_input = QLineEdit()
@@ -408,81 +1273,205 @@ class ChatWidget(QWidget):
 
     def update_header_info(self):
         if self.is_group:
-            self.db.cur.execute("SELECT name FROM groups WHERE id = ?", (self.chat_id,))
-            name = self.db.cur.fetchone()[0]
-            self.name_label.setText(name)
+            self.db.submit('get_group_name', self.chat_id, callback=self.name_label.setText)
         else:
-            self.db.cur.execute("SELECT username, profile_pic FROM users WHERE id = ?", (self.chat_id,))
-            username, profile_pic = self.db.cur.fetchone()
-            self.name_label.setText(username)
+            self.db.submit('get_user_profile', self.chat_id, callback=self.show_header_profile)
 
-            if profile_pic and os.path.exists(profile_pic):
-                pixmap = QPixmap(profile_pic)
-                self.profile_pic_label.setPixmap(pixmap.scaled(75, 75, Qt.AspectRatioMode.KeepAspectRatio))
-            else:
-                pixmap = QPixmap("logo.png")
-                self.profile_pic_label.setPixmap(pixmap.scaled(75,75, Qt.AspectRatioMode.KeepAspectRatio))
+    def show_header_profile(self, profile):
+        self.name_label.setText(profile.username)
 
-    def check_new_messages(self):
-        if self.is_group:
-            self.db.cur.execute("""
-                SELECT MAX(id) FROM messages WHERE group_id = ?
-            """, (self.chat_id,))
+        if profile.profile_pic and os.path.exists(profile.profile_pic):
+            ImageLoader.instance().set_pixmap(self.profile_pic_label, profile.profile_pic, HEADER_PIC_SIZE)
         else:
-            self.db.cur.execute("""
-                SELECT MAX(id) FROM messages 
-                WHERE (sender_id = ? AND receiver_id = ?)
-                OR (sender_id = ? AND receiver_id = ?)
-            """, (self.user_id, self.chat_id, self.chat_id, self.user_id))
-
-        latest_id = self.db.cur.fetchone()[0] or 0
-        if latest_id > self.last_message_id:
-            self.load_messages()
-            
-    def load_messages(self):
-        scroll_bar = self.messages_area.verticalScrollBar()
-        scroll_position = scroll_bar.value()
+            ImageLoader.instance().set_pixmap(self.profile_pic_label, "logo.png", HEADER_PIC_SIZE)
+
+    def export_conversation(self):
+        file_path, _ = QFileDialog.getSaveFileName(self, "Export Conversation", f"{self.name_label.text()}.txt",
+                                                   "Text Files (*.txt)")
+        if file_path:
+            self.db.submit('export_conversation', self.user_id, self.chat_id, self.is_group, file_path,
+                           callback=self.on_exported, errback=self.on_export_failed)
+
+    def on_exported(self, count):
+        QMessageBox.information(self, "Export", f"Exported {count} messages.")
+
+    def on_export_failed(self, error):
+        QMessageBox.critical(self, "Error", f"Error exporting conversation: {str(error)}")
 
-        self.messages_area.clear()
-        chat_html = ""
+    def on_message_added(self, message_id, sender_id, receiver_id, group_id):
+        if self.has_newer or message_id <= self.last_message_id:
+            return
 
         if self.is_group:
-            self.db.cur.execute("""
-                SELECT m.content, m.media_path, m.media_type, m.timestamp, u.username
-                FROM messages m
-                JOIN users u ON m.sender_id = u.id
-                WHERE m.group_id = ?
-                ORDER BY m.timestamp
-            """, (self.chat_id,))
+            belongs = group_id == self.chat_id
         else:
-            self.db.cur.execute("""
-                SELECT m.content, m.media_path, m.media_type, m.timestamp, u.username
-                FROM messages m
-                JOIN users u ON m.sender_id = u.id
-                WHERE (sender_id = ? AND receiver_id = ?)
-                OR (sender_id = ? AND receiver_id = ?)
-                ORDER BY m.timestamp
-            """, (self.user_id, self.chat_id, self.chat_id, self.user_id))
-
-        for content, media_path, media_type, timestamp, username in self.db.cur.fetchall():
-            message_html = f"<b>{username}</b> <i>({timestamp})</i>:<br>"
-
-            if content:
-                message_html += f"{content}<br>"
-
-            if media_path:
-                if media_type == 'image' and os.path.exists(media_path):
-                    message_html += f"<img src='{media_path}' width='200'><br>"
-                elif media_type == 'video':
-                    message_html += f"<a href='{media_path}'>[Click to Play Video]</a><br>"
-                else:
-                    message_html += f"<a href='{media_path}'>[Download File]</a><br>"
+            belongs = {sender_id, receiver_id} == {self.user_id, self.chat_id} and not group_id
+        if belongs:
+            self.append_new_messages()
+
+    @property
+    def first_message_id(self):
+        return self.message_model.first_id
 
-            chat_html += message_html + "<br>"
+    @property
+    def last_message_id(self):
+        return self.message_model.last_id
 
-        self.messages_area.setHtml(chat_html)
+    def scroll_to(self, anchor_id=None, hint=QListView.PositionAtTop):
+        scroll_bar = self.messages_area.verticalScrollBar()
+        scroll_bar.blockSignals(True)
+        self.messages_area.doItemsLayout()
+        row = None if anchor_id is None else self.message_model.row_for_id(anchor_id)
+        if row is None:
+            self.messages_area.scrollToBottom()
+        else:
+            self.messages_area.scrollTo(self.message_model.index(row), hint)
+        scroll_bar.blockSignals(False)
+
+    def at_bottom(self):
+        scroll_bar = self.messages_area.verticalScrollBar()
+        return scroll_bar.value() == scroll_bar.maximum()
+
+    def open_media(self, index):
+        media_path = index.data(MessageModel.MessageRole).media_path
+        if media_path and os.path.exists(media_path):
+            QDesktopServices.openUrl(QUrl.fromLocalFile(os.path.abspath(media_path)))
+
+    def request_page(self, callback, before_id=None, after_id=None):
+        self.loading = True
+        self.db.submit('get_messages_page', self.user_id, self.chat_id, self.is_group, before_id, after_id,
+                       callback=callback, errback=self.on_page_failed)
+
+    def on_page_failed(self, error):
+        print(f"Error loading messages: {str(error)}")
+        self.loading = False
+
+    def finish_loading(self):
+        self.loading = False
+        if self.append_pending:
+            self.append_pending = False
+            self.append_new_messages()
+
+    def load_messages(self):
+        self.request_page(self.on_latest_page)
+
+    def load_around(self, message_id):
+        # Opens the conversation on a search hit: a page up to the message and a
+        # page after it, with the message highlighted in the middle.
+        self.messages_area.itemDelegate().highlighted_id = message_id
+        self.request_page(partial(self.on_focus_page, message_id), before_id=message_id + 1)
+
+    def on_focus_page(self, message_id, rows):
+        self.message_model.reset_messages(rows)
+        self.has_older = len(rows) == MESSAGE_PAGE_SIZE
+        self.request_page(partial(self.on_focus_newer_page, message_id), after_id=message_id)
+
+    def on_focus_newer_page(self, message_id, rows):
+        if rows:
+            self.message_model.append_messages(rows)
+        self.has_newer = len(rows) == MESSAGE_PAGE_SIZE
+        self.scroll_to(message_id, QListView.PositionAtCenter)
+        self.mark_read()
+        self.finish_loading()
+
+    @profiled('gui')
+    def on_latest_page(self, rows):
+        self.message_model.reset_messages(rows)
+        self.has_older = len(rows) == MESSAGE_PAGE_SIZE
+        self.has_newer = False
+        self.scroll_to()
+        self.mark_read()
+        self.finish_loading()
+
+        if self.has_older and self.messages_area.verticalScrollBar().maximum() == 0:
+            self.load_older_messages()
+
+    def on_scroll(self, value):
+        if self.loading:
+            return
+
+        scroll_bar = self.messages_area.verticalScrollBar()
+        if value == scroll_bar.minimum() and self.has_older:
+            self.load_older_messages()
+        elif value == scroll_bar.maximum() and self.has_newer:
+            self.load_newer_messages()
+
+    def load_older_messages(self):
+        self.request_page(self.on_older_page, before_id=self.first_message_id)
+
+    @profiled('gui')
+    def on_older_page(self, rows):
+        anchor_id = self.first_message_id
+        self.has_older = len(rows) == MESSAGE_PAGE_SIZE
+        if rows:
+            scroll_bar = self.messages_area.verticalScrollBar()
+            scroll_bar.blockSignals(True)
+            self.message_model.prepend_messages(rows)
+            excess = len(self.message_model.messages) - MAX_RENDERED_MESSAGES
+            if excess > 0:
+                self.message_model.trim_back(excess)
+                self.has_newer = True
+            scroll_bar.blockSignals(False)
+            self.scroll_to(anchor_id)
+        self.finish_loading()
+
+    def load_newer_messages(self):
+        self.request_page(self.on_newer_page, after_id=self.last_message_id)
+
+    @profiled('gui')
+    def on_newer_page(self, rows):
+        self.has_newer = len(rows) == MESSAGE_PAGE_SIZE
+        if rows:
+            scroll_bar = self.messages_area.verticalScrollBar()
+            scroll_bar.blockSignals(True)
+            self.message_model.append_messages(rows)
+            excess = len(self.message_model.messages) - MAX_RENDERED_MESSAGES
+            if excess > 0:
+                self.message_model.trim_front(excess)
+                self.has_older = True
+            scroll_bar.blockSignals(False)
+            self.scroll_to(rows[0].id)
+        self.mark_read()
+        self.finish_loading()
+
+    def append_new_messages(self):
+        if self.loading:
+            self.append_pending = True
+            return
+
+        if not self.at_bottom():
+            # The user is reading history; new rows are paged in when they scroll back down.
+            self.has_newer = True
+            return
+
+        self.request_page(self.on_appended_page, after_id=self.last_message_id)
+
+    @profiled('gui')
+    def on_appended_page(self, rows):
+        if rows:
+            self.has_newer = len(rows) == MESSAGE_PAGE_SIZE
+            scroll_bar = self.messages_area.verticalScrollBar()
+            scroll_bar.blockSignals(True)
+            self.message_model.append_messages(rows)
+            excess = len(self.message_model.messages) - MAX_RENDERED_MESSAGES
+            if excess > 0:
+                self.message_model.trim_front(excess)
+                self.has_older = True
+            scroll_bar.blockSignals(False)
+            self.scroll_to()
+            self.mark_read()
+            # A full page means more rows are waiting; keep following the tail.
+            self.append_pending = self.has_newer
+        self.finish_loading()
+
+    def mark_read(self):
+        if not self.has_newer and self.last_message_id:
+            self.db.submit('mark_read', self.user_id, self.chat_id, self.is_group, self.last_message_id,
+                           callback=self.on_marked_read)
+
+    def on_marked_read(self, result):
+        self.messages_read.emit()
 
-        scroll_bar.setValue(scroll_position)
     def attach_file(self):
         file_path, _ = QFileDialog.getOpenFileName(self, "Attach File")
         if file_path:
@@ -494,12 +1483,20 @@ class ChatWidget(QWidget):
             else:
                 media_type = 'file'
 
-            storage_dir = f"media/{media_type}s"
-            os.makedirs(storage_dir, exist_ok=True)
-            new_path = os.path.join(storage_dir, os.path.basename(file_path))
-            shutil.copy2(file_path, new_path)
+            self.upload_progress.setValue(0)
+            self.upload_progress.show()
+            MediaUploader.instance().upload(
+                file_path, partial(self.on_media_stored, media_type),
+                progress=self.upload_progress.setValue, errback=self.on_upload_failed,
+                thumbnail_sizes=(CHAT_IMAGE_SIZE,) if media_type == 'image' else ())
 
-            self.save_message(None, new_path, media_type)
+    def on_media_stored(self, media_type, media_path):
+        self.upload_progress.hide()
+        self.save_message(None, media_path, media_type)
+
+    def on_upload_failed(self, error):
+        self.upload_progress.hide()
+        QMessageBox.warning(self, "Error", f"Could not attach file: {error}")
 
     def send_message(self):
         content = self.message_input.text()
@@ -508,41 +1505,90 @@ class ChatWidget(QWidget):
             self.message_input.clear()
 
     def save_message(self, content, media_path=None, media_type=None):
-        timestamp = datetime.now()
+        if self.has_newer:
+            # Sending from history jumps back to the latest messages.
+            self.load_messages()
 
-        if self.is_group:
-            self.db.cur.execute("""
-                INSERT INTO messages (sender_id, group_id, content, media_path, media_type, timestamp)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (self.user_id, self.chat_id, content, media_path, media_type, timestamp))
+        # The message is shown straight away and replaced by the stored row when
+        # it comes back; the worker commits bursts of sends in one transaction.
+        pending_id = self.message_model.add_pending(content, media_path, media_type, self.username)
+        self.messages_area.scrollToBottom()
+        self.db.submit('save_message', self.user_id, self.chat_id, self.is_group, content, media_path, media_type,
+                       callback=partial(self.on_message_saved, pending_id),
+                       errback=partial(self.on_message_failed, pending_id))
+
+    def on_message_saved(self, pending_id, message_id):
+        self.message_model.confirm_pending(pending_id, message_id)
+        self.append_new_messages()
+
+    def on_message_failed(self, pending_id, error):
+        self.message_model.remove_pending(pending_id)
+        QMessageBox.warning(self, "Error", f"Could not send message: {error}")
+
+class ProfilerOverlay(QLabel):
+    # The slowest instrumented calls so far, drawn over the main window.
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        self.setStyleSheet("background-color: rgba(0, 0, 0, 200); color: #e0e0e0; padding: 6px;")
+        self.setAttribute(Qt.WidgetAttribute.WA_TransparentForMouseEvents)
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.hide()
+
+    def toggle(self):
+        if self.isVisible():
+            self.timer.stop()
+            self.hide()
         else:
-            self.db.cur.execute("""
-                INSERT INTO messages (sender_id, receiver_id, content, media_path, media_type, timestamp)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (self.user_id, self.chat_id, content, media_path, media_type, timestamp))
+            self.refresh()
+            self.show()
+            self.raise_()
+            self.timer.start(OVERLAY_INTERVAL)
 
-        self.db.conn.commit()
-        self.load_messages()
+    def refresh(self):
+        self.setText(instrumentation.summary())
+        self.adjustSize()
+        self.move(max(0, self.parent().width() - self.width() - 10), 10)
 
-    def closeEvent(self, event):
-        if hasattr(self, 'update_timer'):
-            self.update_timer.stop()
-        super().closeEvent(event)
 
 class MainWindow(QMainWindow):
-    def __init__(self):
+    def __init__(self, server=None):
         super().__init__()
-        self.db = Database()
+        if server:
+            self.db = RemoteDatabase(server)
+            self.background_db = None
+        else:
+            # Two workers on one service, each with its own connection, so
+            # archiving on the second never holds up the UI's requests.
+            service = instrumentation.instrument(ChatService(DATABASE_PATH), 'db')
+            self.db = DatabaseWorker(service)
+            self.background_db = DatabaseWorker(service)
+        self.db.start()
         self.init_ui()
         self.current_chat_widget = None
         self.current_user_id = None
         self.current_username = None
-        self.last_user_count = 0
-        self.notification_sound = QSound("notification.wav")
+        self.sidebar_refresh_pending = False
+        self.conversations = {}
+        self.notification_sound = None
+
+    def play_notification_sound(self):
+        # QtMultimedia is slow to load and to open the audio device, and some
+        # systems lack it, so it waits for the first notification.
+        if self.notification_sound is None:
+            try:
+                from PyQt5.QtMultimedia import QSound
+                self.notification_sound = QSound("notification.wav")
+            except ImportError as e:
+                print(f"Sound disabled: {str(e)}")
+                self.notification_sound = False
+        if self.notification_sound:
+            self.notification_sound.play()
 
     def show_notification(self, title, message):
         try:
-            self.notification_sound.play()
+            self.play_notification_sound()
         except Exception as e:
             print(f"Error playing sound: {str(e)}")
 
@@ -552,18 +1598,12 @@ class MainWindow(QMainWindow):
         msg.setIcon(QMessageBox.Information)
         msg.setStandardButtons(QMessageBox.Ok)
         msg.show()
-    def check_new_users(self):
-        try:
-            self.db.cur.execute("SELECT COUNT(*) FROM users")
-            current_user_count = self.db.cur.fetchone()[0]
-
-            if current_user_count > self.last_user_count:
-                self.load_users()
-                if self.last_user_count > 0:
-                    self.show_notification("New User", "A new user has joined the chat!")
-                self.last_user_count = current_user_count
-        except Exception as e:
-            print(f"Error checking new users: {str(e)}")
+    def on_user_added(self, user_id):
+        if not self.main_screen or user_id == self.current_user_id:
+            return
+        self.load_users()
+        self.show_notification("New User", "A new user has joined the chat!")
+
     def init_ui(self):
         self.setWindowTitle("Chat Application")
         self.setGeometry(100, 100, 800, 600)
@@ -578,40 +1618,42 @@ class MainWindow(QMainWindow):
 
         self.main_screen = None
 
-        self.user_check_timer = QTimer(self)
-        self.user_check_timer.timeout.connect(self.check_new_users)
-        self.user_check_timer.start(1000)
-
-        self.group_check_timer = QTimer(self)
-        self.group_check_timer.timeout.connect(self.check_new_groups)
-        self.group_check_timer.start(1000)
+        self.change_dispatcher = ChangeDispatcher(self.db, self)
+        self.change_dispatcher.user_added.connect(self.on_user_added)
+        self.change_dispatcher.group_member_added.connect(self.on_group_member_added)
+        self.change_dispatcher.message_added.connect(self.on_message_added)
+        self.archiver = Archiver(self.background_db, self)
+
+        if instrumentation.ENABLED:
+            # Developer tools, only built when CHAT_PROFILE is set.
+            self.profiler_overlay = ProfilerOverlay(self)
+            QShortcut(QKeySequence("Ctrl+Shift+P"), self, self.profiler_overlay.toggle)
+            if instrumentation.DUMP_PATH:
+                self.dump_timer = QTimer(self)
+                self.dump_timer.timeout.connect(instrumentation.dump)
+                self.dump_timer.start(instrumentation.DUMP_INTERVAL)
 
     def cleanup_current_chat(self):
         if self.current_chat_widget:
-            if hasattr(self.current_chat_widget, 'update_timer'):
-                self.current_chat_widget.update_timer.stop()
             self.chat_stack.removeWidget(self.current_chat_widget)
             self.current_chat_widget.deleteLater()
             self.current_chat_widget = None
 
-    def check_new_groups(self):
-        try:
-            self.db.cur.execute("""
-                SELECT COUNT(*) FROM groups g
-                JOIN group_members gm ON g.id = gm.group_id
-                WHERE gm.user_id = ?
-            """, (self.current_user_id,))
-            current_groups_count = self.db.cur.fetchone()[0]
-
-            if not hasattr(self, 'last_groups_count'):
-                self.last_groups_count = current_groups_count
-            elif current_groups_count > self.last_groups_count:
-                self.load_groups()
-                self.show_notification("New Group", "You've been added to a new group!")
-                self.last_groups_count = current_groups_count
-        except Exception as e:
-            print(f"Error checking new groups: {str(e)}")
-            
+    def on_group_member_added(self, group_id, user_id):
+        if not self.main_screen or user_id != self.current_user_id:
+            return
+        self.load_groups()
+        self.show_notification("New Group", "You've been added to a new group!")
+
+    def on_message_added(self, message_id, sender_id, receiver_id, group_id):
+        self.schedule_sidebar_refresh()
+
+    def schedule_sidebar_refresh(self):
+        if not self.main_screen or self.sidebar_refresh_pending:
+            return
+        self.sidebar_refresh_pending = True
+        QTimer.singleShot(0, self.refresh_sidebar)
+
     def set_current_user(self, user_id, username):
         self.current_user_id = user_id
         self.current_username = username
@@ -622,6 +1664,14 @@ class MainWindow(QMainWindow):
         self.stacked_widget.setCurrentWidget(self.main_screen)
 
     def create_main_screen(self):
+        # Nothing polls the database until someone has logged in; the first
+        # frame is only the login screen.
+        self.change_dispatcher.start()
+        # A server archives its own database.
+        if self.background_db:
+            self.background_db.start()
+            self.archiver.start()
+
         self.main_screen = QWidget()
         layout = QHBoxLayout()
 
@@ -645,6 +1695,17 @@ class MainWindow(QMainWindow):
         sidebar = QWidget()
         sidebar_layout = QVBoxLayout()
 
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText("Search messages")
+        self.search_input.returnPressed.connect(self.search_messages)
+        sidebar_layout.addWidget(self.search_input)
+
+        self.search_results = QListWidget()
+        self.search_results.setWordWrap(True)
+        self.search_results.itemClicked.connect(self.open_search_result)
+        self.search_results.hide()
+        sidebar_layout.addWidget(self.search_results)
+
         profile_btn = QPushButton("Set Profile Picture")
         profile_btn.setStyleSheet("padding: 5px;\n"
                                   "border: 1px solid;\n"
@@ -704,66 +1765,92 @@ class MainWindow(QMainWindow):
 
         self.main_screen.setLayout(layout)
         self.stacked_widget.addWidget(self.main_screen)
-        
-        self.message_check_timer = QTimer(self)
-        self.message_check_timer.timeout.connect(self.check_unread_messages)
-        self.message_check_timer.start(1000)
+        self.refresh_sidebar()
 
     def load_users(self):
+        self.db.submit('get_users', self.current_user_id, callback=self.populate_users)
+
+    @profiled('gui')
+    def populate_users(self, users):
         current_selection = self.users_list.currentItem()
         selected_user_id = current_selection.data(Qt.ItemDataRole.UserRole) if current_selection else None
 
         self.users_list.clear()
-        self.db.cur.execute("SELECT id, username FROM users WHERE id != ?", (self.current_user_id,))
-        for user_id, username in self.db.cur.fetchall():
-            item = QListWidgetItem(f"{username}")
-            item.setData(Qt.ItemDataRole.UserRole, user_id)
+        for user in users:
+            item = QListWidgetItem(f"{user.username}")
+            item.setData(Qt.ItemDataRole.UserRole, user.id)
+            item.setData(NAME_ROLE, user.username)
             self.users_list.addItem(item)
 
-            if user_id == selected_user_id:
+            if user.id == selected_user_id:
                 self.users_list.setCurrentItem(item)
+        self.apply_conversations(self.users_list, 'user')
+
     def load_groups(self):
+        self.db.submit('get_user_groups', self.current_user_id, callback=self.populate_groups)
+
+    @profiled('gui')
+    def populate_groups(self, groups):
         self.groups_list.clear()
-        self.db.cur.execute("""
-            SELECT g.id, g.name FROM groups g
-            JOIN group_members gm ON g.id = gm.group_id
-            WHERE gm.user_id = ?
-        """, (self.current_user_id,))
-        for group_id, name in self.db.cur.fetchall():
-            self.groups_list.addItem(f"{name}")
-            self.groups_list.item(self.groups_list.count() - 1).setData(Qt.ItemDataRole.UserRole, group_id)
+        for group in groups:
+            item = QListWidgetItem(f"{group.name}")
+            item.setData(Qt.ItemDataRole.UserRole, group.id)
+            item.setData(NAME_ROLE, group.name)
+            self.groups_list.addItem(item)
+        self.apply_conversations(self.groups_list, 'group')
 
     def open_chat(self, item):
-        try:
-            user_id = item.data(Qt.ItemDataRole.UserRole)
-
-            self.cleanup_current_chat()
-
-            chat_widget = ChatWidget(self.db, self.current_user_id, user_id)
-            self.current_chat_widget = chat_widget
-            self.chat_stack.addWidget(chat_widget)
-            self.chat_stack.setCurrentWidget(chat_widget)
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Error opening chat: {str(e)}")
+        self.open_conversation(item.data(Qt.ItemDataRole.UserRole), False)
 
     def open_group_chat(self, item):
-        try:
-            group_id = item.data(Qt.ItemDataRole.UserRole)
+        self.open_conversation(item.data(Qt.ItemDataRole.UserRole), True)
 
+    def open_conversation(self, chat_id, is_group, focus_message_id=None):
+        try:
             self.cleanup_current_chat()
 
-            chat_widget = ChatWidget(self.db, self.current_user_id, group_id, is_group=True)
+            chat_widget = ChatWidget(self.db, self.current_user_id, chat_id, is_group=is_group,
+                                     username=self.current_username, focus_message_id=focus_message_id)
+            self.change_dispatcher.message_added.connect(chat_widget.on_message_added)
+            chat_widget.messages_read.connect(self.schedule_sidebar_refresh)
             self.current_chat_widget = chat_widget
             self.chat_stack.addWidget(chat_widget)
             self.chat_stack.setCurrentWidget(chat_widget)
         except Exception as e:
-            QMessageBox.critical(self, "Error", f"Error opening group chat: {str(e)}")
+            chat_kind = "group chat" if is_group else "chat"
+            QMessageBox.critical(self, "Error", f"Error opening {chat_kind}: {str(e)}")
+
+    def search_messages(self):
+        text = self.search_input.text().strip()
+        if not text:
+            self.search_results.clear()
+            self.search_results.hide()
+            return
+        self.db.submit('search_messages', self.current_user_id, text, callback=self.show_search_results)
+
+    def show_search_results(self, hits):
+        self.search_results.clear()
+        for message_id, kind, chat_id, username, timestamp, snippet in hits:
+            item = QListWidgetItem(f"{username}: {snippet}")
+            item.setToolTip(str(timestamp))
+            item.setData(Qt.ItemDataRole.UserRole, (kind, chat_id, message_id))
+            self.search_results.addItem(item)
+        if not hits:
+            self.search_results.addItem(QListWidgetItem("No messages found"))
+        self.search_results.show()
+
+    def open_search_result(self, item):
+        hit = item.data(Qt.ItemDataRole.UserRole)
+        if hit:
+            kind, chat_id, message_id = hit
+            self.open_conversation(chat_id, kind == 'group', message_id)
 
     def show_posts(self):
         try:
             self.cleanup_current_chat()
 
             posts_widget = PostsWidget(self.db, self.current_user_id)
+            self.change_dispatcher.post_added.connect(posts_widget.on_post_created)
             self.current_chat_widget = posts_widget
             self.chat_stack.addWidget(posts_widget)
             self.chat_stack.setCurrentWidget(posts_widget)
@@ -772,76 +1859,75 @@ class MainWindow(QMainWindow):
 
     def closeEvent(self, event):
         self.cleanup_current_chat()
-        if hasattr(self, 'user_check_timer'):
-            self.user_check_timer.stop()
-        if hasattr(self, 'group_check_timer'):
-            self.group_check_timer.stop()
-        if hasattr(self, 'message_check_timer'):
-            self.message_check_timer.stop()
+        self.change_dispatcher.stop()
+        self.archiver.stop()
+        if self.background_db:
+            self.background_db.stop()
+        self.db.stop()
         super().closeEvent(event)
 
-    def check_unread_messages(self):
-        try:
-            for i in range(self.users_list.count()):
-                item = self.users_list.item(i)
-                user_id = item.data(Qt.ItemDataRole.UserRole)
-                username = item.text().split(" [")[0] 
-                self.db.cur.execute("""
-                    SELECT COUNT(*) FROM messages 
-                    WHERE sender_id = ? AND receiver_id = ? 
-                    AND id > COALESCE((
-                        SELECT MAX(id) FROM messages 
-                        WHERE (sender_id = ? AND receiver_id = ?) 
-                        OR (sender_id = ? AND receiver_id = ?)
-                    ), 0)
-                """, (user_id, self.current_user_id, self.current_user_id, user_id, user_id, self.current_user_id))
-            
-                unread_count = self.db.cur.fetchone()[0]
-                if unread_count > 0:
-                    item.setText(f"{username} [{unread_count}]")
-                else:
-                    item.setText(username)
-
-            for i in range(self.groups_list.count()):
-                item = self.groups_list.item(i)
-                group_id = item.data(Qt.ItemDataRole.UserRole)
-                group_name = item.text().split(" [")[0]
-
-                self.db.cur.execute("""
-                    SELECT COUNT(*) FROM messages 
-                    WHERE group_id = ? AND sender_id != ? 
-                    AND id > COALESCE((
-                        SELECT MAX(id) FROM messages 
-                        WHERE group_id = ? AND sender_id = ?
-                    ), 0)
-                """, (group_id, self.current_user_id, group_id, self.current_user_id))
-            
-                unread_count = self.db.cur.fetchone()[0]
-                if unread_count > 0:
-                    item.setText(f"{group_name} [{unread_count}]")
-                else:
-                    item.setText(group_name)
+    @profiled('timer')
+    def refresh_sidebar(self):
+        self.sidebar_refresh_pending = False
+        self.db.submit('get_conversations', self.current_user_id, callback=self.on_conversations,
+                       errback=self.on_conversations_failed)
+
+    @profiled('gui')
+    def on_conversations(self, conversations):
+        self.conversations = {(conversation.kind, conversation.chat_id): conversation
+                              for conversation in conversations}
+        self.apply_conversations(self.users_list, 'user')
+        self.apply_conversations(self.groups_list, 'group')
+
+    def on_conversations_failed(self, error):
+        print(f"Error loading conversations: {str(error)}")
+
+    def apply_conversations(self, list_widget, kind):
+        # Each item shows its unread count, with the last message as its
+        # tooltip. The most recently active chats move to the top; the rest
+        # keep their order below them.
+        items = [list_widget.item(i) for i in range(list_widget.count())]
+        activity = [0] * len(items)
+        for i, item in enumerate(items):
+            name = item.data(NAME_ROLE)
+            conversation = self.conversations.get((kind, item.data(Qt.ItemDataRole.UserRole)))
+            if conversation:
+                activity[i] = conversation.last_message_id
+                label = f"{name} [{conversation.unread}]" if conversation.unread > 0 else name
+                tooltip = f"{conversation.username}: {conversation.preview}"
+            else:
+                label, tooltip = name, ""
+            if item.text() != label:
+                item.setText(label)
+            if item.toolTip() != tooltip:
+                item.setToolTip(tooltip)
+
+        order = sorted(range(len(items)), key=lambda i: -activity[i])
+        if order != list(range(len(items))):
+            current = list_widget.currentItem()
+            for _ in items:
+                list_widget.takeItem(0)
+            for i in order:
+                list_widget.addItem(items[i])
+            if current:
+                list_widget.setCurrentItem(current)
 
-        except Exception as e:
-            print(f"Error checking unread messages: {str(e)}")
-        
     def show_profile_info(self):
-        try:
-            selected_item = self.users_list.currentItem()
-            if not selected_item:
-                QMessageBox.warning(self, "Warning", "Please select a user first.")
-                return
+        selected_item = self.users_list.currentItem()
+        if not selected_item:
+            QMessageBox.warning(self, "Warning", "Please select a user first.")
+            return
 
-            user_id = selected_item.data(Qt.ItemDataRole.UserRole)
-            self.db.cur.execute("""
-                SELECT username, telephone, profile_pic 
-                FROM users 
-                WHERE id = ?
-            """, (user_id,))
-        
-            user_info = self.db.cur.fetchone()
+        user_id = selected_item.data(Qt.ItemDataRole.UserRole)
+        self.db.submit('get_user_profile', user_id, callback=self.show_profile_dialog,
+                       errback=self.on_profile_failed)
+
+    def on_profile_failed(self, error):
+        QMessageBox.critical(self, "Error", f"Error showing profile info: {str(error)}")
+
+    def show_profile_dialog(self, user_info):
+        try:
             if user_info:
-                username, telephone, profile_pic = user_info
             
                 dialog = QDialog(self)
                 dialog.setWindowTitle("User Profile")
@@ -849,15 +1935,14 @@ class MainWindow(QMainWindow):
             
                 layout = QVBoxLayout()
             
-                if profile_pic and os.path.exists(profile_pic):
+                if user_info.profile_pic and os.path.exists(user_info.profile_pic):
                     pic_label = QLabel()
-                    pixmap = QPixmap(profile_pic)
-                    pic_label.setPixmap(pixmap.scaled(200, 200, Qt.AspectRatioMode.KeepAspectRatio))
+                    ImageLoader.instance().set_pixmap(pic_label, user_info.profile_pic, PROFILE_PIC_SIZE)
                     layout.addWidget(pic_label, alignment=Qt.AlignmentFlag.AlignCenter)
             
                 info_layout = QVBoxLayout()
-                info_layout.addWidget(QLabel(f"Username: {username}"))
-                info_layout.addWidget(QLabel(f"Telephone: {telephone}"))
+                info_layout.addWidget(QLabel(f"Username: {user_info.username}"))
+                info_layout.addWidget(QLabel(f"Telephone: {user_info.telephone}"))
             
                 layout.addLayout(info_layout)
                 dialog.setLayout(layout)
@@ -877,42 +1962,36 @@ class MainWindow(QMainWindow):
                     QMessageBox.warning(self, "Warning", "Please select at least one member for the group.")
                     return
 
-                try:
-                    self.db.cur.execute("INSERT INTO groups (name, created_by) VALUES (?, ?)",
-                                        (name, self.current_user_id))
-                    group_id = self.db.cur.lastrowid
-
-                    self.db.cur.execute("INSERT INTO group_members (group_id, user_id) VALUES (?, ?)",
-                                        (group_id, self.current_user_id))
+                self.db.submit('create_group', name, self.current_user_id, selected_members,
+                               callback=self.on_group_created, errback=self.on_group_create_failed)
 
-                    for member_id in selected_members:
-                        self.db.cur.execute("INSERT INTO group_members (group_id, user_id) VALUES (?, ?)",
-                                            (group_id, member_id))
-
-                    self.db.conn.commit()
-                    self.load_groups()
-                    QMessageBox.information(self, "Success", "Group created successfully!")
+    def on_group_created(self, group_id):
+        self.load_groups()
+        QMessageBox.information(self, "Success", "Group created successfully!")
 
-                except sqlite3.Error as e:
-                    self.db.conn.rollback()
-                    QMessageBox.critical(self, "Error", f"Failed to create group: {str(e)}")
+    def on_group_create_failed(self, error):
+        QMessageBox.critical(self, "Error", f"Failed to create group: {str(error)}")
 
     def set_profile_picture(self):
         file_path, _ = QFileDialog.getOpenFileName(self, "Select Profile Picture",
                                                    filter="Images (*.png *.jpg *.jpeg)")
         if file_path:
-            storage_dir = "profile_pictures"
-            os.makedirs(storage_dir, exist_ok=True)
-            new_path = os.path.join(storage_dir, f"profile_{self.current_user_id}{os.path.splitext(file_path)[1]}")
-            shutil.copy2(file_path, new_path)
+            MediaUploader.instance().upload(file_path, self.on_profile_picture_stored,
+                                            thumbnail_sizes=(AVATAR_SIZE, HEADER_PIC_SIZE, PROFILE_PIC_SIZE))
 
-            self.db.cur.execute("UPDATE users SET profile_pic = ? WHERE id = ?",
-                                (new_path, self.current_user_id))
-            self.db.conn.commit()
+    def on_profile_picture_stored(self, path):
+        self.db.submit('set_profile_pic', self.current_user_id, path)
 
 def main():
     app = QApplication(sys.argv)
-    window = MainWindow()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--server", default=os.environ.get("CHAT_SERVER"),
+                        help="chat_server address (host:port or unix:/path); defaults to opening chat_app.db directly")
+    args, _ = parser.parse_known_args(app.arguments()[1:])
+
+    QPixmapCache.setCacheLimit(PIXMAP_CACHE_KB)
+    instrumentation.dump_at_exit()
+    window = MainWindow(args.server)
     window.show()
     sys.exit(app.exec())
 
@@ -0,0 +1,45 @@
+import hashlib
+import os
+import tempfile
+
+MEDIA_DIR = 'media'
+CHUNK_SIZE = 1024 * 1024
+
+
+def blob_path(digest, ext, root=MEDIA_DIR):
+    return os.path.join(root, digest[:2], f"{digest}{ext.lower()}")
+
+
+def ingest(source_path, root=MEDIA_DIR, progress=None, chunk_size=CHUNK_SIZE):
+    # Copies the file into the store in one pass, hashing as it goes, and
+    # returns (stored_path, sha256). Blobs are named after their content, so a
+    # file that is already stored is not kept twice; callers record the
+    # reference in the database, which keeps media_blobs.refcount in step.
+    total = os.path.getsize(source_path)
+    os.makedirs(root, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=root, suffix='.part')
+    digest = hashlib.sha256()
+    done = 0
+    try:
+        with open(source_path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            for chunk in iter(lambda: src.read(chunk_size), b''):
+                digest.update(chunk)
+                dst.write(chunk)
+                done += len(chunk)
+                if progress:
+                    progress(done, total)
+
+        stored_path = blob_path(digest.hexdigest(), os.path.splitext(source_path)[1], root)
+        if os.path.exists(stored_path):
+            os.remove(temp_path)
+            # Touched so the media sweep sees it as new until the reference
+            # to it is written.
+            os.utime(stored_path)
+        else:
+            os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+            os.replace(temp_path, stored_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return stored_path, digest.hexdigest()
@@ -0,0 +1,73 @@
+from dataclasses import dataclass
+
+# Rows fetched per fetchmany() call when a result is streamed.
+FETCH_BATCH = 500
+
+
+# The rows the app passes around. With slots there is no per-instance
+# __dict__, so each record costs about what the tuple it replaces did.
+@dataclass(slots=True)
+class Message:
+    id: int
+    content: str
+    media_path: str
+    media_type: str
+    timestamp: str
+    username: str
+
+
+@dataclass(slots=True)
+class User:
+    id: int
+    username: str
+    telephone: str = None
+    profile_pic: str = None
+
+
+@dataclass(slots=True)
+class Group:
+    id: int
+    name: str
+
+
+@dataclass(slots=True)
+class Post:
+    id: int
+    content: str
+    media_path: str
+    media_type: str
+    timestamp: str
+    username: str
+    profile_pic: str
+
+
+@dataclass(slots=True)
+class Conversation:
+    # A sidebar entry: kind is 'user' or 'group' and chat_id the peer or
+    # group, as get_unread_counts keys them; username sent the last message.
+    kind: str
+    chat_id: int
+    last_message_id: int
+    username: str
+    preview: str
+    timestamp: str
+    unread: int
+
+
+# By name, for chat_protocol to rebuild records on the far side of a socket.
+RECORD_TYPES = {record.__name__: record for record in (Message, User, Group, Post, Conversation)}
+
+
+def stream(cursor, to_records, batch_size=FETCH_BATCH):
+    # Yields the records for an executed cursor a batch at a time, so only one
+    # batch of raw rows is held however large the result is. to_records turns
+    # a list of rows into a list of records.
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from to_records(rows)
+
+
+def fields(record):
+    return [getattr(record, name) for name in record.__slots__]
@@ -0,0 +1,626 @@
+import math
+import re
+import sqlite3
+import threading
+import unicodedata
+from datetime import datetime
+
+from archive import (ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH, MEDIA_GRACE, VACUUM_PAGES, Archives, archive_cutoff,
+                     collect_media, compact, conversation_key)
+from database import ConnectionPool, DATABASE_PATH
+from directory import Directory
+from records import FETCH_BATCH, Conversation, Group, Message, Post, User, stream
+
+MESSAGE_PAGE_SIZE = 50
+POST_PAGE_SIZE = 20
+SEARCH_PAGE_SIZE = 20
+# Search ranks matches a window of this many at a time, newest window first,
+# and later pages run on into older windows. Common words then never rank
+# every matching row in the database, and the window bounds how much of a
+# word's index one page reads: at 5M messages, 1000 took up to 70 ms, 250
+# stays under 35 ms.
+SEARCH_CANDIDATES = 250
+SNIPPET_WORDS = 12
+SEARCH_WORD = re.compile(r'\w+')
+CHANGE_FEED_RETENTION = 10000
+
+
+def fts_query(text):
+    # Every word is quoted so user input is matched literally rather than
+    # parsed as FTS5 query syntax; the words are ANDed together.
+    return " ".join('"{}"'.format(word.replace('"', '""')) for word in text.split())
+
+
+def search_words(text):
+    # Close to what the unicode61 tokenizer indexes: case-folded words with
+    # diacritics removed.
+    text = text.casefold()
+    if not text.isascii():
+        text = "".join(ch for ch in unicodedata.normalize('NFKD', text) if not unicodedata.combining(ch))
+    return SEARCH_WORD.findall(text)
+
+
+def rank_hits(candidates, text, k1=1.2, b=0.75):
+    # Orders the (id, content) candidate window by BM25, best first. FTS5's bm25()
+    # takes document frequencies from the whole index, which means reading the
+    # full doclist of a common word on every search; scoring the window keeps
+    # the cost bounded by SEARCH_CANDIDATES.
+    if not candidates:
+        return []
+    terms = list(set(search_words(text)))
+    documents = []
+    for row_id, content in candidates:
+        words = search_words(content or "")
+        documents.append((row_id, len(words), [words.count(term) for term in terms]))
+
+    average_length = sum(length for _, length, _ in documents) / len(documents) or 1
+    idf = []
+    for i in range(len(terms)):
+        count = sum(1 for _, _, tfs in documents if tfs[i])
+        idf.append(math.log((len(documents) - count + 0.5) / (count + 0.5) + 1))
+
+    scores = []
+    for row_id, length, tfs in documents:
+        norm = k1 * (1 - b + b * length / average_length)
+        score = sum(weight * tf * (k1 + 1) / (tf + norm) for weight, tf in zip(idf, tfs) if tf)
+        scores.append((-score, -row_id))
+    contents = dict(candidates)
+    return [(-row_id, contents[-row_id]) for _, row_id in sorted(scores)]
+
+
+def search_snippet(content, text, size=SNIPPET_WORDS):
+    # What FTS5's snippet() gives, cut from content already in hand rather
+    # than by another query per hit: the size words with the most matches,
+    # the matches in brackets and "..." where the content was cut.
+    content = content or ""
+    terms = set(search_words(text))
+    tokens = list(SEARCH_WORD.finditer(content))
+    if not tokens:
+        return content
+    matched = [not terms.isdisjoint(search_words(token.group())) for token in tokens]
+    counts = [sum(matched[i:i + size]) for i in range(max(1, len(tokens) - size + 1))]
+    start = counts.index(max(counts))
+    end = min(len(tokens), start + size)
+
+    parts = ["..." if start else content[:tokens[0].start()]]
+    position = tokens[start].start()
+    for token, hit in zip(tokens[start:end], matched[start:end]):
+        parts.append(content[position:token.start()])
+        parts.append(f"[{token.group()}]" if hit else token.group())
+        position = token.end()
+    parts.append("..." if end < len(tokens) else content[position:])
+    return "".join(parts)
+
+
+def scoped_fts_query(text, user_id, group_ids):
+    words = fts_query(text)
+    if not words:
+        return None
+    scopes = " OR ".join([f"u{user_id}"] + [f"g{group_id}" for group_id in group_ids])
+    return f"content : ({words}) AND search_scope : ({scopes})"
+
+
+def check_message(content, media_path):
+    if not content and not media_path:
+        raise ValueError("message has no content or media")
+
+
+def conversation_filter(user_id, chat_id, is_group):
+    if is_group:
+        return "m.group_id = ?", [chat_id]
+    return ("((m.sender_id = ? AND m.receiver_id = ?) OR (m.sender_id = ? AND m.receiver_id = ?))",
+            [user_id, chat_id, chat_id, user_id])
+
+
+def export_line(message):
+    line = f"[{message.timestamp}] {message.username}: {message.content or ''}"
+    if message.media_path:
+        line += f" [{message.media_type}: {message.media_path}]"
+    return line + "\n"
+
+
+class ChatRepository:
+    # Every query the app runs, against one Database connection. The SQL is
+    # fixed text with ? parameters, so sqlite3 prepares each statement once
+    # and reuses it from the connection's statement cache. Names, pictures
+    # and memberships come from the directory rather than a JOIN on users.
+    # Messages and posts old enough to be archived are read from the month
+    # archives once the main tables run out.
+    def __init__(self, db, directory):
+        self.db = db
+        self.conn = db.conn
+        self.directory = directory
+        self.archives = Archives(self.conn)
+
+    def message_records(self, rows):
+        # A plain dict lookup per row; only a sender the directory has not
+        # seen yet goes back to the database.
+        usernames = self.directory.usernames
+        return [Message(message_id, content, media_path, media_type, timestamp,
+                        usernames.get(sender_id) or self.directory.username(self.conn, sender_id))
+                for message_id, content, media_path, media_type, timestamp, sender_id in rows]
+
+    def post_records(self, rows):
+        users = self.directory.users
+        posts = []
+        for post_id, content, media_path, media_type, timestamp, user_id in rows:
+            user = users.get(user_id) or self.directory.user(self.conn, user_id)
+            posts.append(Post(post_id, content, media_path, media_type, timestamp, user and user.username,
+                              user and user.profile_pic))
+        return posts
+
+    def get_messages_page(self, user_id, chat_id, is_group, before_id=None, after_id=None,
+                          limit=MESSAGE_PAGE_SIZE):
+        # Keyset pagination on messages.id; rows are always returned oldest first.
+        where, params = conversation_filter(user_id, chat_id, is_group)
+        if after_id is not None:
+            where += " AND m.id > ?"
+            params.append(after_id)
+            order = "ASC"
+        else:
+            if before_id is not None:
+                where += " AND m.id < ?"
+                params.append(before_id)
+            order = "DESC"
+
+        self.directory.refresh(self.conn)
+        query = f"""
+            SELECT m.id, m.content, m.media_path, m.media_type, m.timestamp, m.sender_id
+            FROM {{schema}}.messages m
+            WHERE {where}{{bound}}
+            ORDER BY m.id {order}
+            LIMIT ?
+        """
+        key = conversation_key(user_id, chat_id, is_group)
+
+        def archived(months, count):
+            rows = []
+            unarchived_id = self.archives.first_unarchived_id('messages')
+            for month in months:
+                schema = self.archives.attach(month)
+                rows += self.conn.execute(query.format(schema=schema, bound=" AND m.id < ?"),
+                                          (*params, unarchived_id, count - len(rows))).fetchall()
+                if len(rows) == count:
+                    break
+            return rows
+
+        if order == "DESC":
+            # Going back in time the main table comes first, and the archives
+            # are only read when it runs out.
+            rows = self.conn.execute(query.format(schema='main', bound=""), (*params, limit)).fetchall()
+            if len(rows) < limit:
+                rows += archived(self.archives.conversation_months(key, before_id=before_id), limit - len(rows))
+        else:
+            rows = archived(self.archives.conversation_months(key, after_id=after_id, newest_first=False), limit)
+            if len(rows) < limit:
+                rows += self.conn.execute(query.format(schema='main', bound=""),
+                                          (*params, limit - len(rows))).fetchall()
+        messages = self.message_records(rows)
+        if order == "DESC":
+            messages.reverse()
+        return messages
+
+    def iter_conversation(self, user_id, chat_id, is_group, batch_size=FETCH_BATCH):
+        # Every message in a conversation, oldest first: the archived months,
+        # then the main table. Each runs on a cursor of its own, so other
+        # queries can use the shared one in between batches.
+        where, params = conversation_filter(user_id, chat_id, is_group)
+        self.directory.refresh(self.conn)
+        query = f"""
+            SELECT m.id, m.content, m.media_path, m.media_type, m.timestamp, m.sender_id
+            FROM messages m
+            WHERE {where}{{bound}}
+            ORDER BY m.id
+        """
+        key = conversation_key(user_id, chat_id, is_group)
+        unarchived_id = self.archives.first_unarchived_id('messages')
+        for month in self.archives.conversation_months(key, newest_first=False):
+            archive = self.archives.open(month)
+            try:
+                yield from stream(archive.execute(query.format(bound=" AND m.id < ?"), (*params, unarchived_id)),
+                                  self.message_records, batch_size)
+            finally:
+                archive.close()
+        cursor = self.conn.execute(query.format(bound=""), params)
+        try:
+            yield from stream(cursor, self.message_records, batch_size)
+        finally:
+            cursor.close()
+
+    def latest_change_id(self):
+        return self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM changes").fetchone()[0]
+
+    def get_changes(self, after_id, limit=1000):
+        return self.conn.execute("""
+            SELECT id, kind, row_id, user_id, peer_id, group_id
+            FROM changes
+            WHERE id > ?
+            ORDER BY id
+            LIMIT ?
+        """, (after_id, limit)).fetchall()
+
+    def prune_changes(self, keep=CHANGE_FEED_RETENTION):
+        self.conn.execute("DELETE FROM changes WHERE id <= (SELECT MAX(id) FROM changes) - ?", (keep,))
+        self.conn.commit()
+
+    # Archiving and compaction
+    def archive_step(self, cutoff, batch=ARCHIVE_BATCH):
+        return self.archives.archive_step(cutoff, batch)
+
+    def collect_media(self, grace=MEDIA_GRACE):
+        return collect_media(self.conn, grace=grace)
+
+    def compact(self, pages=VACUUM_PAGES):
+        return compact(self.conn, pages)
+
+    def mark_read(self, user_id, chat_id, is_group, message_id):
+        peer_id, group_id = (0, chat_id) if is_group else (chat_id, 0)
+        self.conn.execute("""
+            INSERT INTO read_receipts (user_id, peer_id, group_id, last_read_id)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (user_id, peer_id, group_id)
+            DO UPDATE SET last_read_id = MAX(last_read_id, excluded.last_read_id)
+        """, (user_id, peer_id, group_id, message_id))
+        self.conn.commit()
+
+    def get_conversations(self, user_id):
+        # The sidebar in one read of the summary the message triggers keep,
+        # most recent activity first.
+        rows = self.conn.execute("""
+            SELECT peer_id, group_id, last_message_id, last_sender_id, preview, last_timestamp, unread
+            FROM conversations
+            WHERE user_id = ?
+            ORDER BY last_message_id DESC
+        """, (user_id,)).fetchall()
+        self.directory.refresh(self.conn)
+        usernames = self.directory.usernames
+        return [Conversation('group' if group_id else 'user', group_id or peer_id, message_id,
+                             usernames.get(sender_id) or self.directory.username(self.conn, sender_id),
+                             preview, timestamp, unread)
+                for peer_id, group_id, message_id, sender_id, preview, timestamp, unread in rows]
+
+    def get_unread_counts(self, user_id):
+        rows = self.conn.execute("""
+            SELECT peer_id, group_id, unread FROM conversations
+            WHERE user_id = ? AND unread > 0
+        """, (user_id,))
+        return {('group', group_id) if group_id else ('user', peer_id): unread
+                for peer_id, group_id, unread in rows}
+
+    def get_user_credentials(self, username):
+        return self.conn.execute("SELECT id, password FROM users WHERE username = ?", (username,)).fetchone()
+
+    def create_user(self, username, password_hash, telephone):
+        try:
+            cursor = self.conn.execute("INSERT INTO users (username, password, telephone) VALUES (?, ?, ?)",
+                                       (username, password_hash, telephone))
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        return cursor.lastrowid
+
+    def set_password(self, user_id, password_hash):
+        self.conn.execute("UPDATE users SET password = ? WHERE id = ?", (password_hash, user_id))
+        self.conn.commit()
+
+    def get_users(self, exclude_user_id):
+        self.directory.refresh(self.conn)
+        return [User(user.id, user.username) for user_id, user in sorted(self.directory.users.items())
+                if user_id != exclude_user_id]
+
+    def get_user_profile(self, user_id):
+        self.directory.refresh(self.conn)
+        return self.directory.users.get(user_id)
+
+    def set_profile_pic(self, user_id, path):
+        self.conn.execute("UPDATE users SET profile_pic = ? WHERE id = ?", (path, user_id))
+        self.conn.commit()
+
+    def get_group_name(self, group_id):
+        self.directory.refresh(self.conn)
+        return self.directory.group_name(self.conn, group_id)
+
+    def get_user_groups(self, user_id):
+        self.directory.refresh(self.conn)
+        group_ids = sorted(self.directory.user_groups.get(user_id, ()))
+        return [Group(group_id, self.directory.groups[group_id]) for group_id in group_ids]
+
+    def is_member(self, user_id, group_id):
+        self.directory.refresh(self.conn)
+        return group_id in self.directory.user_groups.get(user_id, ())
+
+    def member_groups(self, user_ids):
+        # {user_id: set of group ids} for the given users, as of now.
+        self.directory.refresh(self.conn)
+        return {user_id: set(self.directory.user_groups.get(user_id, ())) for user_id in user_ids}
+
+    def create_group(self, name, created_by, member_ids):
+        try:
+            group_id = self.conn.execute("INSERT INTO groups (name, created_by) VALUES (?, ?)",
+                                         (name, created_by)).lastrowid
+            self.conn.executemany("INSERT INTO group_members (group_id, user_id) VALUES (?, ?)",
+                                  [(group_id, user_id) for user_id in [created_by, *member_ids]])
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        return group_id
+
+    def save_message(self, sender_id, chat_id, is_group, content, media_path=None, media_type=None):
+        receiver_id, group_id = (None, chat_id) if is_group else (chat_id, None)
+        cursor = self.conn.execute("""
+            INSERT INTO messages (sender_id, receiver_id, group_id, content, media_path, media_type, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (sender_id, receiver_id, group_id, content, media_path, media_type, datetime.now()))
+        self.conn.commit()
+        return cursor.lastrowid
+
+    def save_messages(self, messages):
+        # Inserts (sender_id, chat_id, is_group, content, media_path, media_type)
+        # tuples in a single transaction and returns their ids. The ids are
+        # consecutive because the write lock is held from the first insert
+        # until the commit.
+        now = datetime.now()
+        rows = [(sender_id, None if is_group else chat_id, chat_id if is_group else None,
+                 content, media_path, media_type, now)
+                for sender_id, chat_id, is_group, content, media_path, media_type in messages]
+        try:
+            self.conn.executemany("""
+                INSERT INTO messages (sender_id, receiver_id, group_id, content, media_path, media_type, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+            last_id = self.conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        return list(range(last_id - len(rows) + 1, last_id + 1))
+
+    def get_posts_page(self, before_id=None, after_id=None, limit=POST_PAGE_SIZE):
+        # Newest first. after_id pages forward through the posts made since
+        # the feed was loaded: the limit posts right after it, so paging on
+        # from the newest one returned skips none.
+        order = "DESC"
+        if after_id is not None:
+            where, params, order = "sp.id > ?", (after_id,), "ASC"
+        elif before_id is not None:
+            where, params = "sp.id < ?", (before_id,)
+        else:
+            where, params = "1", ()
+
+        self.directory.refresh(self.conn)
+        query = f"""
+            SELECT sp.id, sp.content, sp.media_path, sp.media_type, sp.timestamp, sp.user_id
+            FROM {{schema}}.status_posts sp
+            WHERE {where}{{bound}}
+            ORDER BY sp.id {order}
+            LIMIT ?
+        """
+        rows = self.conn.execute(query.format(schema='main', bound=""), (*params, limit)).fetchall()
+        if order == "ASC":
+            rows.reverse()
+        if len(rows) < limit and after_id is None:
+            unarchived_id = self.archives.first_unarchived_id('status_posts')
+            for month in self.archives.post_months(before_id):
+                schema = self.archives.attach(month)
+                rows += self.conn.execute(query.format(schema=schema, bound=" AND sp.id < ?"),
+                                          (*params, unarchived_id, limit - len(rows))).fetchall()
+                if len(rows) == limit:
+                    break
+        return self.post_records(rows)
+
+    def create_post(self, user_id, content, media_path=None, media_type=None):
+        cursor = self.conn.execute("""
+            INSERT INTO status_posts (user_id, content, media_path, media_type, timestamp)
+            VALUES (?, ?, ?, ?, ?)
+        """, (user_id, content, media_path, media_type, datetime.now()))
+        self.conn.commit()
+        return cursor.lastrowid
+
+    def search_messages(self, user_id, text, limit=SEARCH_PAGE_SIZE, offset=0):
+        # Returns (message_id, 'user'|'group', chat_id, username, timestamp, snippet)
+        # for messages the user sent, received or can read as a group member,
+        # best BM25 match first.
+        self.directory.refresh(self.conn)
+        query = scoped_fts_query(text, user_id, sorted(self.directory.user_groups.get(user_id, ())))
+        if not query:
+            return []
+
+        # Only the page being returned is looked up, one rowid seek per hit,
+        # and its snippets are cut from the content ranking already read.
+        hits = []
+        for message_id, content in self.ranked_page('messages', 'messages_fts', query, text, limit, offset):
+            rows = self.conn.execute("""
+                SELECT CASE WHEN group_id IS NOT NULL THEN 'group' ELSE 'user' END,
+                       CASE WHEN group_id IS NOT NULL THEN group_id
+                            WHEN sender_id = ? THEN receiver_id
+                            ELSE sender_id END,
+                       sender_id, timestamp
+                FROM messages WHERE id = ?
+            """, (user_id, message_id))
+            for kind, chat_id, sender_id, timestamp in rows:
+                hits.append((message_id, kind, chat_id, self.directory.username(self.conn, sender_id),
+                             timestamp, search_snippet(content, text)))
+        return hits
+
+    def ranked_page(self, table, fts_table, query, text, limit, offset):
+        # The (id, content) rows of one page of results. BM25 ranks each window of
+        # SEARCH_CANDIDATES matches on its own, newest window first, and
+        # offset runs on through the windows in that order. So a strong old
+        # match comes after the weaker matches of a newer window, but paging
+        # reaches every match; each window further back costs a little more.
+        page = []
+        window, skip = divmod(offset, SEARCH_CANDIDATES)
+        while len(page) < limit:
+            candidates = self.conn.execute(f"""
+                SELECT id, content FROM {table}
+                WHERE id IN (
+                    SELECT rowid FROM {fts_table}
+                    WHERE {fts_table} MATCH ?
+                    ORDER BY rowid DESC
+                    LIMIT ? OFFSET ?
+                )
+            """, (query, SEARCH_CANDIDATES, window * SEARCH_CANDIDATES)).fetchall()
+            page += rank_hits(candidates, text)[skip:skip + limit - len(page)]
+            if len(candidates) < SEARCH_CANDIDATES:
+                break
+            window, skip = window + 1, 0
+        return page
+
+    def search_posts(self, text, limit=SEARCH_PAGE_SIZE, offset=0):
+        # Posts are public, so every match is visible. Returns
+        # (post_id, username, timestamp, snippet), best match first.
+        query = fts_query(text)
+        if not query:
+            return []
+
+        self.directory.refresh(self.conn)
+        hits = []
+        for post_id, content in self.ranked_page('status_posts', 'posts_fts', query, text, limit, offset):
+            rows = self.conn.execute("SELECT user_id, timestamp FROM status_posts WHERE id = ?", (post_id,))
+            for user_id, timestamp in rows:
+                hits.append((post_id, self.directory.username(self.conn, user_id), timestamp,
+                             search_snippet(content, text)))
+        return hits
+
+
+class ChatService:
+    # The operations the GUI's DatabaseWorkers, chat_server and the benchmarks
+    # call by name. Writes are checked here before they reach SQL. A service
+    # can be shared between threads: each thread that calls it gets its own
+    # connection from the pool, and a repository on that connection.
+    def __init__(self, path=DATABASE_PATH, schema_version=None, pragmas=None):
+        self.pool = ConnectionPool(path, schema_version, pragmas)
+        self.directory = Directory.for_path(path)
+        self.local = threading.local()
+
+    @property
+    def db(self):
+        return self.pool.database()
+
+    @property
+    def repository(self):
+        repository = getattr(self.local, 'repository', None)
+        if repository is None or repository.db is not self.db:
+            repository = self.local.repository = ChatRepository(self.db, self.directory)
+        return repository
+
+    def close(self):
+        # Closes the calling thread's connection.
+        self.pool.close()
+
+    def close_all(self):
+        self.pool.close_all()
+
+    # Change feed
+    def latest_change_id(self):
+        return self.repository.latest_change_id()
+
+    def get_changes(self, after_id, limit=1000):
+        return self.repository.get_changes(after_id, limit)
+
+    def prune_changes(self, keep=CHANGE_FEED_RETENTION):
+        self.repository.prune_changes(keep)
+
+    # Archiving and compaction, run a step at a time so that other requests
+    # get the connection in between. Each returns 0 once there is no more to do.
+    def archive_step(self, max_age_days=ARCHIVE_AFTER_DAYS, batch=ARCHIVE_BATCH):
+        if max_age_days <= 0:
+            return 0
+        return self.repository.archive_step(archive_cutoff(max_age_days), batch)
+
+    def collect_media(self, grace=MEDIA_GRACE):
+        return self.repository.collect_media(grace)
+
+    def compact(self, pages=VACUUM_PAGES):
+        return self.repository.compact(pages)
+
+    # Accounts and profiles
+    def get_user_credentials(self, username):
+        return self.repository.get_user_credentials(username)
+
+    def create_user(self, username, password_hash, telephone):
+        if not username.strip():
+            raise ValueError("username is empty")
+        return self.repository.create_user(username, password_hash, telephone)
+
+    def set_password(self, user_id, password_hash):
+        self.repository.set_password(user_id, password_hash)
+
+    def get_users(self, exclude_user_id):
+        return self.repository.get_users(exclude_user_id)
+
+    def get_user_profile(self, user_id):
+        return self.repository.get_user_profile(user_id)
+
+    def set_profile_pic(self, user_id, path):
+        self.repository.set_profile_pic(user_id, path)
+
+    # Groups
+    def get_group_name(self, group_id):
+        return self.repository.get_group_name(group_id)
+
+    def get_user_groups(self, user_id):
+        return self.repository.get_user_groups(user_id)
+
+    def is_member(self, user_id, group_id):
+        return self.repository.is_member(user_id, group_id)
+
+    def member_groups(self, user_ids):
+        return self.repository.member_groups(user_ids)
+
+    def create_group(self, name, created_by, member_ids):
+        if not name.strip():
+            raise ValueError("group name is empty")
+        member_ids = [user_id for user_id in dict.fromkeys(member_ids) if user_id != created_by]
+        return self.repository.create_group(name, created_by, member_ids)
+
+    # Messages
+    def get_messages_page(self, user_id, chat_id, is_group, before_id=None, after_id=None,
+                          limit=MESSAGE_PAGE_SIZE):
+        return self.repository.get_messages_page(user_id, chat_id, is_group, before_id, after_id, limit)
+
+    def save_message(self, sender_id, chat_id, is_group, content, media_path=None, media_type=None):
+        check_message(content, media_path)
+        return self.repository.save_message(sender_id, chat_id, is_group, content, media_path, media_type)
+
+    def save_messages(self, messages):
+        for _, _, _, content, media_path, _ in messages:
+            check_message(content, media_path)
+        return self.repository.save_messages(messages)
+
+    def export_conversation(self, user_id, chat_id, is_group, path):
+        # Written as the rows stream in, so memory stays flat however long the
+        # conversation is. Returns the number of messages written.
+        count = 0
+        with open(path, 'w', encoding='utf-8') as f:
+            for message in self.repository.iter_conversation(user_id, chat_id, is_group):
+                f.write(export_line(message))
+                count += 1
+        return count
+
+    def mark_read(self, user_id, chat_id, is_group, message_id):
+        self.repository.mark_read(user_id, chat_id, is_group, message_id)
+
+    def get_unread_counts(self, user_id):
+        return self.repository.get_unread_counts(user_id)
+
+    def get_conversations(self, user_id):
+        return self.repository.get_conversations(user_id)
+
+    # Feed
+    def get_posts_page(self, before_id=None, after_id=None, limit=POST_PAGE_SIZE):
+        return self.repository.get_posts_page(before_id, after_id, limit)
+
+    def create_post(self, user_id, content, media_path=None, media_type=None):
+        if not content and not media_path:
+            raise ValueError("post has no content or media")
+        return self.repository.create_post(user_id, content, media_path, media_type)
+
+    # Search
+    def search_messages(self, user_id, text, limit=SEARCH_PAGE_SIZE, offset=0):
+        return self.repository.search_messages(user_id, text, limit, offset)
+
+    def search_posts(self, text, limit=SEARCH_PAGE_SIZE, offset=0):
+        return self.repository.search_posts(text, limit, offset)
@@ -0,0 +1,109 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from archive import collect_media  # noqa: E402
+from repository import ChatService  # noqa: E402
+
+OLD = '2020-01-15 12:00:00'
+
+
+class ArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.service = ChatService(os.path.join(self.dir, 'chat.db'))
+        self.addCleanup(self.service.close)
+        self.alice = self.service.create_user('alice', b'x', '1')
+        self.bob = self.service.create_user('bob', b'x', '2')
+
+    def archive_all(self):
+        while self.service.archive_step(max_age_days=1):
+            pass
+
+    def test_ids_are_not_reused_after_archiving_everything(self):
+        sent = [self.service.save_message(self.alice, self.bob, False, f"old {n}") for n in range(5)]
+        self.service.db.conn.execute("UPDATE messages SET timestamp = ?", (OLD,))
+        self.service.db.conn.commit()
+        self.service.mark_read(self.bob, self.alice, False, sent[-1])
+        self.archive_all()
+
+        new_id = self.service.save_message(self.alice, self.bob, False, "new")
+        self.assertGreater(new_id, max(sent))
+        ids = [message.id for message in self.service.get_messages_page(self.bob, self.alice, False)]
+        self.assertEqual(ids, [*sent, new_id])
+        self.assertEqual(self.service.get_unread_counts(self.bob), {('user', self.alice): 1})
+
+    def test_interrupted_move_is_read_once_and_finished_later(self):
+        sent = [self.service.save_message(self.alice, self.bob, False, f"old {n}") for n in range(5)]
+        conn = self.service.db.conn
+        conn.execute("UPDATE messages SET timestamp = ?", (OLD,))
+        conn.commit()
+        self.assertEqual(self.service.archive_step(max_age_days=1, batch=2), 2)
+        # The delete from main fails after the copy to the archive committed.
+        conn.execute("CREATE TEMP TRIGGER fail_delete BEFORE DELETE ON messages "
+                     "BEGIN SELECT RAISE(ABORT, 'interrupted'); END")
+        with self.assertRaises(sqlite3.Error):
+            self.service.archive_step(max_age_days=1, batch=2)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM archive_2020_01.messages").fetchone()[0], 4)
+
+        page = [message.id for message in self.service.get_messages_page(self.bob, self.alice, False)]
+        self.assertEqual(page, sent)
+        exported = self.service.repository.iter_conversation(self.bob, self.alice, False)
+        self.assertEqual([message.id for message in exported], sent)
+
+        conn.execute("DROP TRIGGER fail_delete")
+        self.archive_all()
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM main.messages").fetchone()[0], 1)
+        page = [message.id for message in self.service.get_messages_page(self.bob, self.alice, False)]
+        self.assertEqual(page, sent)
+
+    def test_collect_media_stays_in_the_database_directory(self):
+        conn = self.service.db.conn
+        elsewhere = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, elsewhere)
+        names = {'unused': os.path.join('media', 'ab', 'unused.jpg'),
+                 'used': os.path.join('media', 'ab', 'used.jpg'),
+                 'outside': os.path.join(elsewhere, 'picked.jpg')}
+        for name in names.values():
+            full_path = os.path.join(self.dir, name)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            open(full_path, 'wb').close()
+        conn.executemany("INSERT INTO media_blobs (path, refcount) VALUES (?, ?)",
+                         [(names['unused'], 0), (names['used'], 1), (names['outside'], 0)])
+        conn.commit()
+
+        # The same relative names under the current directory are not this
+        # database's files.
+        cwd = os.getcwd()
+        os.chdir(elsewhere)
+        self.addCleanup(os.chdir, cwd)
+        os.makedirs(os.path.join('media', 'ab'))
+        open(names['unused'], 'wb').close()
+
+        self.assertEqual(collect_media(conn, grace=0), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.dir, names['unused'])))
+        self.assertTrue(os.path.exists(os.path.join(self.dir, names['used'])))
+        self.assertTrue(os.path.exists(names['outside']))
+        self.assertTrue(os.path.exists(os.path.join(elsewhere, names['unused'])))
+        self.assertEqual(conn.execute("SELECT path FROM media_blobs").fetchall(), [(names['used'],)])
+
+    def test_collect_media_keeps_recent_files(self):
+        conn = self.service.db.conn
+        name = os.path.join('media', 'cd', 'fresh.jpg')
+        os.makedirs(os.path.join(self.dir, 'media', 'cd'))
+        open(os.path.join(self.dir, name), 'wb').close()
+        conn.execute("INSERT INTO media_blobs (path, refcount) VALUES (?, 0)", (name,))
+        conn.commit()
+        self.assertEqual(collect_media(conn, grace=time.time()), 0)
+        self.assertTrue(os.path.exists(os.path.join(self.dir, name)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from repository import ChatService  # noqa: E402
+
+
+class SearchTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.service = ChatService(os.path.join(self.dir, 'chat.db'))
+        self.addCleanup(self.service.close)
+        self.alice = self.service.create_user('alice', b'x', '1')
+        self.bob = self.service.create_user('bob', b'x', '2')
+
+    @mock.patch('repository.SEARCH_CANDIDATES', 10)
+    def test_paging_reaches_matches_past_the_first_window(self):
+        sent = [self.service.save_message(self.alice, self.bob, False, "hello " * (n % 3 + 1) + "there")
+                for n in range(25)]
+        self.service.save_message(self.alice, self.bob, False, "goodbye")
+
+        found = []
+        for offset in range(0, 35, 7):
+            found += [hit[0] for hit in self.service.search_messages(self.bob, "hello", limit=7, offset=offset)]
+        self.assertEqual(sorted(found), sent)
+        # The newest window is ranked first.
+        self.assertEqual(set(found[:10]), set(sent[-10:]))
+
+    def test_snippet_marks_the_matched_words(self):
+        self.service.save_message(self.alice, self.bob, False, " ".join(f"w{n}" for n in range(30)) + " Héllo!")
+        [hit] = self.service.search_messages(self.bob, "hello")
+        self.assertEqual(hit[5], "...w19 w20 w21 w22 w23 w24 w25 w26 w27 w28 w29 [Héllo]!")
+
+    def test_other_users_chats_are_not_searched(self):
+        carol = self.service.create_user('carol', b'x', '3')
+        self.service.save_message(self.alice, self.bob, False, "secret plan")
+        self.assertEqual(len(self.service.search_messages(self.bob, "plan")), 1)
+        self.assertEqual(self.service.search_messages(carol, "plan"), [])
+
+
+if __name__ == '__main__':
+    unittest.main()